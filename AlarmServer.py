@@ -2,54 +2,341 @@
 # -*- coding: utf-8 -*-
 
 import os, sys, struct, json
-from time import sleep
-from socket import *
-from datetime import *
+import argparse
+import asyncio
+import logging
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import monotonic, time
+from socket import inet_ntoa
 
-if len(sys.argv) > 1:
-    port = sys.argv[1]
-else:
-    print("Usage: %s [Port]" % os.path.basename(sys.argv[0]))
-    port = input("Port(default 15002): ")
-if port == "":
-    port = "15002"
-server = socket(AF_INET, SOCK_STREAM)
-server.bind(("0.0.0.0", int(port)))
-# server.settimeout(0.5)
-server.listen(1)
+from dvrip_header import HEADER
 
-log = "info.txt"
-
-
-def tolog(s):
-    logfile = open(datetime.now().strftime("%Y_%m_%d_") + log, "a+")
-    logfile.write(s)
-    logfile.close()
+MAX_PAYLOAD = 0x100000
 
 
 def GetIP(s):
     return inet_ntoa(struct.pack("<I", int(s, 16)))
 
 
-while True:
-    try:
-        conn, addr = server.accept()
-        head, version, session, sequence_number, msgid, len_data = struct.unpack(
-            "BB2xII2xHI", conn.recv(20)
+class AlarmStats(object):
+    """Counters of the alarm server, rate is averaged over the last `window` seconds"""
+
+    def __init__(self, window=10):
+        self.window = window
+        self.events = 0
+        self.parse_errors = 0
+        self.connections = 0
+        self.active = 0
+        self.written = 0
+        self.dropped = 0
+        self.buckets = deque([[0, 0]], maxlen=window + 1)
+
+    def event(self):
+        self.events += 1
+        second = int(monotonic())
+        bucket = self.buckets[-1]
+        if bucket[0] == second:
+            bucket[1] += 1
+        else:
+            self.buckets.append([second, 1])
+
+    def events_per_sec(self):
+        now = int(monotonic())
+        count = sum(n for second, n in self.buckets if now - second < self.window)
+        return count / self.window
+
+    def as_dict(self):
+        return {
+            "events": self.events,
+            "events_per_sec": self.events_per_sec(),
+            "parse_errors": self.parse_errors,
+            "connections": self.connections,
+            "active": self.active,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+class JSONLSink(object):
+    """Append events to `path` (strftime pattern) as JSON lines,
+    new file when the date changes or the file grows over max_bytes"""
+
+    def __init__(self, path="%Y_%m_%d_info.jsonl", max_bytes=0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = None
+        self.name = None
+        self.base = None
+        self.part = 0
+
+    def current_name(self):
+        base = datetime.now().strftime(self.path)
+        if base != self.base:
+            self.base = base
+            self.part = 0
+        elif self.max_bytes and self.name is not None and os.path.getsize(self.name) >= self.max_bytes:
+            self.part += 1
+        if self.part:
+            return "%s.%d" % (base, self.part)
+        return base
+
+    def write(self, events):
+        name = self.current_name()
+        if self.file is None or name != self.name:
+            self.close()
+            self.file = open(name, "a", encoding="utf-8")
+            self.name = name
+        self.file.write(
+            "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events)
+        )
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SQLiteSink(JSONLSink):
+    """Insert events into SQLite database `path` (strftime pattern),
+    rotated like JSONLSink"""
+
+    def __init__(self, path="%Y_%m_%d_info.sqlite", max_bytes=0):
+        JSONLSink.__init__(self, path, max_bytes)
+        self.db = None
+
+    def write(self, events):
+        name = self.current_name()
+        if self.db is None or name != self.name:
+            self.close()
+            self.db = sqlite3.connect(name)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS events (time REAL, ip TEXT, session INTEGER,"
+                " sequence INTEGER, msgid INTEGER, name TEXT, event TEXT)"
+            )
+            self.name = name
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        e["time"],
+                        e["ip"],
+                        e["session"],
+                        e["sequence"],
+                        e["msgid"],
+                        e.get("name"),
+                        json.dumps(e["event"], ensure_ascii=False),
+                    )
+                    for e in events
+                ],
+            )
+
+    def close(self):
+        JSONLSink.close(self)
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+class AlarmServer(object):
+    """Receives DVRIP alarm pushes from many cameras at once.
+
+    Every event is handed to subscribers and written to the sink in batches
+    of up to `batch` events or every `flush_interval` seconds. Batches the
+    sink fails to write are tried again, at most `max_pending` events wait,
+    the oldest are dropped beyond."""
+
+    def __init__(
+        self,
+        host="0.0.0.0",
+        port=15002,
+        sink=None,
+        batch=500,
+        flush_interval=1.0,
+        timeout=30,
+        max_pending=100000,
+    ):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.sink = sink
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.stats = AlarmStats()
+        self.subscribers = []
+        self.queues = []
+        self.server = None
+        self.pending = None
+        self.writer_task = None
+        # sink is used from one thread only, sqlite3 insists on it
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def subscribe(self, func):
+        """func(event) is called for every event, coroutine functions are scheduled"""
+        self.subscribers.append(func)
+
+    def unsubscribe(self, func):
+        self.subscribers.remove(func)
+
+    def queue(self, maxsize=10000):
+        """asyncio.Queue receiving every event, oldest events are dropped when full"""
+        q = asyncio.Queue(maxsize)
+        self.queues.append(q)
+        return q
+
+    def publish(self, event):
+        self.stats.event()
+        for func in self.subscribers:
+            try:
+                ret = func(event)
+                if asyncio.iscoroutine(ret):
+                    asyncio.ensure_future(ret)
+            except Exception:
+                self.logger.exception("Alarm subscriber failed")
+        for q in self.queues:
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(event)
+        if self.pending is not None:
+            self.pending.append(event)
+            self.trim()
+
+    def trim(self):
+        while len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.stats.dropped += 1
+
+    async def handle(self, reader, writer):
+        ip = writer.get_extra_info("peername")[0]
+        self.stats.connections += 1
+        self.stats.active += 1
+        try:
+            while True:
+                try:
+                    header = await asyncio.wait_for(reader.readexactly(HEADER.size), self.timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break
+                head, version, session, sequence_number, msgid, len_data = HEADER.unpack(header)
+                if head != 255 or len_data > MAX_PAYLOAD:
+                    self.stats.parse_errors += 1
+                    break
+                try:
+                    data = await asyncio.wait_for(reader.readexactly(len_data), self.timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self.stats.parse_errors += 1
+                    break
+                try:
+                    reply = json.loads(data.decode("utf-8", errors="replace").rstrip("\x00\n"))
+                except ValueError:
+                    self.stats.parse_errors += 1
+                    continue
+                self.publish(
+                    {
+                        "time": time(),
+                        "ip": ip,
+                        "session": session,
+                        "sequence": sequence_number,
+                        "msgid": msgid,
+                        "name": reply.get("Name") if hasattr(reply, "get") else None,
+                        "event": reply,
+                    }
+                )
+        except ConnectionError:
+            pass
+        finally:
+            self.stats.active -= 1
+            writer.close()
+
+    async def writer_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        loop = asyncio.get_event_loop()
+        while self.pending:
+            events = [self.pending.popleft() for i in range(min(self.batch, len(self.pending)))]
+            try:
+                await loop.run_in_executor(self.executor, self.sink.write, events)
+                self.stats.written += len(events)
+            except Exception:
+                self.logger.exception("Cannot write %d alarm events", len(events))
+                # tried again at the next flush, in their order
+                self.pending.extendleft(reversed(events))
+                self.trim()
+                return
+
+    async def start(self):
+        if self.sink is not None:
+            self.pending = deque()
+            self.writer_task = asyncio.ensure_future(self.writer_loop())
+        self.server = await asyncio.start_server(
+            self.handle, self.host, self.port, backlog=4096
         )
-        sleep(0.1)  # Just for recive whole packet
-        data = conn.recv(len_data)
-        conn.close()
-        reply = json.loads(data.decode("utf-8", errors="replace").rstrip("\x00\n"))
-        print(datetime.now().strftime("[%Y-%m-%d %H:%M:%S]>>>"))
-        print(head, version, session, sequence_number, msgid, len_data)
-        print(json.dumps(reply, indent=4, sort_keys=True))
-        print("<<<")
-        tolog(repr(data) + "\r\n")
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            await self.flush()
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.sink.close)
+
+    async def serve_forever(self):
+        await self.start()
+        await self.server.serve_forever()
+
+
+def print_event(event):
+    print(datetime.fromtimestamp(event["time"]).strftime("[%Y-%m-%d %H:%M:%S]>>>"))
+    print(event["ip"], event["session"], event["sequence"], event["msgid"])
+    print(json.dumps(event["event"], indent=4, sort_keys=True))
+    print("<<<")
+
+
+async def print_stats(server, interval):
+    while True:
+        await asyncio.sleep(interval)
+        print(json.dumps(server.stats.as_dict()))
+
+
+async def main(args):
+    if args.sink == "sqlite":
+        sink = SQLiteSink(args.log or "%Y_%m_%d_info.sqlite", args.max_bytes)
+    elif args.sink == "jsonl":
+        sink = JSONLSink(args.log or "%Y_%m_%d_info.jsonl", args.max_bytes)
+    else:
+        sink = None
+    server = AlarmServer(args.host, args.port, sink)
+    if not args.quiet:
+        server.subscribe(print_event)
+    if args.stats:
+        asyncio.ensure_future(print_stats(server, args.stats))
+    try:
+        await server.serve_forever()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", nargs="?", type=int, default=15002, help="Port (default 15002)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--sink", choices=["jsonl", "sqlite", "none"], default="jsonl")
+    parser.add_argument("--log", help="Sink file name, strftime pattern")
+    parser.add_argument("--max-bytes", type=int, default=0, help="Rotate sink file after this size")
+    parser.add_argument("--stats", type=float, default=0, help="Print counters every N seconds")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Do not print events")
+    try:
+        asyncio.run(main(parser.parse_args()))
     except (KeyboardInterrupt, SystemExit):
-        break
-    # except:
-    # 	e = 1
-    # print "no"
-server.close()
-sys.exit(1)
+        pass
+    sys.exit(1)
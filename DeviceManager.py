@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 
-import os, sys, struct, json
+import os, sys, struct, json, csv
 from locale import getdefaultlocale
 from subprocess import check_output
 from socket import *
 import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from ipaddress import ip_network
+from time import monotonic, sleep
 from datetime import *
 import hashlib, base64
-from dvrip import DVRIPCam
+from html import escape
+from io import StringIO
+from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip_pool import session
+from dvrip_header import SEARCH_HEADER
+import dvrip_firmware
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 try:
     try:
@@ -23,7 +42,10 @@ except:
     GUI_TK = False
 
 devices = {}
+sweep = []  # CIDR ranges probed by unicast in addition to broadcasts
+sweepRate = 500  # unicast probes per second
 log = "search.log"
+logfile = None
 icon = "R0lGODlhIAAgAPcAAAAAAAkFAgwKBwQBABQNBRAQDQQFERAOFA4QFBcWFSAaFCYgGAoUMhwiMSUlJCsrKyooJy8wLjUxLjkzKTY1Mzw7OzY3OEpFPwsaSRsuTRUsWD4+QCo8XQAOch0nYB05biItaj9ARjdHYiRMfEREQ0hIR0xMTEdKSVNOQ0xQT0NEUVFNUkhRXlVVVFdYWFxdXFtZVV9wXGZjXUtbb19fYFRda19gYFZhbF5wfWRkZGVna2xsa2hmaHFtamV0Ynp2aHNzc3x8fHh3coF9dYJ+eH2Fe3K1YoGBfgIgigwrmypajDtXhw9FpxFFpSdVpzlqvFNzj0FvnV9zkENnpUh8sgdcxh1Q2jt3zThi0SJy0Dl81Rhu/g50/xp9/x90/zB35TJv8DJ+/EZqzj2DvlGDrlqEuHqLpHeQp26SuhqN+yiC6imH/zSM/yqa/zeV/zik/1aIwlmP0mmayWSY122h3VWb6kyL/1yP8UGU/UiW/VWd/miW+Eqp/12k/1Co/1yq/2Gs/2qr/WKh/nGv/3er9mK3/3K0/3e4+4ODg4uLi4mHiY+Qj5WTjo+PkJSUlJycnKGem6ShnY2ZrKOjo6urrKqqpLi0prS0tLu8vMO+tb+/wJrE+bzf/sTExMfIx8zMzMjIxtrWyM/Q0NXU1NfY193d3djY1uDf4Mnj+931/OTk5Ozs7O/v8PLy8gAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAACH5BAEAAAAALAAAAAAgACAAAAj+AAEIHEiwoMGDCBMqXMiwocOHECNKnEixosWLGDNq3Mgx4iVMnTyJInVKlclSpD550nRpUqKGmD59EjWqlMlVOFWdIgWq0iNNoBIhSujokidPn0aNKrmqVStWqjxRumTqyI5KOxI5OpiIkiakNG2yelqK5alKLSAJgbBBB6RIjArmCKLIkV1HjyZNpTTJFKgSQoI4cGBiBxBIR6QM6TGQxooWL3LwMBwkSJEcLUq8YATDAZAdMkKh+GGpAo0cL1wInJuokSNIeqdeCgLBAoVMR2CEMkHDzAcnTCzsCAKERwsXK3wYKYLIdd6pjh4guCGJw5IpT7R8CeNlCwsikx7+JTJ+PAZlRHXxOgqBAQMTLXj0AAKkJw+eJw6CXGqJyAWNyT8QgZ5rsD2igwYEOOEGH38EEoghgcQhQgJAxISJI/8ZNoQUijiX1yM7NIBAFm3wUcghh9yBhQcCFEBDJ6V8MskKhgERxBGMMILXI7AhsoAAGSgRBRlliLHHHlZgMAAJmLByCiUnfGajFEcgotVzjkhggAYjjBHFFISgkoodSDAwAyStqDIJAELs4CYQQxChVSRTQcJCFWmUyAcghmzCCRgdXCEHEU69VJiNdDmnV0s4rNHFGmzgkUcfhgiShAd0nNHDVAc9YIEFFWxAQgkVpKAGF1yw4UYdc6AhhQohJFiwQAIRPQCHFlRAccMJFCRAgAAVJXDBBAsQEEBHDwUEADs="
 help = """
 	Usage: %s [-q] [-n] [Command];[Command];...
@@ -36,10 +58,16 @@ help = """
 	log [filename]		Set log file
 	logLevel [0..100]	Set log verbosity
 	search [brand]		Searching devices of [brand] or all
+	interfaces		Network interfaces used for search
+	sweep [CIDR] ...	Also probe these ranges by unicast ("sweep none" to disable)
+	sweeprate [pps]		Unicast probes per second
 	table			Table of devices
 	json			JSON String of devices
+	csv, html, jsonl	Devices in other formats
+	export [fmt] [file|-] [live] [password] [workers]   - Stream devices to file, live adds firmware/uptime/storage read from devices
 	device [MAC]		JSON String of [MAC]
 	config [MAC] [IP] [MASK] [GATE] [Pasword]   - Configure searched divice
+	batch [plan] [report]	Configure devices from CSV/JSON plan (MAC,IP,Mask,Gateway,Password)
 	""" % os.path.basename(
     sys.argv[0]
 )
@@ -68,6 +96,7 @@ locale = {
         "Text files": u"Текстовые файлы",
         "Searching %s, found %d devices": u"Поиск %s, нашли %d устройств",
         "Found %d devices": u"Найденно %d устройств",
+        "Configured %d of %d devices": u"Настроено %d из %d устройств",
         "All": "По всем",
         "Error": "Ошибка",
     },
@@ -142,11 +171,17 @@ CODES = {
 
 
 def tolog(s):
+    global logfile
     print(s)
     if logLevel >= 20:
-        logfile = open(log, "wb")
+        if logfile is None or logfile.name != log:
+            if logfile is not None:
+                logfile.close()
+            logfile = open(log, "ab")
+        if not s.endswith("\n"):
+            s += "\n"
         logfile.write(bytes(s, "utf-8"))
-        logfile.close()
+        logfile.flush()
 
 
 def get_nat_ip():
@@ -164,11 +199,16 @@ def get_nat_ip():
 
 def local_ip():
     ip = get_nat_ip()
+    mask = "255.255.255.0"
+    for name, addr, netmask in GetInterfaces():
+        if addr == ip:
+            mask = netmask
+    net = ip_network("%s/%s" % (ip, mask), strict=False)
     ipn = struct.unpack(">I", inet_aton(ip))
     return (
         inet_ntoa(struct.pack(">I", ipn[0] + 10)),
-        "255.255.255.0",
-        inet_ntoa(struct.pack(">I", (ipn[0] & 0xFFFFFF00) + 1)),
+        mask,
+        str(net.network_address + 1),
     )
 
 
@@ -204,20 +244,96 @@ def GetAllAddr():
         ]
 
 
+def GetInterfaces():
+    """List (name, address, netmask) of every IPv4 interface except loopback"""
+    ifaces = []
+    if psutil is not None:
+        for name, addrs in psutil.net_if_addrs().items():
+            for a in addrs:
+                if a.family == AF_INET and a.netmask and not a.address.startswith("127."):
+                    ifaces.append((name, a.address, a.netmask))
+    elif fcntl is not None:
+        # SIOCGIFADDR / SIOCGIFNETMASK, Linux only
+        s = socket(AF_INET, SOCK_DGRAM)
+        try:
+            for index, name in if_nameindex():
+                req = struct.pack("256s", name.encode()[:15])
+                try:
+                    addr = inet_ntoa(fcntl.ioctl(s.fileno(), 0x8915, req)[20:24])
+                    mask = inet_ntoa(fcntl.ioctl(s.fileno(), 0x891B, req)[20:24])
+                except OSError:
+                    continue
+                if not addr.startswith("127."):
+                    ifaces.append((name, addr, mask))
+        finally:
+            s.close()
+    if not ifaces:
+        try:
+            ifaces = [("", addr, "255.255.255.0") for addr in GetAllAddr()]
+        except Exception:
+            pass
+    return ifaces
+
+
+def BroadcastTargets():
+    targets = ["255.255.255.255"]
+    for name, addr, mask in GetInterfaces():
+        net = ip_network("%s/%s" % (addr, mask), strict=False)
+        if net.prefixlen < 31 and str(net.broadcast_address) not in targets:
+            targets.append(str(net.broadcast_address))
+    return targets
+
+
+def SweepTargets():
+    for cidr in sweep:
+        for host in ip_network(cidr, strict=False).hosts():
+            yield str(host)
+
+
+def SweepProbe(server, pkt, port):
+    delay = 1.0 / sweepRate if sweepRate > 0 else 0
+    deadline = monotonic()
+    for host in SweepTargets():
+        try:
+            server.sendto(pkt, (host, port))
+        except OSError:
+            pass
+        deadline += delay
+        pause = deadline - monotonic()
+        if pause > 0:
+            sleep(pause)
+
+
+def SendProbe(server, pkt, port):
+    """Broadcast pkt on every interface at once, then sweep unicast ranges in background.
+    Returns the sweeping thread, search goes on while it is alive"""
+    for addr in BroadcastTargets():
+        try:
+            server.sendto(pkt, (addr, port))
+        except OSError:
+            pass
+    sender = threading.Thread(target=SweepProbe, args=(server, pkt, port), daemon=True)
+    sender.start()
+    return sender
+
+
 def SearchXM(devices):
     server = socket(AF_INET, SOCK_DGRAM)
     server.bind(("", 34569))
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(
-        struct.pack("BBHIIHHI", 255, 0, 0, 0, 0, 0, 1530, 0), ("255.255.255.255", 34569)
+    sender = SendProbe(
+        server, SEARCH_HEADER.pack(255, 0, 0, 0, 0, 0, 1530, 0), 34569
     )
     while True:
-        data = server.recvfrom(1024)
-        head, ver, typ, session, packet, info, msg, leng = struct.unpack(
-            "BBHIIHHI", data[0][:20]
-        )
+        try:
+            data = server.recvfrom(1024)
+        except timeout:
+            if sender.is_alive():
+                continue
+            break
+        head, ver, typ, session, packet, info, msg, leng = SEARCH_HEADER.unpack_from(data[0])
         if (msg == 1531) and leng > 0:
             answer = json.loads(
                 data[0][20 : 20 + leng].replace(b"\x00", b""))
@@ -236,9 +352,10 @@ def SearchDahua(devices):
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(
+    sender = SendProbe(
+        server,
         b"\xa3\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00",
-        ("255.255.255.255", 5050),
+        5050,
     )
     while True:
         try:
@@ -263,6 +380,10 @@ def SearchDahua(devices):
                 answer[u"SN"] = ""
                 if answer[u"MAC"] not in devices.keys():
                     devices[answer[u"MAC"]] = answer
+        except timeout:
+            if sender.is_alive():
+                continue
+            break
         except:
             break
     server.close()
@@ -275,9 +396,10 @@ def SearchFros(devices):
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(
+    sender = SendProbe(
+        server,
         b"MO_I\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x04\x00\x00\x00\x04\x00\x00\x00\x00\x00\x00\x01",
-        ("255.255.255.255", 10000),
+        10000,
     )
     while True:
         try:
@@ -326,6 +448,10 @@ def SearchFros(devices):
                     u"SwVer": ver,
                     u"WebVer": webver,
                 }
+        except timeout:
+            if sender.is_alive():
+                continue
+            break
         except:
             break
     server.close()
@@ -338,7 +464,7 @@ def SearchWans(devices):
     server.settimeout(1.3)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(b"DH\x01\x01", ("255.255.255.255", 8600))
+    sender = SendProbe(server, b"DH\x01\x01", 8600)
     while True:
         try:
             data = server.recvfrom(1024)
@@ -406,6 +532,10 @@ def SearchWans(devices):
                     u"SwVer": ver,
                     u"WebVer": webver,
                 }
+        except timeout:
+            if sender.is_alive():
+                continue
+            break
         except:
             break
     server.close()
@@ -419,7 +549,7 @@ def SearchBeward(devices):
     server.settimeout(1)
     server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
     server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    server.sendto(b"u4aRnryQk5CN08/P08DAwMD/", ("255.255.255.255", 6666))
+    sender = SendProbe(server, b"u4aRnryQk5CN08/P08DAwMD/", 6666)
     while True:
         try:
             data = server.recvfrom(1024)
@@ -430,247 +560,590 @@ def SearchBeward(devices):
             # 	if answer['NetWork.NetCommon']['MAC'] not in devices.keys():
             # 		devices[answer['NetWork.NetCommon']['MAC']] = answer['NetWork.NetCommon']
             # 		devices[answer['NetWork.NetCommon']['MAC']][u'Brand'] = u"xm"
+        except timeout:
+            if sender.is_alive():
+                continue
+            break
         except:
             break
     server.close()
     return devices
 
 
-def ConfigXM(data):
+def PlanEntry(data):
+    """Plan entry from config command arguments"""
+    return {
+        u"MAC": data[1],
+        u"IP": data[2],
+        u"Mask": data[3],
+        u"Gateway": data[4],
+        u"Password": data[5],
+        u"Username": data[6] if len(data) > 6 else u"admin",
+    }
+
+
+def LoadPlan(filename):
+    """Read MAC -> IP/Mask/Gateway/Password plan from CSV or JSON file"""
+    keys = {
+        "mac": u"MAC",
+        "ip": u"IP",
+        "mask": u"Mask",
+        "submask": u"Mask",
+        "gateway": u"Gateway",
+        "gate": u"Gateway",
+        "password": u"Password",
+        "username": u"Username",
+        "user": u"Username",
+    }
+    with open(filename, "r", encoding="utf-8") as f:
+        if filename.lower().endswith(".json"):
+            rows = json.load(f)
+            if hasattr(rows, "keys"):
+                rows = [dict(rows[mac], MAC=mac) for mac in rows]
+        else:
+            try:
+                dialect = csv.Sniffer().sniff(f.read(1024), delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            f.seek(0)
+            rows = list(csv.DictReader(f, dialect=dialect))
+    plan = []
+    for row in rows:
+        entry = {u"Password": u"", u"Username": u"admin"}
+        for k in row:
+            if k is not None and k.strip().lower() in keys and row[k] is not None:
+                entry[keys[k.strip().lower()]] = str(row[k]).strip()
+        if u"MAC" in entry:
+            plan.append(entry)
+    return plan
+
+
+def FindMAC(mac):
+    if mac in devices:
+        return mac
+    for dev in devices:
+        if dev.lower() == mac.lower():
+            return dev
+    return None
+
+
+def SearchAll(devices):
+    # every searcher listens on its own port, so run them all at once
+    # and let them merge into the same table
+    with ThreadPoolExecutor(max_workers=len(searchers)) as pool:
+        jobs = {}
+        for s in searchers:
+            tolog(_("Search") + " %s\r" % s)
+            jobs[s] = pool.submit(searchers[s], devices)
+        for s in jobs:
+            try:
+                jobs[s].result()
+            except Exception as error:
+                print(" ".join([str(x) for x in list(error.args)]))
+    return devices
+
+
+def ConfigRounds(packets):
+    """Split packets into rounds in which no two MACs may answer from the
+    same address, a new batch of cameras often shares one factory IP"""
+    rounds = []
+    for mac in packets:
+        addrs = set(packets[mac][1])
+        for used, group in rounds:
+            if not used & addrs:
+                used |= addrs
+                group[mac] = packets[mac]
+                break
+        else:
+            rounds.append((addrs, {mac: packets[mac]}))
+    return [group for used, group in rounds]
+
+
+def ConfigExchange(port, packets, match, bind=None, retries=3):
+    """Send config packets over one socket and collect replies
+    packets: {MAC: (packet, addresses the device may answer from)}
+    match(data): (MAC or None, answer) or None for foreign packets
+    Replies without a MAC are told apart by their source address, MACs
+    sharing one are configured one after the other"""
+    targets = BroadcastTargets()
+    answers = {}
+    server = socket(AF_INET, SOCK_DGRAM)
+    server.settimeout(1)
+    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
+    if bind:
+        server.bind(("", bind))
+    try:
+        for group in ConfigRounds(packets):
+            ConfigDrain(server)
+            owners = {}
+            for mac in group:
+                for addr in group[mac][1]:
+                    owners[addr] = mac
+            for attempt in range(retries + 1):
+                pending = [mac for mac in group if mac not in answers]
+                if len(pending) == 0:
+                    break
+                for mac in pending:
+                    for addr in targets:
+                        try:
+                            server.sendto(group[mac][0], (addr, port))
+                        except OSError:
+                            pass
+                while [mac for mac in group if mac not in answers]:
+                    try:
+                        data, addr = server.recvfrom(1024)
+                    except timeout:
+                        break
+                    try:
+                        found = match(data)
+                    except Exception:
+                        continue
+                    if found is None:
+                        continue
+                    mac = (found[0] and FindMAC(found[0])) or owners.get(addr[0])
+                    if mac in packets and mac not in answers:
+                        answers[mac] = found[1]
+    finally:
+        server.close()
+    return answers
+
+
+def ConfigDrain(server):
+    """Drop late replies to an earlier round, they would be taken for the
+    MACs now answering from the same address"""
+    server.setblocking(False)
+    try:
+        while True:
+            server.recvfrom(1024)
+    except OSError:
+        pass
+    finally:
+        server.settimeout(1)
+
+
+def ConfigApply(entries, answers):
+    """Record the new addresses of the devices that accepted them"""
+    for entry in entries:
+        mac = entry[u"MAC"]
+        if answers.get(mac, {}).get(u"Ret") == 100 and mac in devices:
+            devices[mac][u"GateWay"] = SetIP(entry[u"Gateway"])
+            devices[mac][u"HostIP"] = SetIP(entry[u"IP"])
+            devices[mac][u"Submask"] = SetIP(entry[u"Mask"])
+    return answers
+
+
+def ConfigXMPacket(entry):
+    mac = entry[u"MAC"]
+    addrs = (GetIP(devices[mac][u"HostIP"]), entry[u"IP"])
     config = {}
-    #TODO: may be just copy whwole devices[data[1]] to config?
+    #TODO: may be just copy whwole devices[mac] to config?
     for k in [u"HostName",u"HttpPort",u"MAC",u"MaxBps",u"MonMode",u"SSLPort",u"TCPMaxConn",u"TCPPort",u"TransferPlan",u"UDPPort","UseHSDownLoad"]:
-        if k in devices[data[1]]:
-            config[k] = devices[data[1]][k]
-    config[u"DvrMac"] = devices[data[1]][u"MAC"]
+        if k in devices[mac]:
+            config[k] = devices[mac][k]
+    config[u"DvrMac"] = devices[mac][u"MAC"]
     config[u"EncryptType"] = 1
-    config[u"GateWay"] = SetIP(data[4])
-    config[u"HostIP"] = SetIP(data[2])
-    config[u"Submask"] = SetIP(data[3])
-    config[u"Username"] = data[6]
-    config[u"Password"] = sofia_hash(data[5])
-    devices[data[1]][u"GateWay"] = config[u"GateWay"]
-    devices[data[1]][u"HostIP"] = config[u"HostIP"]
-    devices[data[1]][u"Submask"] = config[u"Submask"]
+    config[u"GateWay"] = SetIP(entry[u"Gateway"])
+    config[u"HostIP"] = SetIP(entry[u"IP"])
+    config[u"Submask"] = SetIP(entry[u"Mask"])
+    config[u"Username"] = entry[u"Username"]
+    config[u"Password"] = sofia_hash(entry[u"Password"])
     config = json.dumps(
         config, ensure_ascii=False, sort_keys=True, separators=(", ", " : ")
     ).encode("utf8")
-    server = socket(AF_INET, SOCK_DGRAM)
-    server.bind(("", 34569))
-    server.settimeout(1)
-    server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    server.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    clen = len(config)
-    server.sendto(
-        struct.pack(
-            "BBHIIHHI%ds2s" % clen,
-            255,
-            0,
-            254,
-            0,
-            0,
-            0,
-            1532,
-            clen + 2,
-            config,
-            b"\x0a\x00",
-        ),
-        ("255.255.255.255", 34569),
+    return (
+        SEARCH_HEADER.pack(255, 0, 254, 0, 0, 0, 1532, len(config) + 2)
+        + config
+        + b"\x0a\x00",
+        addrs,
     )
-    answer = {"Ret": 203}
-    e = 0
-    while True:
-        try:
-            data = server.recvfrom(1024)
-            head, ver, typ, session, packet, info, msg, leng = struct.unpack(
-                "BBHIIHHI", data[0][:20]
-            )
-            if (msg == 1533) and leng > 0:
-                answer = json.loads(
-                    data[0][20 : 20 + leng].replace(b"\x00", b""))
-                break
-        except:
-            e += 1
-            if e > 3:
-                break
-    server.close()
-    return answer
 
 
-def ConfigFros(data):
-    devices[data[1]][u"GateWay"] = SetIP(data[4])
-    devices[data[1]][u"HostIP"] = SetIP(data[2])
-    devices[data[1]][u"Submask"] = SetIP(data[3])
-    client = socket(AF_INET, SOCK_DGRAM)
-    client.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    client.sendto(
+def MatchXM(data):
+    head, ver, typ, session, packet, info, msg, leng = SEARCH_HEADER.unpack_from(data)
+    if (msg == 1533) and leng > 0:
+        answer = json.loads(data[20 : 20 + leng].replace(b"\x00", b""))
+        # some firmwares tell the MAC, in the reply or its NetCommon part
+        mac = None
+        for part in [answer] + [v for v in answer.values() if isinstance(v, dict)]:
+            mac = part.get(u"MAC") or part.get(u"DvrMac") or mac
+        return mac, answer
+    return None
+
+
+def ConfigXMBatch(entries):
+    packets = dict((e[u"MAC"], ConfigXMPacket(e)) for e in entries)
+    return ConfigApply(entries, ConfigExchange(34569, packets, MatchXM, bind=34569))
+
+
+def ConfigXM(data):
+    return ConfigXMBatch([PlanEntry(data)]).get(data[1], {"Ret": 203})
+
+
+def ConfigFrosPacket(entry):
+    mac = entry[u"MAC"]
+    addrs = (GetIP(devices[mac][u"HostIP"]), entry[u"IP"])
+    return (
         struct.pack(
             "<4sB10xB3xB6xB12sx12sx12sxIIIIxB",
-            "MO_I",
+            b"MO_I",
             2,
             61,
             61,
             1,
-            devices[data[1]][u"MAC"].replace(":", ""),
-            "admin",
-            data[5],
-            int(SetIP(data[2]), 16),
-            int(SetIP(data[3]), 16),
-            int(SetIP(data[4]), 16),
-            int(SetIP(data[4]), 16),
+            devices[mac][u"MAC"].replace(":", "").encode(),
+            b"admin",
+            entry[u"Password"].encode(),
+            int(SetIP(entry[u"IP"]), 16),
+            int(SetIP(entry[u"Mask"]), 16),
+            int(SetIP(entry[u"Gateway"]), 16),
+            int(SetIP(entry[u"Gateway"]), 16),
             80,
         ),
-        ("255.255.255.255", 10000),
+        addrs,
     )
-    answer = {}
-    while True:
-        try:
-            data = client.recvfrom(1024)
-            if data[0][4] == "\x03":
-                s, type, n, n, result = struct.unpack("<4sB10xB3xB3xBx", data[0])
-                if result == 0:
-                    answer[u"Ret"] = 100
-                else:
-                    answer[u"Ret"] = 101
-            break
-        except:
-            break
-            e = 1
-    client.close()
-    return answer
 
 
-def ConfigWans(data):
-    devices[data[1]][u"GateWay"] = SetIP(data[4])
-    devices[data[1]][u"HostIP"] = SetIP(data[2])
-    devices[data[1]][u"Submask"] = SetIP(data[3])
-    devices[data[1]][u"TCPPort"] = devices[data[1]][u"HttpPort"]
-    client = socket(AF_INET, SOCK_DGRAM)
-    # client.bind(('',8600))
-    client.settimeout(1)
-    client.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-    client.setsockopt(SOL_SOCKET, SO_BROADCAST, 1)
-    mac = [int(x, 16) for x in data[1].split(":")]
-    client.sendto(
+def MatchFros(data):
+    if data[4:5] == b"\x03":
+        # no MAC in the reply, ConfigExchange goes by the source address
+        s, type, n, n, result = struct.unpack_from("<4sB10xB3xB3xBx", data)
+        return None, {u"Ret": 100 if result == 0 else 101}
+    return None
+
+
+def ConfigFrosBatch(entries):
+    packets = dict((e[u"MAC"], ConfigFrosPacket(e)) for e in entries)
+    return ConfigApply(entries, ConfigExchange(10000, packets, MatchFros))
+
+
+def ConfigFros(data):
+    return ConfigFrosBatch([PlanEntry(data)]).get(data[1], {})
+
+
+def ConfigWansPacket(entry):
+    mac = entry[u"MAC"]
+    addrs = (GetIP(devices[mac][u"HostIP"]), entry[u"IP"])
+    m = [int(x, 16) for x in mac.split(":")]
+    return (
         struct.pack(
             "2sBB16s16s16s16s16s6BH32s32s48x16s16s32s32sxB22x",
-            "DH",
+            b"DH",
             2,
             1,
-            data[2],
-            data[3],
-            data[4],
-            "8.8.8.8",
-            data[4],
-            mac[0],
-            mac[1],
-            mac[2],
-            mac[3],
-            mac[4],
-            mac[5],
-            devices[data[1]][u"HttpPort"],
-            devices[data[1]][u"SN"],
-            devices[data[1]][u"HostName"],
-            devices[data[1]][u"SwVer"],
-            devices[data[1]][u"WebVer"],
-            "admin",
-            data[5],
+            entry[u"IP"].encode(),
+            entry[u"Mask"].encode(),
+            entry[u"Gateway"].encode(),
+            b"8.8.8.8",
+            entry[u"Gateway"].encode(),
+            m[0],
+            m[1],
+            m[2],
+            m[3],
+            m[4],
+            m[5],
+            devices[mac][u"HttpPort"],
+            devices[mac][u"SN"].encode(),
+            devices[mac][u"HostName"].encode(),
+            devices[mac][u"SwVer"].encode(),
+            devices[mac][u"WebVer"].encode(),
+            b"admin",
+            entry[u"Password"].encode(),
             0,
         ),
-        ("255.255.255.255", 8600),
+        addrs,
     )
-    answer = {}
-    while True:
-        try:
-            data = client.recvfrom(1024)
-            mac = [0, 0, 0, 0, 0, 0]
-            (
-                head,
-                pver,
-                type,
-                ip,
-                mask,
-                gate,
-                dns2,
-                dns,
-                mac[0],
-                mac[1],
-                mac[2],
-                mac[3],
-                mac[4],
-                mac[5],
-                port,
-                ser,
-                name,
-                ver,
-                webver,
-                user,
-                passwd,
-                dhcp,
-                err,
-            ) = struct.unpack(
-                "2sBB16s16s16s16s16s6BH32s32s48x16s16s32s32sxB22xB", data[0][:325]
-            )
-            mac = "%02x:%02x:%02x:%02x:%02x:%02x" % (
-                mac[0],
-                mac[1],
-                mac[2],
-                mac[3],
-                mac[4],
-                mac[5],
-            )
-            name, ser, ver, webver = (
-                name.replace("\x00", ""),
-                ser.replace("\x00", ""),
-                ver.replace("\x00", ""),
-                webver.replace("\x00", ""),
-            )
-            ip, mask, gate, dns = (
-                SetIP(ip.replace("\x00", "")),
-                SetIP(mask.replace("\x00", "")),
-                SetIP(gate.replace("\x00", "")),
-                SetIP(dns.replace("\x00", "")),
-            )
-            devices[mac] = {
-                u"Brand": u"wans",
-                u"GateWay": gate,
-                u"DNS": dns,
-                u"HostIP": ip,
-                u"HostName": name,
-                u"HttpPort": port,
-                u"TCPPort": port,
+
+
+def MatchWans(data):
+    if len(data) < 325:
+        return None
+    mac = [0, 0, 0, 0, 0, 0]
+    (
+        head,
+        pver,
+        type,
+        ip,
+        mask,
+        gate,
+        dns2,
+        dns,
+        mac[0],
+        mac[1],
+        mac[2],
+        mac[3],
+        mac[4],
+        mac[5],
+        port,
+        ser,
+        name,
+        ver,
+        webver,
+        user,
+        passwd,
+        dhcp,
+        err,
+    ) = struct.unpack(
+        "2sBB16s16s16s16s16s6BH32s32s48x16s16s32s32sxB22xB", data[:325]
+    )
+    mac = "%02x:%02x:%02x:%02x:%02x:%02x" % (
+        mac[0],
+        mac[1],
+        mac[2],
+        mac[3],
+        mac[4],
+        mac[5],
+    )
+    name, ser, ver, webver = (
+        name.replace(b"\x00", b"").decode(),
+        ser.replace(b"\x00", b"").decode(),
+        ver.replace(b"\x00", b"").decode(),
+        webver.replace(b"\x00", b"").decode(),
+    )
+    ip, mask, gate, dns = (
+        SetIP(ip.replace(b"\x00", b"").decode()),
+        SetIP(mask.replace(b"\x00", b"").decode()),
+        SetIP(gate.replace(b"\x00", b"").decode()),
+        SetIP(dns.replace(b"\x00", b"").decode()),
+    )
+    devices[mac] = {
+        u"Brand": u"wans",
+        u"GateWay": gate,
+        u"DNS": dns,
+        u"HostIP": ip,
+        u"HostName": name,
+        u"HttpPort": port,
+        u"TCPPort": port,
+        u"MAC": mac,
+        u"MaxBps": 0,
+        u"MonMode": u"HTTP",
+        u"SN": ser,
+        u"Submask": mask,
+        u"SwVer": ver,
+        u"WebVer": webver,
+    }
+    return mac, {u"Ret": 100 if err == 0 else 101}
+
+
+def ConfigWansBatch(entries):
+    packets = dict((e[u"MAC"], ConfigWansPacket(e)) for e in entries)
+    return ConfigApply(entries, ConfigExchange(8600, packets, MatchWans))
+
+
+def ConfigWans(data):
+    return ConfigWansBatch([PlanEntry(data)]).get(data[1], {})
+
+
+def ConfigBatch(plan, report=None):
+    """Configure every device of plan, one exchange per vendor, all vendors at once
+    Returns {MAC: answer}, unanswered devices get Ret 108"""
+    if [e for e in plan if FindMAC(e[u"MAC"]) is None]:
+        SearchAll(devices)
+    results = {}
+    groups = {}
+    for entry in plan:
+        mac = FindMAC(entry[u"MAC"])
+        if mac is None:
+            results[entry[u"MAC"]] = {u"Ret": 210}
+        elif devices[mac][u"Brand"] not in batchConfigure:
+            results[mac] = {u"Ret": 605}
+        else:
+            entry = dict(entry, MAC=mac)
+            groups.setdefault(devices[mac][u"Brand"], []).append(entry)
+    if len(groups) > 0:
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            jobs = [pool.submit(batchConfigure[b], groups[b]) for b in groups]
+            for job in jobs:
+                try:
+                    results.update(job.result())
+                except Exception as error:
+                    print(" ".join([str(x) for x in list(error.args)]))
+    for entries in groups.values():
+        for entry in entries:
+            if entry[u"MAC"] not in results:
+                results[entry[u"MAC"]] = {u"Ret": 108}
+    if report:
+        WriteReport(report, plan, results)
+    return results
+
+
+def WriteReport(filename, plan, results):
+    rows = []
+    for entry in plan:
+        mac = FindMAC(entry[u"MAC"]) or entry[u"MAC"]
+        ret = results.get(mac, {}).get(u"Ret", 101)
+        rows.append(
+            {
                 u"MAC": mac,
-                u"MaxBps": 0,
-                u"MonMode": u"HTTP",
-                u"SN": ser,
-                u"Submask": mask,
-                u"SwVer": ver,
-                u"WebVer": webver,
+                u"Brand": devices.get(mac, {}).get(u"Brand", u""),
+                u"IP": entry.get(u"IP", u""),
+                u"Mask": entry.get(u"Mask", u""),
+                u"Gateway": entry.get(u"Gateway", u""),
+                u"Ret": ret,
+                u"Result": CODES.get(ret, u""),
             }
-            if err == 0:
-                answer[u"Ret"] = 100
-            else:
-                answer[u"Ret"] = 101
-            break
-        except:
-            break
-            e = 1
-    client.close()
-    return answer
+        )
+    with open(filename, "w", encoding="utf-8", newline="") as f:
+        if filename.lower().endswith(".json"):
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        else:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()) if rows else [u"MAC"])
+            writer.writeheader()
+            writer.writerows(rows)
 
 
-def FlashXM(cmd):
-    cam = DVRIPCam(GetIP(devices[cmd[1]]["HostIP"]), "admin", cmd[2])
-    if cam.login():
-        cmd[4](_("Auth success"))
-        cam.upgrade(cmd[3], 0x4000, cmd[4])
+FIELDS = [
+    (u"Brand", _("Vendor")),
+    (u"MAC", _("MAC Address")),
+    (u"HostName", _("Name")),
+    (u"HostIP", _("IP Address")),
+    (u"TCPPort", _("Port")),
+    (u"SN", _("SN")),
+]
+LIVE_FIELDS = [
+    (u"SoftWareVersion", _("Firmware")),
+    (u"Uptime", _("Uptime")),
+    (u"TotalSpace", _("Storage")),
+    (u"RemainSpace", _("Free space")),
+    (u"Error", _("Error")),
+]
+
+
+class TableExport:
+    def __init__(self, out, fields):
+        self.out = out
+        self.fields = fields
+
+    def begin(self):
+        self.out.write("\t".join([title for key, title in self.fields]) + "\n")
+
+    def row(self, values):
+        self.out.write("\t".join([str(x) for x in values]) + "\n")
+
+    def end(self):
+        pass
+
+
+class CSVExport(TableExport):
+    def __init__(self, out, fields):
+        TableExport.__init__(self, out, fields)
+        self.writer = csv.writer(out, delimiter=";", lineterminator="\n")
+
+    def begin(self):
+        self.writer.writerow([title for key, title in self.fields])
+
+    def row(self, values):
+        self.writer.writerow(values)
+
+
+class JSONLExport(TableExport):
+    def begin(self):
+        pass
+
+    def row(self, values):
+        self.out.write(
+            json.dumps(dict(zip([key for key, title in self.fields], values)), ensure_ascii=False)
+            + "\n"
+        )
+
+
+class HTMLExport(TableExport):
+    def begin(self):
+        self.out.write(
+            "<table border=1><th>"
+            + "</th><th>".join([escape(title) for key, title in self.fields])
+            + "</th>\r\n"
+        )
+
+    def row(self, values):
+        self.out.write(
+            "<tr><td>"
+            + "</td><td>".join([escape(str(x)) for x in values])
+            + "</td></tr>\r\n"
+        )
+
+    def end(self):
+        self.out.write("</table>\r\n")
+
+
+def LiveInfo(dev, password="", timeout=5):
+    """Read firmware, uptime and storage from a device through DVRIP"""
+    info = {}
+    cam = DVRIPCam(GetIP(dev[u"HostIP"]), user=dev.get(u"Username", "admin"), password=password, port=dev[u"TCPPort"])
+    try:
+        cam.connect(timeout)
+        if not cam.login():
+            info[u"Error"] = CODES.get(cam.session, _("Auth failed"))
+            return info
+        sysinfo = cam.get_system_info()
+        info[u"SoftWareVersion"] = sysinfo.get(u"SoftWareVersion", u"")
+        if u"DeviceRunTime" in sysinfo:
+            info[u"Uptime"] = str(timedelta(minutes=int(sysinfo[u"DeviceRunTime"], 16)))
+        storage = cam.send(1020, {"Name": "StorageInfo"}) or {}
+        total, remain = 0, 0
+        for s in storage.get(u"StorageInfo", []):
+            for p in s.get(u"Partition", []):
+                total += int(p[u"TotalSpace"], 0)
+                remain += int(p[u"RemainSpace"], 0)
+        info[u"TotalSpace"] = total
+        info[u"RemainSpace"] = remain
+    except Exception as error:
+        info[u"Error"] = " ".join([str(x) for x in list(error.args)]) or repr(error)
+    finally:
+        cam.close()
+    return info
+
+
+def LiveInfoAll(macs, password="", workers=16):
+    """Yield (MAC, live info) as devices answer, at most workers connections at once"""
+    macs = iter(macs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while True:
+            while len(running) < workers:
+                mac = next(macs, None)
+                if mac is None:
+                    break
+                running[pool.submit(LiveInfo, devices[mac], password)] = mac
+            if len(running) == 0:
+                break
+            done, pending = wait(running, return_when=FIRST_COMPLETED)
+            for job in done:
+                yield running.pop(job), job.result()
+
+
+def Export(fmt, out, live=False, password="", workers=16):
+    """Write devices to out row by row, returns number of rows"""
+    fields = FIELDS + (LIVE_FIELDS if live else [])
+    exporter = exporters[fmt](out, fields)
+    exporter.begin()
+    if live:
+        rows = LiveInfoAll(list(devices), password, workers)
     else:
+        rows = ((mac, {}) for mac in list(devices))
+    n = 0
+    for mac, info in rows:
+        dev = dict(devices[mac], **info)
+        dev[u"HostIP"] = GetIP(dev[u"HostIP"])
+        exporter.row([dev.get(key, u"") for key, title in fields])
+        out.flush()
+        n += 1
+    exporter.end()
+    return n
+
+
+def FlashXM(cmd):
+    try:
+        with session(GetIP(devices[cmd[1]]["HostIP"]), password=cmd[2]) as cam:
+            cmd[4](_("Auth success"))
+            # devices flashed with the same file share one mapped image
+            cam.upgrade(dvrip_firmware.shared(cmd[3]), 0x4000, cmd[4])
+    except SomethingIsWrongWithCamera:
         cmd[4](_("Auth failed"))
 
 
 def ProcessCMD(cmd):
-    global log, logLevel, devices, searchers, configure, flashers
+    global log, logLevel, devices, searchers, configure, flashers, sweep, sweepRate
     if logLevel == 20:
         tolog(datetime.now().strftime("[%Y-%m-%d %H:%M:%S] >") + " ".join(cmd))
     if cmd[0].lower() == "q" or cmd[0].lower() == "quit":
@@ -686,103 +1159,52 @@ def ProcessCMD(cmd):
                 print(" ".join([str(x) for x in list(error.args)]))
             print(_("Searching %s, found %d devices") % (cmd[1], len(devices)))
         else:
-            for s in searchers:
-                tolog(_("Search") + " %s\r" % s)
-                try:
-                    devices = searchers[s](devices)
-                except Exception as error:
-                    print(" ".join([str(x) for x in list(error.args)]))
+            SearchAll(devices)
             tolog(_("Found %d devices") % len(devices))
         if len(devices) > 0:
             if logLevel > 0:
                 cmd[0] = "table"
                 print("")
-    if cmd[0].lower() == "table":
-        logs = (
-            _("Vendor")
-            + "\t"
-            + _("MAC Address")
-            + "\t\t"
-            + _("Name")
-            + "\t"
-            + _("IP Address")
-            + "\t"
-            + _("Port")
-            + "\n"
-        )
-        for dev in devices:
-            logs += "%s\t%s\t%s\t%s\t%s\n" % (
-                devices[dev]["Brand"],
-                devices[dev]["MAC"],
-                devices[dev]["HostName"],
-                GetIP(devices[dev]["HostIP"]),
-                devices[dev]["TCPPort"],
-            )
-        if logLevel >= 20:
-            tolog(logs)
-        if logLevel >= 10:
-            return logs
-    if cmd[0].lower() == "csv":
-        logs = (
-            _("Vendor")
-            + ";"
-            + _("MAC Address")
-            + ";"
-            + _("Name")
-            + ";"
-            + _("IP Address")
-            + ";"
-            + _("Port")
-            + ";"
-            + _("SN")
-            + "\n"
+    if cmd[0].lower() == "interfaces":
+        return "".join(
+            "%s\t%s\t%s\n" % (name, addr, mask) for name, addr, mask in GetInterfaces()
         )
-        for dev in devices:
-            logs += "%s;%s;%s;%s;%s;%s\n" % (
-                devices[dev]["Brand"],
-                devices[dev]["MAC"],
-                devices[dev]["HostName"],
-                GetIP(devices[dev]["HostIP"]),
-                devices[dev]["TCPPort"],
-                devices[dev]["SN"],
-            )
-        if logLevel >= 20:
-            tolog(logs)
-        if logLevel >= 10:
-            return logs
-    if cmd[0].lower() == "html":
-        logs = (
-            "<table border=1><th>"
-            + _("Vendor")
-            + "</th><th>"
-            + _("MAC Address")
-            + "</th><th>"
-            + _("Name")
-            + "</th><th>"
-            + _("IP Address")
-            + "</th><th>"
-            + _("Port")
-            + "</th><th>"
-            + _("SN")
-            + "</th>\r\n"
-        )
-        for dev in devices:
-            logs += (
-                "<tr><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td><td>%s</td></tr>\r\n"
-                % (
-                    devices[dev]["Brand"],
-                    devices[dev]["MAC"],
-                    devices[dev]["HostName"],
-                    GetIP(devices[dev]["HostIP"]),
-                    devices[dev]["TCPPort"],
-                    devices[dev]["SN"],
-                )
-            )
-        logs += "</table>\r\n"
+    if cmd[0].lower() == "sweep":
+        if len(cmd) > 1:
+            if cmd[1].lower() == "none":
+                sweep = []
+            else:
+                try:
+                    sweep = [str(ip_network(x, strict=False)) for x in cmd[1:] if x]
+                except ValueError as error:
+                    return str(error)
+        return "sweep [CIDR] ... (%s)" % (" ".join(sweep) or "none")
+    if cmd[0].lower() == "sweeprate":
+        if len(cmd) > 1:
+            sweepRate = int(cmd[1])
+        else:
+            return "sweeprate [pps]"
+    if cmd[0].lower() in ["table", "csv", "html", "jsonl"]:
+        out = StringIO()
+        Export(cmd[0].lower(), out)
+        logs = out.getvalue()
         if logLevel >= 20:
             tolog(logs)
         if logLevel >= 10:
             return logs
+    if cmd[0].lower() == "export":
+        if len(cmd) > 2 and cmd[1].lower() in exporters:
+            live = len(cmd) > 3 and cmd[3].lower() == "live"
+            password = cmd[4] if len(cmd) > 4 else ""
+            workers = int(cmd[5]) if len(cmd) > 5 else 16
+            if cmd[2] == "-":
+                Export(cmd[1].lower(), sys.stdout, live, password, workers)
+            else:
+                with open(cmd[2], "w", encoding="utf-8", newline="") as out:
+                    Export(cmd[1].lower(), out, live, password, workers)
+            return ""
+        else:
+            return "export [table|csv|jsonl|html] [file|-] [live] [password] [workers]"
     if cmd[0].lower() == "json":
         logs = json.dumps(devices)
         if logLevel >= 20:
@@ -803,6 +1225,14 @@ def ProcessCMD(cmd):
             return configure[devices[cmd[1]]["Brand"]](cmd)
         else:
             return "config [MAC] [IP] [MASK] [GATE] [Pasword]"
+    if cmd[0].lower() == "batch":
+        if len(cmd) > 1:
+            plan = LoadPlan(cmd[1])
+            results = ConfigBatch(plan, cmd[2] if len(cmd) > 2 else None)
+            ok = len([x for x in results.values() if x.get(u"Ret") in [100, 150]])
+            return _("Configured %d of %d devices") % (ok, len(plan))
+        else:
+            return "batch [plan.csv|plan.json] [report.csv|report.json]"
     if cmd[0].lower() == "flash":
         if (
             len(cmd) > 3
@@ -1070,17 +1500,17 @@ class GUITk:
         )
         if filename == "":
             return
-        ProcessCMD(["log", filename])
-        ProcessCMD(["loglevel", str(100)])
-        if ".json" in filename:
-            ProcessCMD(["json"])
+        if ".jsonl" in filename:
+            ProcessCMD(["export", "jsonl", filename])
+        elif ".json" in filename:
+            with open(filename, "w", encoding="utf-8") as out:
+                json.dump(devices, out)
         elif ".csv" in filename:
-            ProcessCMD(["csv"])
+            ProcessCMD(["export", "csv", filename])
         elif ".htm" in filename:
-            ProcessCMD(["html"])
+            ProcessCMD(["export", "html", filename])
         else:
-            ProcessCMD(["table"])
-        ProcessCMD(["loglevel", str(10)])
+            ProcessCMD(["export", "table", filename])
 
     def flash(self):
         self.fl_state.set("Processing...")
@@ -1116,6 +1546,17 @@ configure = {
     "xm": ConfigXM,
     "fros": ConfigFros,
 }  # ,"dahua":ConfigDahua
+batchConfigure = {
+    "wans": ConfigWansBatch,
+    "xm": ConfigXMBatch,
+    "fros": ConfigFrosBatch,
+}
+exporters = {
+    "table": TableExport,
+    "csv": CSVExport,
+    "jsonl": JSONLExport,
+    "html": HTMLExport,
+}
 flashers = {"xm": FlashXM}  # ,"dahua":FlashDahua,"fros":FlashFros
 logLevel = 30
 if __name__ == "__main__":
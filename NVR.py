@@ -1,5 +1,6 @@
 from time import sleep, monotonic
-from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip import SomethingIsWrongWithCamera
+from dvrip_pool import pool
 from pathlib import Path
 import logging
 
@@ -10,26 +11,27 @@ class NVR:
 
     def __init__(self, host_ip, user, password, logger):
         self.logger = logger
-        self.nvr = DVRIPCam(
-            host_ip,
-            user=user,
-            password=password,
-        )
-        if logger.level <= logging.DEBUG:
-            self.nvr.debug()
+        self.host_ip = host_ip
+        self.user = user
+        self.password = password
+        self.nvr = None
 
     def login(self):
         try:
             self.logger.info(f"Connecting to NVR...")
-            self.nvr.login()
+            self.nvr = pool.acquire(self.host_ip, user=self.user, password=self.password)
+            # a reused session has its debug handler already
+            if self.logger.level <= logging.DEBUG and not self.nvr.reused:
+                self.nvr.debug()
             self.logger.info("Successfuly connected to NVR.")
             return
         except SomethingIsWrongWithCamera:
             self.logger.error("Can't connect to NVR")
-            self.nvr.close()
 
     def logout(self):
-        self.nvr.close()
+        if self.nvr is not None:
+            pool.release(self.nvr)
+            self.nvr = None
 
     def get_channel_statuses(self):
         channel_statuses = self.nvr.get_channel_statuses()
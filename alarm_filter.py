@@ -0,0 +1,193 @@
+import threading
+from collections import deque
+from datetime import datetime
+from time import monotonic, time
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+IDLE = 0
+ACTIVE = 1
+STOPPING = 2
+
+
+class AlarmState(object):
+    __slots__ = ("status", "start", "stop", "count", "generation")
+
+    def __init__(self):
+        self.status = IDLE
+        self.start = None
+        self.stop = None
+        self.count = 0
+        self.generation = 0
+
+
+class AlarmFilter(object):
+    """Collapses raw AlarmInfo bursts into start/stop intervals.
+
+    Every (camera, channel, event) has a small state machine. The first Start
+    is passed on at once, repeated Starts are only counted, and a Stop is held
+    for the debounce window: a Start within the window continues the same
+    interval, otherwise one Stop with the interval length and the number of
+    raw messages is emitted. Output messages keep the AlarmInfo layout, so
+    they can be passed to any existing alarm callback.
+
+    Counts per `bucket` seconds are kept for the last `buckets` buckets.
+    Each message costs O(1) amortized work. `clock` times the debounce
+    windows, `wall` gives bucket starts and interval times.
+    """
+
+    def __init__(self, callback=None, debounce=2.0, bucket=60, buckets=60, clock=monotonic, wall=time):
+        self.callback = callback
+        self.debounce = debounce
+        self.bucket = bucket
+        self.clock = clock
+        self.wall = wall
+        self.states = {}
+        # pending stops per debounce window, each deque is ordered by deadline
+        self.stopping = {}
+        self.counts = {}  # bucket start -> {(camera, event): count}
+        self.bucket_order = deque()
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.received = 0
+        self.emitted = 0
+
+    def window(self, event):
+        if hasattr(self.debounce, "get"):
+            return self.debounce.get(event, self.debounce.get("default", 0))
+        return self.debounce
+
+    def emit(self, msg):
+        self.emitted += 1
+        if self.callback is not None:
+            self.callback(msg)
+
+    def timestamp(self):
+        return datetime.fromtimestamp(self.wall()).strftime(DATE_FORMAT)
+
+    def count(self, camera, event):
+        start = int(self.wall() // self.bucket * self.bucket)
+        if not self.bucket_order or self.bucket_order[-1] != start:
+            self.bucket_order.append(start)
+            self.counts[start] = {}
+            while len(self.bucket_order) > self.buckets:
+                del self.counts[self.bucket_order.popleft()]
+        counts = self.counts[self.bucket_order[-1]]
+        counts[(camera, event)] = counts.get((camera, event), 0) + 1
+
+    def arm(self, now, key, state, event):
+        state.status = STOPPING
+        state.generation += 1
+        window = self.window(event)
+        if window not in self.stopping:
+            self.stopping[window] = deque()
+        self.stopping[window].append((now + window, key, state.generation))
+
+    def feed(self, info, camera=""):
+        """Process one AlarmInfo dict ({"Channel", "Event", "Status", "StartTime"})"""
+        now = self.clock()
+        out = []
+        with self.lock:
+            self.received += 1
+            self.expire(now, out)
+            event = info.get("Event", "")
+            channel = info.get("Channel", 0)
+            self.count(camera, event)
+            key = (camera, channel, event)
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = AlarmState()
+            status = info.get("Status", "")
+            state.count += 1
+            if state.status == IDLE:
+                if status == "Stop":
+                    # stop of an interval we never saw started
+                    state.count = 0
+                else:
+                    state.status = ACTIVE
+                    state.count = 1
+                    state.start = info.get("StartTime") or self.timestamp()
+                    out.append(self.message(key, state, "Start"))
+            if state.status != IDLE:
+                if status == "Start":
+                    # continues the interval, a pending stop is cancelled
+                    state.status = ACTIVE
+                    state.generation += 1
+                else:
+                    # Stop, or one-shot event without Start/Stop pair
+                    state.stop = self.timestamp()
+                    self.arm(now, key, state, event)
+        for msg in out:
+            self.emit(msg)
+
+    def message(self, key, state, status):
+        camera, channel, event = key
+        msg = {
+            "Camera": camera,
+            "Channel": channel,
+            "Event": event,
+            "Status": status,
+            "StartTime": state.start,
+        }
+        if status == "Stop":
+            msg["StopTime"] = state.stop
+            msg["Count"] = state.count
+        return msg
+
+    def expire(self, now, out):
+        for stopping in self.stopping.values():
+            while stopping and stopping[0][0] <= now:
+                deadline, key, generation = stopping.popleft()
+                state = self.states[key]
+                if state.status == STOPPING and state.generation == generation:
+                    out.append(self.message(key, state, "Stop"))
+                    state.status = IDLE
+                    state.count = 0
+
+    def poll(self):
+        """Emit intervals whose debounce window is over, call it periodically"""
+        out = []
+        with self.lock:
+            self.expire(self.clock(), out)
+        for msg in out:
+            self.emit(msg)
+
+    def flush(self):
+        """Close every open interval now"""
+        out = []
+        with self.lock:
+            for key, state in self.states.items():
+                if state.status != IDLE:
+                    if state.stop is None or state.status == ACTIVE:
+                        state.stop = self.timestamp()
+                    out.append(self.message(key, state, "Stop"))
+                    state.status = IDLE
+                    state.count = 0
+            self.stopping.clear()
+        for msg in out:
+            self.emit(msg)
+
+    def active(self):
+        """Keys of intervals which are not closed yet"""
+        with self.lock:
+            return [k for k, s in self.states.items() if s.status != IDLE]
+
+    def histogram(self, camera=None, event=None):
+        """{bucket start time: count} for matching camera/event"""
+        result = {}
+        with self.lock:
+            for start in self.bucket_order:
+                for (c, e), n in self.counts[start].items():
+                    if (camera is None or c == camera) and (event is None or e == event):
+                        result[start] = result.get(start, 0) + n
+        return result
+
+    def dvrip_callback(self, camera=""):
+        """Function for DVRIPCam.setAlarm"""
+        return lambda info, sequence_number: self.feed(info, camera)
+
+    def alarm_server_callback(self, event):
+        """Subscriber for AlarmServer"""
+        reply = event["event"]
+        if hasattr(reply, "get") and hasattr(reply.get(reply.get("Name")), "get"):
+            self.feed(reply[reply["Name"]], event["ip"])
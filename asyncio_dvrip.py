@@ -1,16 +1,26 @@
-import os
-import struct
-import json
 import hashlib
 import asyncio
 from datetime import *
 from re import compile
 import time
 import logging
+import dvrip_json
+from dvrip_keepalive import async_scheduler
+from dvrip_metrics import SessionMetrics
+from dvrip_header import (
+    HEADER, MEDIA_HEADER, END_HEADER, BITMAP, Header, frame_start,
+)
+from dvrip_firmware import FirmwareImage
 
 class SomethingIsWrongWithCamera(Exception):
     pass
 
+class CameraTimeout(SomethingIsWrongWithCamera):
+    """The camera did not send the expected data before the deadline"""
+
+class ConnectionClosed(SomethingIsWrongWithCamera):
+    """The connection was closed or failed while receiving"""
+
 class DVRIPCam(object):
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
     CODES = {
@@ -88,12 +98,17 @@ class DVRIPCam(object):
         self.port = kwargs.get("port", self.PORTS.get(self.proto))
         self.socket_reader = None
         self.socket_writer = None
+        self.video_codec = None  # of the last I-frame
         self.packet_count = 0
         self.session = 0
         self.alive_time = 20
+        self.alive = None
+        self.last_reply = 0
         self.alarm_func = None
         self.timeout = 10
         self.busy = asyncio.Lock()
+        self.monitoring = False
+        self.metrics = kwargs.get("metrics") or SessionMetrics(ip, self.port)
 
     def debug(self, format=None):
         self.logger.setLevel(logging.DEBUG)
@@ -125,85 +140,106 @@ class DVRIPCam(object):
         except:
             pass
         self.socket_writer = None
+        self.alive = None
 
-    def tcp_socket_send(self, bytes):
+    def tcp_socket_send(self, *buffers):
+        """Send one packet, passed as one or more buffers. The transport
+        sends them with sendmsg() on Python 3.12 and later."""
         try:
-            return self.socket_writer.write(bytes)
-        except:
+            self.metrics.bytes_out += sum(len(b) for b in buffers)
+            if len(buffers) == 1:
+                return self.socket_writer.write(buffers[0])
+            return self.socket_writer.writelines(buffers)
+        except Exception as error:
+            self.metrics.error(error)
             return None
 
     async def tcp_socket_recv(self, bufsize):
         try:
-            return await self.socket_reader.read(bufsize)
-        except:
+            data = await self.socket_reader.read(bufsize)
+        except Exception as error:
+            self.metrics.error(error)
             return None
-
-    async def receive_with_timeout(self, length):
-        received = 0
-        buf = bytearray()
-        start_time = time.time()
-
-        while True:
-            try:
-                data = await asyncio.wait_for(self.socket_recv(length - received), timeout=self.timeout)
-                buf.extend(data)
-                received += len(data)
-                if length == received:
-                    break
-                elapsed_time = time.time() - start_time
-                if elapsed_time > self.timeout:
-                    return None
-            except asyncio.TimeoutError:
-                return None
-        return buf
+        self.metrics.bytes_in += len(data)
+        return data
+
+    async def receive_with_timeout(self, length, timeout=None):
+        """Exactly `length` bytes within `timeout` seconds (self.timeout by default)"""
+        if timeout is None:
+            timeout = self.timeout
+        return await self.receive_until(length, time.monotonic() + timeout)
+
+    async def receive_until(self, length, deadline):
+        """Exactly `length` bytes before the time.monotonic() `deadline`.
+        Raises CameraTimeout or ConnectionClosed."""
+        if self.socket_reader is None:
+            raise ConnectionClosed("Not connected")
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            data = await asyncio.wait_for(self.socket_reader.readexactly(length), remaining)
+        except asyncio.TimeoutError:
+            self.metrics.timeout()
+            raise CameraTimeout("%d bytes not received in time" % length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionClosed("Connection closed by camera")
+        except OSError as error:
+            self.metrics.error(error)
+            raise ConnectionClosed(str(error))
+        self.metrics.bytes_in += length
+        return data
 
     async def receive_json(self, length):
         data = await self.receive_with_timeout(length)
-        if data is None:
-            return {}
 
         self.packet_count += 1
         self.logger.debug("<= %s", data)
-        reply = json.loads(data[:-2])
-        return reply
+        try:
+            # without the trailing "\n\0" and without copying
+            reply = dvrip_json.loads(memoryview(data)[:-2])
+            return reply
+        except:
+            return data
 
     async def send(self, msg, data={}, wait_response=True):
         if self.socket_writer is None:
             return {"Ret": 101}
-        await self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            data = bytes(json.dumps(data, ensure_ascii=False), "utf-8")
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                0,
-                self.session,
-                self.packet_count,
-                msg,
-                len(data) + 2,
+        async with self.busy:
+            if hasattr(data, "__iter__"):
+                data = dvrip_json.dumps(data)
+            pkt = (
+                HEADER.pack(
+                    255,
+                    0,
+                    self.session,
+                    self.packet_count,
+                    msg,
+                    len(data) + 2,
+                ),
+                data,
+                b"\x0a\x00",
             )
-            + data
-            + b"\x0a\x00"
-        )
-        self.logger.debug("=> %s", pkt)
-        self.socket_send(pkt)
-        if wait_response:
-            reply = {"Ret": 101}
-            data = await self.socket_recv(20)
-            if data is None or len(data) < 20:
-                return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-            reply = await self.receive_json(len_data)
-            self.busy.release()
-            return reply
+            self.logger.debug("=> %s %s", pkt[0], data)
+            start = time.perf_counter()
+            self.socket_send(*pkt)
+            if wait_response:
+                try:
+                    data = await self.receive_with_timeout(20)
+                    (
+                        head,
+                        version,
+                        self.session,
+                        sequence_number,
+                        msgid,
+                        len_data,
+                    ) = HEADER.unpack(data)
+                    reply = await self.receive_json(len_data)
+                except (CameraTimeout, ConnectionClosed):
+                    return None
+                self.last_reply = time.monotonic()
+                self.metrics.request(msg, time.perf_counter() - start)
+                return reply
 
     def sofia_hash(self, password=""):
         md5 = hashlib.md5(bytes(password, "utf-8")).digest()
@@ -377,19 +413,18 @@ class DVRIPCam(object):
         )
 
     async def channel_bitmap(self, width, height, bitmap):
-        header = struct.pack("HH12x", width, height)
+        header = BITMAP.pack(width, height)
         self.socket_send(
-            struct.pack(
-                "BB2xII2xHI",
+            HEADER.pack(
                 255,
                 0,
                 self.session,
                 self.packet_count,
                 0x041A,
                 len(bitmap) + 16,
-            )
-            + header
-            + bitmap
+            ),
+            header,
+            bitmap,
         )
         reply, rcvd = await self.recv_json()
         if reply and reply["Ret"] != 100:
@@ -415,21 +450,14 @@ class DVRIPCam(object):
         while self.socket_writer:
             await self.busy.acquire()
             try:
-                (
-                    head,
-                    version,
-                    session,
-                    sequence_number,
-                    msgid,
-                    len_data,
-                ) = struct.unpack("BB2xII2xHI", await self.socket_recv(20))
+                header = Header.unpack(await self.socket_recv(20))
                 await asyncio.sleep(0.1)  # Just for receive whole packet
-                reply = await self.socket_recv(len_data)
+                reply = await self.socket_recv(header.length)
                 self.packet_count += 1
-                reply = json.loads(reply[:-2])
-                if msgid == self.QCODES["AlarmInfo"] and self.session == session:
+                reply = dvrip_json.loads(memoryview(reply)[:-2])
+                if header.msgid == self.QCODES["AlarmInfo"] and self.session == header.session:
                     if self.alarm_func is not None:
-                        self.alarm_func(reply[reply["Name"]], sequence_number)
+                        self.alarm_func(reply[reply["Name"]], header.sequence)
             except:
                 pass
             finally:
@@ -440,21 +468,22 @@ class DVRIPCam(object):
             "OPNetAlarm", {"Event": 0, "State": state},
         )
 
-    async def keep_alive_workner(self):
-        while self.socket_writer:
-
-            ret = await self.send(
-                self.QCODES["KeepAlive"],
-                {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session},
-            )
-            if ret is None:
-                self.close()
-                break
-
-            await asyncio.sleep(self.alive_time)
+    async def keep_alive_once(self):
+        """Send one keepalive, returns False when the session is lost"""
+        msg = {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session}
+        if self.monitoring:
+            # the reply arrives within the stream and is skipped there
+            await self.send(self.QCODES["KeepAlive"], msg, wait_response=False)
+            return True
+        ret = await self.send(self.QCODES["KeepAlive"], msg)
+        if ret is None:
+            self.metrics.keepalive_miss()
+            self.close()
+            return False
+        return True
 
     def keep_alive(self, loop):
-        loop.create_task(self.keep_alive_workner())
+        self.alive = async_scheduler(loop).add(self)
 
     async def keyDown(self, key):
         await self.set_command(
@@ -532,6 +561,9 @@ class DVRIPCam(object):
             code = self.QCODES[command]
 
         data = await self.send(code, {"Name": command, "SessionID": "0x%08X" % self.session})
+        if isinstance(data, (bytes, bytearray)):
+            data = dvrip_json.loads_lenient(data)
+
         if data["Ret"] in self.OK_CODES and command in data:
             return data[command]
         else:
@@ -599,12 +631,13 @@ class DVRIPCam(object):
         if m is None:
             return None, buf
         buf = buf[m.span(1)[1] :]
-        return json.loads(m.group(1)), buf
+        return dvrip_json.loads(m.group(1)), buf
 
     async def get_upgrade_info(self):
         return await self.get_command("OPSystemUpgrade")
 
     async def upgrade(self, filename="", packetsize=0x8000, vprint=None):
+        """`filename` is a path, bytes or a FirmwareImage"""
         if not vprint:
             vprint = lambda x: print(x)
 
@@ -615,32 +648,36 @@ class DVRIPCam(object):
             return data
 
         vprint("Ready to upgrade")
+        image = FirmwareImage.open(filename)
+        try:
+            return await self.install(image, packetsize, vprint)
+        finally:
+            if image is not filename:
+                # mapped here, the caller's images stay open
+                image.close()
+
+    async def install(self, image, packetsize, vprint):
+        """Upload the FirmwareImage `image` after the upgrade was started"""
         blocknum = 0
         sentbytes = 0
-        fsize = os.stat(filename).st_size
+        fsize = len(image)
         rcvd = bytearray()
-        with open(filename, "rb") as f:
-            while True:
-                bytes = f.read(packetsize)
-                if not bytes:
-                    break
-                header = struct.pack(
-                    "BB2xII2xHI", 255, 0, self.session, blocknum, 0x5F2, len(bytes)
-                )
-                self.socket_send(header + bytes)
-                blocknum += 1
-                sentbytes += len(bytes)
-
-                reply, rcvd = await self.recv_json(rcvd)
-                if reply and reply["Ret"] != 100:
-                    vprint("Upgrade failed")
-                    return reply
-
-                progress = sentbytes / fsize * 100
-                vprint(f"Uploaded {progress:.2f}%")
+        for block in image.blocks(packetsize):
+            header = HEADER.pack(255, 0, self.session, blocknum, 0x5F2, len(block))
+            self.socket_send(header, block)
+            blocknum += 1
+            sentbytes += len(block)
+
+            reply, rcvd = await self.recv_json(rcvd)
+            if reply and reply["Ret"] != 100:
+                vprint("Upgrade failed")
+                return reply
+
+            progress = sentbytes / fsize * 100
+            vprint(f"Uploaded {progress:.2f}%")
         vprint("End of file")
 
-        pkt = struct.pack("BB2xIIxBHI", 255, 0, self.session, blocknum, 1, 0x05F2, 0)
+        pkt = END_HEADER.pack(255, 0, self.session, blocknum, 1, 0x05F2, 0)
         self.socket_send(pkt)
         vprint("Waiting for upgrade...")
         while True:
@@ -666,40 +703,23 @@ class DVRIPCam(object):
                 return data
             vprint(f"Upgraded {data['Ret']}%")
 
-    async def reassemble_bin_payload(self, metadata={}):
-        def internal_to_type(data_type, value):
-            if data_type == 0x1FC or data_type == 0x1FD:
-                if value == 1:
-                    return "mpeg4"
-                elif value == 2:
-                    return "h264"
-                elif value == 3:
-                    return "h265"
-            elif data_type == 0x1F9:
-                if value == 1 or value == 6:
-                    return "info"
-            elif data_type == 0x1FA:
-                if value == 0xE:
-                    return "g711a"
-            elif data_type == 0x1FE and value == 0:
-                return "jpeg"
-            return None
-
-        def internal_to_datetime(value):
-            second = value & 0x3F
-            minute = (value & 0xFC0) >> 6
-            hour = (value & 0x1F000) >> 12
-            day = (value & 0x3E0000) >> 17
-            month = (value & 0x3C00000) >> 22
-            year = ((value & 0xFC000000) >> 26) + 2000
-            return datetime(year, month, day, hour, minute, second)
+    async def reassemble_bin_payload(self, metadata=None):
+        """Payload of the next media frame, its metadata is stored in the
+        dict `metadata`"""
+        frame = await self.read_frame()
+        if metadata is not None:
+            metadata.update(frame.meta())
+        return frame.data
 
+    async def read_frame(self):
+        """Next media Frame"""
         length = 0
         buf = bytearray()
-        start_time = time.time()
+        # one deadline for the whole frame
+        deadline = time.monotonic() + self.timeout
 
         while True:
-            data = await self.receive_with_timeout(20)
+            data = await self.receive_until(20, deadline)
             (
                 head,
                 version,
@@ -709,46 +729,27 @@ class DVRIPCam(object):
                 cur,
                 msgid,
                 len_data,
-            ) = struct.unpack("BB2xIIBBHI", data)
-            packet = await self.receive_with_timeout(len_data)
+            ) = MEDIA_HEADER.unpack(data)
+            packet = await self.receive_until(len_data, deadline)
             frame_len = 0
             if length == 0:
-                media = None
-                frame_len = 8
-                (data_type,) = struct.unpack(">I", packet[:4])
-                if data_type == 0x1FC or data_type == 0x1FE:
-                    frame_len = 16
-                    (media, metadata["fps"], w, h, dt, length,) = struct.unpack(
-                        "BBBBII", packet[4:frame_len]
-                    )
-                    metadata["width"] = w * 8
-                    metadata["height"] = h * 8
-                    metadata["datetime"] = internal_to_datetime(dt)
-                    if data_type == 0x1FC:
-                        metadata["frame"] = "I"
-                elif data_type == 0x1FD:
-                    (length,) = struct.unpack("I", packet[4:frame_len])
-                    metadata["frame"] = "P"
-                elif data_type == 0x1FA:
-                    (media, samp_rate, length) = struct.unpack(
-                        "BBH", packet[4:frame_len]
-                    )
-                elif data_type == 0x1F9:
-                    (media, n, length) = struct.unpack("BBH", packet[4:frame_len])
-                # special case of JPEG shapshots
-                elif data_type == 0xFFD8FFE0:
-                    return packet
-                else:
-                    raise ValueError(data_type)
-                if media is not None:
-                    metadata["type"] = internal_to_type(data_type, media)
-            buf.extend(packet[frame_len:])
+                if packet[:1] == b"{":
+                    # keepalive replies share the socket with the stream
+                    continue
+                first = time.perf_counter()
+                frame, frame_len, length = frame_start(packet, self.video_codec)
+                if length is None:
+                    # special case of JPEG shapshots
+                    frame.data = packet
+                    return frame
+                if frame.kind == "I":
+                    self.video_codec = frame.codec
+            buf.extend(memoryview(packet)[frame_len:])
             length -= len(packet) - frame_len
             if length == 0:
-                return buf
-            elapsed_time = time.time() - start_time
-            if elapsed_time > self.timeout:
-                return None
+                self.metrics.frame(len(buf), time.perf_counter() - first)
+                frame.data = buf
+                return frame
 
     async def snapshot(self, channel=0):
         command = "OPSNAP"
@@ -764,7 +765,12 @@ class DVRIPCam(object):
         packet = await self.reassemble_bin_payload()
         return packet
 
-    async def start_monitor(self, frame_callback, user={}, stream="Main"):
+    async def start_monitor(self, frame_callback, user=None, stream="Main", frames=False, pts=None):
+        """frame_callback(frame, meta, user) for every frame, or
+        frame_callback(frame) with a Frame when `frames` is set. `pts` is a
+        dvrip_pts.PTSClock that stamps every frame."""
+        if user is None:
+            user = {}
         params = {
             "Channel": 0,
             "CombinMode": "NONE",
@@ -786,9 +792,13 @@ class DVRIPCam(object):
         )
         self.monitoring = True
         while self.monitoring:
-            meta = {}
-            frame = await self.reassemble_bin_payload(meta)
-            frame_callback(frame, meta, user)
+            frame = await self.read_frame()
+            if pts is not None:
+                pts.stamp(frame)
+            if frames:
+                frame_callback(frame)
+            else:
+                frame_callback(frame.data, frame.meta(), user)
 
     def stop_monitor(self):
         self.monitoring = False
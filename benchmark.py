@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""Benchmarks of the protocol hot paths against simulated devices on loopback.
+
+    python3 benchmark.py -o baseline.json
+    python3 benchmark.py -o current.json --compare baseline.json
+
+Every benchmark runs --repeat times and the median of each metric is kept.
+"""
+
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import datetime
+import struct
+from socket import socket, socketpair, AF_INET, SOCK_DGRAM
+from statistics import median
+from time import monotonic, perf_counter, sleep
+
+import dvrip_json
+from dvrip import DVRIPCam, SENDMSG_MIN
+from dvrip_header import HEADER, MEDIA_HEADER, DATA_TYPE, IFRAME, PFRAME, AUDIO, frame_start, iter_frames
+from dvrip_firmware import FirmwareImage
+from dvrip_simulator import DVRIPSimulator, MediaGenerator
+
+
+class SimulatorLoop(object):
+    """Event loop thread hosting the simulated devices"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def device(self, **kwargs):
+        return self.run(DVRIPSimulator("127.0.0.1", 0, **kwargs).start())
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def connect(device):
+    cam = DVRIPCam("127.0.0.1", port=device.port)
+    cam.connect()
+    if not cam.login():
+        raise RuntimeError("Cannot login to the simulator")
+    return cam
+
+
+def bench_roundtrip(sim, scale):
+    device = sim.device()
+    cam = connect(device)
+    n = 2000 * scale
+    start = perf_counter()
+    for i in range(n):
+        cam.send(1006, {"Name": "KeepAlive", "SessionID": "0x%08X" % cam.session})
+    elapsed = perf_counter() - start
+    start = perf_counter()
+    for i in range(n // 4):
+        cam.get_command("SystemInfo")
+    parsed = perf_counter() - start
+    cam.close()
+    sim.run(device.stop())
+    return {
+        "roundtrips_per_sec": n / elapsed,
+        "roundtrip_us": elapsed / n * 1e6,
+        "get_command_per_sec": n // 4 / parsed,
+    }
+
+
+def monitor(device, n, frames):
+    """Seconds and bytes of `n` frames"""
+    cam = connect(device)
+    count = [0, 0]
+
+    def frame(data, meta=None, user=None):
+        count[0] += 1
+        count[1] += len(data.data if frames else data)
+        if count[0] >= n:
+            cam.stop_monitor()
+
+    start = perf_counter()
+    cam.start_monitor(frame, frames=frames)
+    elapsed = perf_counter() - start
+    cam.close()
+    return elapsed, count[1]
+
+
+def bench_reassemble(sim, scale):
+    device = sim.device(speed=0, bitrate=8192, packet_size=8192)
+    n = 3000 * scale
+    elapsed, size = monitor(device, n, False)
+    frames_elapsed, size = monitor(device, n, True)
+    sim.run(device.stop())
+
+    # metadata of the frame headers alone: Frame vs Frame + meta dict
+    heads = [frame[:16] for t, frame in itertools.islice(MediaGenerator().frames(), 1000)] * 100 * scale
+    start = perf_counter()
+    for head in heads:
+        frame_start(head)[0].meta()
+    meta_elapsed = perf_counter() - start
+    start = perf_counter()
+    for head in heads:
+        frame_start(head)
+    return {
+        "frames_per_sec": n / elapsed,
+        "mb_per_sec": size / elapsed / 1e6,
+        "frame_objects_per_sec": n / frames_elapsed,
+        "header_speedup": meta_elapsed / (perf_counter() - start),
+    }
+
+
+def download(device, path):
+    cam = connect(device)
+    files = cam.list_local_files("2000-01-01 00:00:00", "2100-01-01 00:00:00", "h264")
+    start = perf_counter()
+    cam.download_file(files[0]["BeginTime"], files[0]["EndTime"], files[0]["FileName"], path)
+    elapsed = perf_counter() - start
+    cam.close()
+    return elapsed
+
+
+def bench_get_file(sim, scale):
+    device = sim.device(file_count=1, file_size=16384 * scale)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "file.h264")
+        elapsed = download(device, path)
+        size = os.path.getsize(path)
+        # separate run, tracing slows everything down
+        tracemalloc.start()
+        download(device, path)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    sim.run(device.stop())
+    return {
+        "mb_per_sec": size / elapsed / 1e6,
+        "peak_memory_mb": peak / 1e6,
+        "peak_per_file_size": peak / size,
+    }
+
+
+def bench_list_files(sim, scale):
+    device = sim.device(file_count=500 * scale)
+    cam = connect(device)
+    start = perf_counter()
+    files = cam.list_local_files("2000-01-01 00:00:00", "2100-01-01 00:00:00", "h264")
+    elapsed = perf_counter() - start
+    cam.close()
+    sim.run(device.stop())
+    pages = (len(files) + 63) // 64
+    return {
+        "files": len(files),
+        "total_ms": elapsed * 1e3,
+        "page_ms": elapsed / pages * 1e3,
+    }
+
+
+def bench_upgrade(sim, scale):
+    device = sim.device()
+    cam = connect(device)
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(16 * 1024 * 1024 * scale))
+        f.flush()
+        start = perf_counter()
+        cam.upgrade(f.name, vprint=lambda *args, **kwargs: None)
+        elapsed = perf_counter() - start
+        size = os.path.getsize(f.name)
+    cam.close()
+    sim.run(device.stop())
+    return {"mb_per_sec": size / elapsed / 1e6}
+
+
+def media_packets(count, packet_size=1400):
+    """(header, payload) pairs of `count` frames of a 2 Mbit/s stream"""
+    packets = []
+    generator = MediaGenerator(bitrate=2048)
+    for t, frame in itertools.islice(generator.frames(), count):
+        for i in range(0, len(frame), packet_size):
+            part = frame[i : i + packet_size]
+            packets.append((MEDIA_HEADER.pack(255, 0, 1, 0, 0, 0, 1412, len(part)), part))
+    return packets
+
+
+def parse_format_strings(packets):
+    """Frame parsing as reassemble_bin_payload did it before dvrip_header"""
+    frames = 0
+    length = 0
+    buf = bytearray()
+    for data, packet in packets:
+        head, version, session, sequence, total, cur, msgid, len_data = struct.unpack(
+            "BB2xIIBBHI", data
+        )
+        frame_len = 0
+        if length == 0:
+            frame_len = 8
+            (data_type,) = struct.unpack(">I", packet[:4])
+            if data_type == 0x1FC:
+                frame_len = 16
+                media, fps, w, h, dt, length = struct.unpack("BBBBII", packet[4:frame_len])
+            elif data_type == 0x1FD:
+                (length,) = struct.unpack("I", packet[4:frame_len])
+            else:
+                media, rate, length = struct.unpack("BBH", packet[4:frame_len])
+        buf.extend(packet[frame_len:])
+        length -= len(packet) - frame_len
+        if length == 0:
+            frames += 1
+            buf = bytearray()
+    return frames
+
+
+def parse_precompiled(packets):
+    """Frame parsing of reassemble_bin_payload with dvrip_header"""
+    frames = 0
+    length = 0
+    buf = bytearray()
+    for data, packet in packets:
+        head, version, session, sequence, total, cur, msgid, len_data = MEDIA_HEADER.unpack(data)
+        frame_len = 0
+        if length == 0:
+            frame_len = 8
+            (data_type,) = DATA_TYPE.unpack_from(packet)
+            if data_type == 0x1FC:
+                frame_len = 16
+                media, fps, w, h, dt, length = IFRAME.unpack_from(packet, 4)
+            elif data_type == 0x1FD:
+                (length,) = PFRAME.unpack_from(packet, 4)
+            else:
+                media, rate, length = AUDIO.unpack_from(packet, 4)
+        if frame_len:
+            buf.extend(memoryview(packet)[frame_len:])
+        else:
+            buf.extend(packet)
+        length -= len(packet) - frame_len
+        if length == 0:
+            frames += 1
+            buf = bytearray()
+    return frames
+
+
+def bench_header(sim, scale):
+    packets = media_packets(2000 * scale)
+    results = {"packets": len(packets)}
+    for name, parse in (("format_string", parse_format_strings), ("precompiled", parse_precompiled)):
+        start = perf_counter()
+        parse(packets)
+        results[name + "_packets_per_sec"] = len(packets) / (perf_counter() - start)
+    results["parse_speedup"] = results["precompiled_packets_per_sec"] / results["format_string_packets_per_sec"]
+
+    n = 200000 * scale
+    payload = b'{"Name": "KeepAlive", "SessionID": "0x00000001"}'
+    start = perf_counter()
+    for i in range(n):
+        struct.pack("BB2xII2xHI", 255, 0, 1, i, 1006, len(payload) + 2) + payload + b"\x0a\x00"
+    before = perf_counter() - start
+    start = perf_counter()
+    for i in range(n):
+        HEADER.pack(255, 0, 1, i, 1006, len(payload) + 2) + payload + b"\x0a\x00"
+    results["pack_speedup"] = before / (perf_counter() - start)
+
+    # 64 MB of upgrade blocks, read and concatenated vs header and a slice
+    # of the image, as upgrade() sends them
+    image = io.BytesIO(bytes(64 * 1024 * 1024 * scale))
+    start = perf_counter()
+    while True:
+        block = image.read(0x8000)
+        if not block:
+            break
+        struct.pack("BB2xII2xHI", 255, 0, 1, 0, 0x5F2, len(block)) + block
+    before = perf_counter() - start
+    firmware = FirmwareImage(image.getbuffer())
+    start = perf_counter()
+    for block in firmware.blocks(0x8000):
+        struct.pack("BB2xII2xHI", 255, 0, 1, 0, 0x5F2, len(block)), block
+    results["upgrade_block_speedup"] = before / (perf_counter() - start)
+    return results
+
+
+def drain(sock):
+    buf = bytearray(0x40000)
+    while sock.recv_into(buf):
+        pass
+
+
+def bench_sendmsg(sim, scale):
+    """DVRIPCam.tcp_socket_send() of joined packets vs the buffers send()
+    builds, sent with sendmsg() when large"""
+    results = {}
+    cam = DVRIPCam("127.0.0.1")
+    for name, size, count in (("upgrade_block", 0x8000, 4096 * scale), ("command", 64, 100000 * scale)):
+        payload = bytes(size)
+        for method in ("concat", "sendmsg"):
+            a, b = socketpair()
+            reader = threading.Thread(target=drain, args=(b,))
+            reader.start()
+            start = perf_counter()
+            cam.socket = a
+            if method == "concat":
+                for i in range(count):
+                    cam.tcp_socket_send(HEADER.pack(255, 0, 1, i, 0x5F2, size) + payload + b"\x0a\x00")
+            else:
+                # built as DVRIPCam.send() does
+                for i in range(count):
+                    header = HEADER.pack(255, 0, 1, i, 0x5F2, size)
+                    if size < SENDMSG_MIN:
+                        cam.tcp_socket_send(header + payload + b"\x0a\x00")
+                    else:
+                        cam.tcp_socket_send(header, payload, b"\x0a\x00")
+            elapsed = perf_counter() - start
+            a.close()
+            reader.join()
+            b.close()
+            results[f"{name}_{method}_mb_per_sec"] = count * size / elapsed / 1e6
+        results[name + "_speedup"] = results[name + "_sendmsg_mb_per_sec"] / results[name + "_concat_mb_per_sec"]
+    return results
+
+
+def bench_activity(sim, scale):
+    """ActivityDetector on 500 streams of 25 fps"""
+    import dvrip_activity
+
+    if dvrip_activity.np is None:
+        return {}
+    generator = MediaGenerator(audio=False)
+    frames = [
+        (len(frame), "I" if DATA_TYPE.unpack_from(frame)[0] == 0x1FC else "P")
+        for t, frame in itertools.islice(generator.frames(), 1000)
+    ]
+    now = [0.0]
+    detector = dvrip_activity.ActivityDetector(clock=lambda: now[0])
+    n = 0
+    start = perf_counter()
+    for i in range(200 * scale):
+        now[0] = i / 25
+        for stream in range(500):
+            size, frame = frames[(i + stream) % len(frames)]
+            detector.feed(stream, frame, size)
+            n += 1
+    elapsed = perf_counter() - start
+    start = perf_counter()
+    detector.poll()
+    return {"frames_per_sec": n / elapsed, "poll_ms": (perf_counter() - start) * 1000}
+
+
+def bench_nal(sim, scale):
+    """Access unit scan of an Annex B recording and inline inspection of
+    live frames"""
+    from dvrip_nal import StreamInspector, access_units
+
+    frames = [frame for offset, frame in iter_frames(MediaGenerator(audio=False).file(20000000))]
+    raw = b"".join(frame.data for frame in frames) * scale
+    start = perf_counter()
+    pictures = sum(1 for unit in access_units(raw, "h264"))
+    scan = perf_counter() - start
+    inspector = StreamInspector()
+    start = perf_counter()
+    for frame in frames * scale:
+        inspector.feed(frame)
+    inspect = perf_counter() - start
+    return {
+        "scan_mb_per_sec": len(raw) / scan / 1e6,
+        "pictures_per_sec": pictures / scan,
+        "inspect_frames_per_sec": len(frames) * scale / inspect,
+    }
+
+
+def bench_sofia_hash(sim, scale):
+    cam = DVRIPCam("127.0.0.1")
+    n = 100000 * scale
+    start = perf_counter()
+    for i in range(n):
+        cam.sofia_hash("password%d" % (i & 0xFF))
+    elapsed = perf_counter() - start
+    return {"hashes_per_sec": n / elapsed}
+
+
+def bench_discovery(sim, scale):
+    import DeviceManager
+
+    count = 200 * scale
+    replies = [DVRIPSimulator("127.0.0.1", 41000 + i).search_reply() for i in range(count)]
+    devices = {}
+    found = []
+    sweep = DeviceManager.sweep
+    DeviceManager.sweep = []
+
+    def answer():
+        # the search socket owns port 34569, so the simulated devices
+        # cannot listen for the probe and answer right away instead
+        sleep(0.1)
+        s = socket(AF_INET, SOCK_DGRAM)
+        for reply in replies:
+            s.sendto(reply, ("127.0.0.1", 34569))
+        s.close()
+        while len(devices) < count and monotonic() - start < 5:
+            sleep(0.001)
+        found.append(monotonic() - start)
+
+    start = monotonic()
+    thread = threading.Thread(target=answer)
+    thread.start()
+    try:
+        DeviceManager.SearchXM(devices)
+    finally:
+        DeviceManager.sweep = sweep
+    elapsed = monotonic() - start
+    thread.join()
+    return {
+        "devices": len(devices),
+        "all_found_s": found[0] - 0.1,
+        "search_s": elapsed,
+    }
+
+
+benchmarks = {
+    "roundtrip": bench_roundtrip,
+    "reassemble_bin_payload": bench_reassemble,
+    "get_file": bench_get_file,
+    "list_local_files": bench_list_files,
+    "upgrade": bench_upgrade,
+    "sofia_hash": bench_sofia_hash,
+    "header": bench_header,
+    "sendmsg": bench_sendmsg,
+    "activity": bench_activity,
+    "nal": bench_nal,
+    "discovery": bench_discovery,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, repeat=3, scale=1):
+    sim = SimulatorLoop()
+    results = {}
+    for name in names:
+        runs = [benchmarks[name](sim, scale) for i in range(repeat)]
+        results[name] = {key: median(r[key] for r in runs) for key in runs[0]}
+        print(name, json.dumps(results[name]), file=sys.stderr)
+    sim.stop()
+    return {
+        "time": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "system": platform.platform(),
+        "json_backend": dvrip_json.backend,
+        "repeat": repeat,
+        "scale": scale,
+        "results": results,
+    }
+
+
+def compare(old, new):
+    for name, metrics in new["results"].items():
+        for key, value in metrics.items():
+            before = old["results"].get(name, {}).get(key)
+            if before:
+                print(f"{name:24} {key:22} {before:14.2f} {value:14.2f} {(value / before - 1) * 100:+7.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", help="Benchmarks to run: " + ", ".join(benchmarks))
+    parser.add_argument("-o", "--output", help="Write results to this JSON file")
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-s", "--scale", type=int, default=1, help="Multiply the work of every benchmark")
+    parser.add_argument("-c", "--compare", help="Print changes against an older results file")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error("unknown benchmark " + name)
+    report = run(args.names or list(benchmarks), args.repeat, args.scale)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -1,21 +1,222 @@
-import os
 import struct
-import json
 from time import sleep
 import hashlib
+import random
 import threading
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET
+from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET, SO_RCVBUF
+from socket import IPPROTO_TCP, SO_KEEPALIVE, SHUT_RDWR
+from socket import timeout as SocketTimeout
+from select import select
 from datetime import *
 from re import compile
 import time
 import logging
 from pathlib import Path
+import dvrip_json
+from dvrip_keepalive import scheduler
+from dvrip_metrics import SessionMetrics
+from dvrip_header import (
+    HEADER, MEDIA_HEADER, END_HEADER, LENGTH, SEQUENCE, DATA_TYPE, BITMAP, FRAME_TYPES, JPEG_TYPES, Header,
+    frame_start,
+)
+from dvrip_firmware import FirmwareImage
+
+try:
+    from select import poll, POLLIN, POLLPRI, POLLERR, POLLHUP
+except ImportError:
+    poll = None
+
+try:
+    from socket import TCP_KEEPIDLE, TCP_KEEPINTVL, TCP_KEEPCNT
+
+    # a dead peer is noticed after about 11 seconds of silence
+    KEEPALIVE_OPTIONS = ((TCP_KEEPIDLE, 5), (TCP_KEEPINTVL, 2), (TCP_KEEPCNT, 3))
+except ImportError:
+    KEEPALIVE_OPTIONS = ()
+
+
+# below this packet size joining the buffers is cheaper than sendmsg()
+SENDMSG_MIN = 0x4000
+# data types of the first packet of a frame or snapshot
+START_TYPES = FRAME_TYPES + JPEG_TYPES
+
+
+def send_buffers(sock, buffers, size=None):
+    """socket.sendall() of `buffers` back to back, `size` is their total
+    length when the caller has it already. Small packets are joined, large
+    ones go out with sendmsg(), so the payload is not copied into a joined
+    bytes object first. A datagram socket sends them as one datagram."""
+    if size is None:
+        size = sum(map(len, buffers))
+    if size < SENDMSG_MIN or not hasattr(sock, "sendmsg"):
+        # sendmsg() is missing on Windows
+        return sock.sendall(b"".join(buffers))
+    sent = sock.sendmsg(buffers)
+    if sent == size:
+        return
+    buffers = [memoryview(b) for b in buffers]
+    while True:
+        while buffers and len(buffers[0]) <= sent:
+            sent -= len(buffers.pop(0))
+        if not buffers:
+            return
+        buffers[0] = buffers[0][sent:]
+        sent = sock.sendmsg(buffers)
 
 
 class SomethingIsWrongWithCamera(Exception):
     pass
 
 
+class CameraTimeout(SomethingIsWrongWithCamera):
+    """The camera did not send the expected data before the deadline"""
+
+
+class ConnectionClosed(SomethingIsWrongWithCamera):
+    """The connection was closed or failed while receiving"""
+
+
+class UDPTransport(object):
+    """DVRIP over UDP, one packet per datagram.
+
+    Datagrams are handed out in sequence number order as a byte stream, so
+    the code written for TCP reads them unchanged. Datagrams that arrive
+    early wait up to `reorder_time` seconds or `window` datagrams for the
+    missing ones, then the gap is skipped, counted in `lost` and `gaps` is
+    incremented. Requests are sent again every `retransmit` seconds while
+    their reply is missing; the camera has no way to resend media."""
+
+    def __init__(self, cam, window=64, reorder_time=0.05, retransmit=0.5):
+        self.cam = cam
+        self.window = window
+        self.reorder_time = reorder_time
+        self.retransmit = retransmit
+        self.expected = None
+        self.pending = {}  # sequence -> datagram that arrived early
+        self.gap_since = None
+        self.buffer = memoryview(b"")
+        self.lost = 0
+        self.gaps = 0
+        self.retransmits = 0
+        self.stale = False
+
+    def receive(self, timeout):
+        """The next datagram from the socket, None after `timeout` seconds"""
+        sock = self.cam.socket
+        if sock is None:
+            raise ConnectionClosed("Not connected")
+        if not self.cam.wait_readable(max(timeout, 0)):
+            return None
+        try:
+            data = sock.recv(0x10000)
+        except (BlockingIOError, InterruptedError, SocketTimeout):
+            return None
+        except OSError as error:
+            self.cam.metrics.error(error)
+            raise ConnectionClosed(str(error))
+        self.cam.metrics.bytes_in += len(data)
+        return data
+
+    def next_datagram(self, deadline):
+        """The next datagram in sequence order"""
+        while True:
+            if self.expected in self.pending:
+                self.gap_since = None
+                data = self.pending.pop(self.expected)
+                self.expected += 1
+                return data
+            now = time.monotonic()
+            wait = deadline - now
+            if self.pending:
+                if self.gap_since is None:
+                    self.gap_since = now
+                if now - self.gap_since >= self.reorder_time or len(self.pending) >= self.window:
+                    # lost, skip to the first datagram waiting
+                    first = min(self.pending)
+                    self.lost += first - self.expected
+                    self.cam.metrics.datagrams_lost += first - self.expected
+                    self.gaps += 1
+                    self.expected = first
+                    continue
+                wait = min(wait, self.gap_since + self.reorder_time - now)
+            data = self.receive(wait)
+            if data is None:
+                if time.monotonic() >= deadline:
+                    raise CameraTimeout("No datagram received in time")
+                continue
+            if len(data) < 20 or data[0] != 255:
+                continue
+            (sequence,) = SEQUENCE.unpack_from(data, 8)
+            if self.expected is None or sequence == self.expected:
+                self.gap_since = None
+                self.expected = sequence + 1
+                return data
+            if self.expected < sequence < self.expected + self.window:
+                self.pending[sequence] = data
+            elif self.expected - self.window <= sequence < self.expected:
+                # duplicate or too late, its place in the stream is gone
+                continue
+            else:
+                # the camera counts from somewhere else now
+                self.pending.clear()
+                self.gap_since = None
+                self.expected = sequence + 1
+                return data
+
+    def read(self, length, deadline):
+        """Exactly `length` bytes of the stream"""
+        buf = bytearray()
+        while len(buf) < length:
+            if not self.buffer:
+                self.buffer = memoryview(self.next_datagram(deadline))
+            n = min(length - len(buf), len(self.buffer))
+            buf += self.buffer[:n]
+            self.buffer = self.buffer[n:]
+        return buf
+
+    def read_some(self, size, deadline):
+        """Up to `size` bytes of the stream, like recv()"""
+        if not self.buffer:
+            self.buffer = memoryview(self.next_datagram(deadline))
+        data = self.buffer[:size].tobytes()
+        self.buffer = self.buffer[len(data):]
+        return data
+
+    def request(self, pkt, deadline):
+        """Reply header to the request that was just sent, `pkt` is the
+        list of its buffers"""
+        while True:
+            try:
+                return self.read(20, min(deadline, time.monotonic() + self.retransmit))
+            except CameraTimeout:
+                if time.monotonic() >= deadline:
+                    raise
+            self.retransmits += 1
+            self.cam.metrics.retransmits += 1
+            # both the request and its copy may get a reply
+            self.stale = True
+            size = sum(map(len, pkt))
+            send_buffers(self.cam.socket, pkt, size)
+            self.cam.metrics.bytes_out += size
+
+    def flush(self):
+        """Drop everything received so far, before a new request when a
+        late reply to a retransmitted one may still arrive"""
+        self.stale = False
+        self.buffer = memoryview(b"")
+        while True:
+            data = self.receive(0)
+            if data is None:
+                break
+            if len(data) >= 20:
+                (sequence,) = SEQUENCE.unpack_from(data, 8)
+                self.pending[sequence] = data
+        if self.pending:
+            self.expected = max(self.pending) + 1
+            self.pending.clear()
+        self.gap_since = None
+
+
 class DVRIPCam(object):
     DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
     CODES = {
@@ -113,13 +314,30 @@ class DVRIPCam(object):
         self.proto = kwargs.get("proto", "tcp")
         self.port = kwargs.get("port", self.PORTS.get(self.proto))
         self.socket = None
+        self.udp = None
+        self.video_codec = None  # of the last I-frame
         self.packet_count = 0
         self.session = 0
         self.alive_time = 20
         self.alive = None
+        # time.monotonic() of the last reply, it refreshes the session too
+        self.last_reply = 0
         self.alarm = None
         self.alarm_func = None
         self.busy = threading.Condition()
+        self.metrics = kwargs.get("metrics") or SessionMetrics(ip, self.port)
+        self.timeout = 10
+        self.reconnect_enabled = kwargs.get("reconnect", False)
+        self.backoff = kwargs.get("backoff", 0.2)
+        self.max_backoff = kwargs.get("max_backoff", 30)
+        self.reconnect_attempts = kwargs.get("reconnect_attempts", 0)
+        self.reconnect_lock = threading.Lock()
+        self.generation = 0
+        self.monitoring = False
+        # held by start_monitor() while it reads the stream
+        self.reading = threading.Lock()
+        self.monitor_params = None
+        self.alarm_active = False
 
     def debug(self, format=None):
         self.logger.setLevel(logging.DEBUG)
@@ -138,72 +356,199 @@ class DVRIPCam(object):
                 if self.iface:
                     self.socket.setsockopt(
                         SOL_SOCKET, 25, str(self.iface + '\0').encode())
+                self.socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+                for option, value in KEEPALIVE_OPTIONS:
+                    self.socket.setsockopt(IPPROTO_TCP, option, value)
                 self.socket.connect((self.ip, self.port))
             elif self.proto == "udp":
                 self.socket_send = self.udp_socket_send
                 self.socket_recv = self.udp_socket_recv
                 self.socket = socket(AF_INET, SOCK_DGRAM)
+                # room for the burst of datagrams of a key frame, the
+                # default buffer overflows while the reader is busy
+                self.socket.setsockopt(SOL_SOCKET, SO_RCVBUF, 0x100000)
+                # datagrams from other hosts are dropped by the kernel
+                self.socket.connect((self.ip, self.port))
+                self.udp = UDPTransport(self)
             else:
                 raise f"Unsupported protocol {self.proto}"
 
             # it's important to extend timeout for upgrade procedure
             self.timeout = timeout
             self.socket.settimeout(timeout)
+            self.poller = None
+            if poll is not None:
+                self.poller = poll()
+                self.poller.register(self.socket, POLLIN | POLLPRI | POLLERR | POLLHUP)
         except OSError:
             raise SomethingIsWrongWithCamera("Cannot connect to camera")
 
     def close(self):
+        self.monitoring = False
+        self.alarm_active = False
+        self.disconnect()
+
+    def disconnect(self):
+        # drops the session from the keepalive scheduler
+        self.alive = None
+        try:
+            # wakes up a thread blocked in recv on this socket
+            self.socket.shutdown(SHUT_RDWR)
+        except:
+            pass
         try:
-            self.alive.cancel()
             self.socket.close()
         except:
             pass
         self.socket = None
+        self.udp = None
+
+    def reconnect(self, generation=None):
+        """Connect and login again after the session was lost, then restore
+        the stream claim and alarm subscription. Retries with exponential
+        backoff and full jitter, the first attempt is immediate.
+        Returns False when reconnect_attempts are exhausted."""
+        with self.reconnect_lock:
+            if generation is not None and generation != self.generation:
+                # another thread has already reconnected
+                return True
+            self.disconnect()
+            attempt = 0
+            delay = self.backoff
+            while True:
+                try:
+                    self.connect(self.timeout)
+                    if self.login():
+                        break
+                except SomethingIsWrongWithCamera:
+                    pass
+                self.disconnect()
+                attempt += 1
+                if self.reconnect_attempts and attempt >= self.reconnect_attempts:
+                    return False
+                sleep(random.uniform(0, delay))
+                delay = min(delay * 2, self.max_backoff)
+            self.generation += 1
+            self.metrics.reconnect()
+            self.logger.debug("Reconnected to %s after %d failed attempts", self.ip, attempt)
+            if self.monitoring and self.monitor_params is not None:
+                self.claim_monitor(self.monitor_params)
+        if self.alarm_active:
+            self.alarmStart()
+        return True
 
-    def udp_socket_send(self, bytes):
-        return self.socket.sendto(bytes, (self.ip, self.port))
+    def udp_socket_send(self, *buffers):
+        try:
+            if self.udp.stale:
+                self.udp.flush()
+            size = sum(map(len, buffers))
+            self.metrics.bytes_out += size
+            return send_buffers(self.socket, buffers, size)
+        except Exception as error:
+            self.metrics.error(error)
+            return None
 
-    def udp_socket_recv(self, bytes):
-        data, _ = self.socket.recvfrom(bytes)
-        return data
+    def udp_socket_recv(self, bufsize):
+        try:
+            return self.udp.read_some(bufsize, time.monotonic() + self.timeout)
+        except CameraTimeout:
+            self.metrics.timeout()
+        except Exception as error:
+            self.metrics.error(error)
+        return None
 
-    def tcp_socket_send(self, bytes):
+    def tcp_socket_send(self, *buffers):
+        """Send one packet, passed as one or more buffers"""
         try:
-            return self.socket.sendall(bytes)
-        except:
+            if len(buffers) == 1:
+                self.metrics.bytes_out += len(buffers[0])
+                return self.socket.sendall(buffers[0])
+            size = sum(map(len, buffers))
+            self.metrics.bytes_out += size
+            return send_buffers(self.socket, buffers, size)
+        except Exception as error:
+            self.metrics.error(error)
             return None
 
     def tcp_socket_recv(self, bufsize):
         try:
-            return self.socket.recv(bufsize)
-        except:
+            data = self.socket.recv(bufsize)
+        except SocketTimeout:
+            self.metrics.timeout()
             return None
+        except Exception as error:
+            self.metrics.error(error)
+            return None
+        self.metrics.bytes_in += len(data)
+        return data
 
-    def receive_with_timeout(self, length):
+    def wait_readable(self, timeout):
+        if self.poller is not None:
+            return bool(self.poller.poll(timeout * 1000))
+        return bool(select([self.socket], [], [], timeout)[0])
+
+    def receive_with_timeout(self, length, timeout=None):
+        """Exactly `length` bytes within `timeout` seconds (self.timeout by default)"""
+        if timeout is None:
+            timeout = self.timeout
+        return self.receive_until(length, time.monotonic() + timeout)
+
+    def receive_until(self, length, deadline):
+        """Exactly `length` bytes before the time.monotonic() `deadline`.
+        Raises CameraTimeout or ConnectionClosed."""
+        buf = bytearray(length)
+        view = memoryview(buf)
         received = 0
-        buf = bytearray()
-        start_time = time.time()
-
-        while True:
-            data = self.socket_recv(length - received)
-            buf.extend(data)
-            received += len(data)
-            if length == received:
-                break
-            elapsed_time = time.time() - start_time
-            if elapsed_time > self.timeout:
-                return None
+        sock = self.socket
+        if sock is None:
+            raise ConnectionClosed("Not connected")
+        if self.udp is not None:
+            try:
+                return self.udp.read(length, deadline)
+            except CameraTimeout:
+                self.metrics.timeout()
+                raise
+        while received < length:
+            # a socket with a timeout waits that long inside recv even with
+            # MSG_DONTWAIT, so wait for data here, bounded by the deadline
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.wait_readable(remaining):
+                self.metrics.timeout()
+                raise CameraTimeout(
+                    "%d of %d bytes received in time" % (received, length)
+                )
+            try:
+                n = sock.recv_into(view[received:], length - received)
+            except (BlockingIOError, InterruptedError, SocketTimeout):
+                continue
+            except OSError as error:
+                self.metrics.error(error)
+                raise ConnectionClosed(str(error))
+            if n == 0:
+                raise ConnectionClosed("Connection closed by camera")
+            received += n
+        self.metrics.bytes_in += length
         return buf
 
+    def receive_reply(self, pkt):
+        """Header of the reply to the request sent as the buffers `pkt`.
+        Over UDP the request is sent again while the reply is missing."""
+        if self.udp is None:
+            return self.receive_with_timeout(20)
+        try:
+            return self.udp.request(pkt, time.monotonic() + self.timeout)
+        except CameraTimeout:
+            self.metrics.timeout()
+            raise
+
     def receive_json(self, length):
         data = self.receive_with_timeout(length)
-        if data is None:
-            return {}
 
         self.packet_count += 1
         self.logger.debug("<= %s", data)
         try:
-            reply = json.loads(data[:-2])
+            # without the trailing "\n\0" and without copying
+            reply = dvrip_json.loads(memoryview(data)[:-2])
             return reply
         except:
             return data
@@ -214,64 +559,60 @@ class DVRIPCam(object):
         if self.socket is None:
             return {"Ret": 101}
         # self.busy.wait()
-        self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            if version == 1:
-                data["SessionID"] = f"{self.session:#0{12}x}"
-            data = bytes(
-                json.dumps(data, ensure_ascii=False, separators=(",", ":")), "utf-8"
-            )
-
-        tail = b"\x00"
-        if version == 0:
-            tail = b"\x0a" + tail
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
-                255,
-                version,
-                self.session,
-                self.packet_count,
-                msg,
-                len(data) + len(tail),
+        with self.busy:
+            if hasattr(data, "__iter__"):
+                if version == 1:
+                    data["SessionID"] = f"{self.session:#0{12}x}"
+                data = dvrip_json.dumps(data, compact=True)
+
+            tail = b"\x00"
+            if version == 0:
+                tail = b"\x0a" + tail
+            pkt = (
+                HEADER.pack(
+                    255,
+                    version,
+                    self.session,
+                    self.packet_count,
+                    msg,
+                    len(data) + len(tail),
+                ),
+                data,
+                tail,
             )
-            + data
-            + tail
-        )
-        self.logger.debug("=> %s", pkt)
-        self.socket_send(pkt)
-        if wait_response:
-            reply = {"Ret": 101}
-            data = self.socket_recv(20)
-            if data is None or len(data) < 20:
-                return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-
-            reply = None
-            if download:
-                reply = self.get_file(len_data)
-            else:
-                reply = self.get_specific_size(len_data)
-            self.busy.release()
-            return reply
+            self.logger.debug("=> %s %s", pkt[0], data)
+            start = time.perf_counter()
+            self.socket_send(*pkt)
+            if wait_response:
+                try:
+                    data = self.receive_reply(pkt)
+                    (
+                        head,
+                        version,
+                        self.session,
+                        sequence_number,
+                        msgid,
+                        len_data,
+                    ) = HEADER.unpack(data)
+
+                    if download:
+                        reply = self.get_file(len_data)
+                    else:
+                        reply = self.get_specific_size(len_data)
+                except (CameraTimeout, ConnectionClosed):
+                    return None
+                self.last_reply = time.monotonic()
+                self.metrics.request(msg, time.perf_counter() - start)
+                return reply
 
     def send(self, msg, data={}, wait_response=True):
         if self.socket is None:
             return {"Ret": 101}
         # self.busy.wait()
-        self.busy.acquire()
-        if hasattr(data, "__iter__"):
-            data = bytes(json.dumps(data, ensure_ascii=False), "utf-8")
-        pkt = (
-            struct.pack(
-                "BB2xII2xHI",
+        with self.busy:
+            if hasattr(data, "__iter__"):
+                data = dvrip_json.dumps(data)
+            header = HEADER.pack(
                 255,
                 0,
                 self.session,
@@ -279,29 +620,35 @@ class DVRIPCam(object):
                 msg,
                 len(data) + 2,
             )
-            + data
-            + b"\x0a\x00"
-        )
-        self.logger.debug("=> %s", pkt)
-        self.socket_send(pkt)
-        if wait_response:
-            reply = {"Ret": 101}
-            data = self.socket_recv(20)
-            if data is None or len(data) < 20:
-                return None
-            (
-                head,
-                version,
-                self.session,
-                sequence_number,
-                msgid,
-                len_data,
-            ) = struct.unpack("BB2xII2xHI", data)
-            reply = self.receive_json(len_data)
-            self.busy.release()
-            return reply
-
-    def sofia_hash(self, password=""):
+            if len(data) < SENDMSG_MIN:
+                # commands, one concatenation is cheapest
+                pkt = (header + data + b"\x0a\x00",)
+            else:
+                # large bodies go out with sendmsg() without being copied
+                pkt = (header, data, b"\x0a\x00")
+            self.logger.debug("=> %s %s", header, data)
+            start = time.perf_counter()
+            self.socket_send(*pkt)
+            if wait_response:
+                try:
+                    data = self.receive_reply(pkt)
+                    (
+                        head,
+                        version,
+                        self.session,
+                        sequence_number,
+                        msgid,
+                        len_data,
+                    ) = HEADER.unpack(data)
+                    reply = self.receive_json(len_data)
+                except (CameraTimeout, ConnectionClosed):
+                    return None
+                self.last_reply = time.monotonic()
+                self.metrics.request(msg, time.perf_counter() - start)
+                return reply
+
+    @staticmethod
+    def sofia_hash(password=""):
         md5 = hashlib.md5(bytes(password, "utf-8")).digest()
         chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
         return "".join([chars[sum(x) % 62] for x in zip(md5[::2], md5[1::2])])
@@ -318,14 +665,16 @@ class DVRIPCam(object):
                 "UserName": self.user,
             },
         )
-        if data is None or data["Ret"] not in self.OK_CODES:
+        if data is None:
+            return False
+        if data["Ret"] not in self.OK_CODES:
             if data["Ret"] in self.CODES:
                 print(f'[{data["Ret"]}] {self.CODES[data["Ret"]]}')
                 self.session=data["Ret"]
             return False
         self.session = int(data["SessionID"], 16)
         self.alive_time = data["AliveInterval"]
-        self.keep_alive()
+        self.alive = scheduler.add(self)
         if not hasattr(self, 'devtype'):
             self.devtype = data["DeviceType "]
         return data["Ret"] in self.OK_CODES
@@ -482,19 +831,18 @@ class DVRIPCam(object):
         )
 
     def channel_bitmap(self, width, height, bitmap):
-        header = struct.pack("HH12x", width, height)
+        header = BITMAP.pack(width, height)
         self.socket_send(
-            struct.pack(
-                "BB2xII2xHI",
+            HEADER.pack(
                 255,
                 0,
                 self.session,
                 self.packet_count,
                 0x041A,
                 len(bitmap) + 16,
-            )
-            + header
-            + bitmap
+            ),
+            header,
+            bitmap,
         )
         reply, rcvd = self.recv_json()
         if reply and reply["Ret"] != 100:
@@ -512,6 +860,7 @@ class DVRIPCam(object):
         self.alarm_func = None
 
     def alarmStart(self):
+        self.alarm_active = True
         self.alarm = threading.Thread(
             name="DVRAlarm%08X" % self.session,
             target=self.alarm_thread,
@@ -522,29 +871,23 @@ class DVRIPCam(object):
         return res
 
     def alarm_thread(self, event):
+        generation = self.generation
         while True:
             event.acquire()
             try:
-                (
-                    head,
-                    version,
-                    session,
-                    sequence_number,
-                    msgid,
-                    len_data,
-                ) = struct.unpack("BB2xII2xHI", self.socket_recv(20))
+                header = Header.unpack(self.socket_recv(20))
                 sleep(0.1)  # Just for receive whole packet
-                reply = self.socket_recv(len_data)
+                reply = self.socket_recv(header.length)
                 self.packet_count += 1
-                reply = json.loads(reply[:-2])
-                if msgid == self.QCODES["AlarmInfo"] and self.session == session:
+                reply = dvrip_json.loads(memoryview(reply)[:-2])
+                if header.msgid == self.QCODES["AlarmInfo"] and self.session == header.session:
                     if self.alarm_func is not None:
-                        self.alarm_func(reply[reply["Name"]], sequence_number)
+                        self.alarm_func(reply[reply["Name"]], header.sequence)
             except:
                 pass
             finally:
                 event.release()
-            if self.socket is None:
+            if self.socket is None or self.generation != generation:
                 break
 
     def set_remote_alarm(self, state):
@@ -554,16 +897,33 @@ class DVRIPCam(object):
         )
 
     def keep_alive(self):
-        ret = self.send(
-            self.QCODES["KeepAlive"],
-            {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session},
-        )
-        if ret is None:
+        """Send one keepalive, called by the keepalive scheduler.
+        Returns False when the session is lost."""
+        generation = self.generation
+        msg = {"Name": "KeepAlive", "SessionID": "0x%08X" % self.session}
+        if not self.reading.acquire(blocking=False):
+            # the stream is being read, the reply arrives within it and is
+            # skipped there
+            self.send(self.QCODES["KeepAlive"], msg, wait_response=False)
+            return True
+        try:
+            alive = self.send(self.QCODES["KeepAlive"], msg) is not None
+        finally:
+            self.reading.release()
+        if alive:
+            return True
+        self.metrics.keepalive_miss()
+        if self.reconnect_enabled:
+            # can take long, keep the scheduler's worker free
+            threading.Thread(
+                name="DVRReconnect%08X" % self.session,
+                target=self.reconnect,
+                args=(generation,),
+                daemon=True,
+            ).start()
+        else:
             self.close()
-            return
-        self.alive = threading.Timer(self.alive_time, self.keep_alive)
-        self.alive.daemon = True
-        self.alive.start()
+        return False
 
     def keyDown(self, key):
         self.set_command(
@@ -654,8 +1014,7 @@ class DVRIPCam(object):
         data = self.send(code, {"Name": command, "SessionID": "0x%08X" % self.session})
 
         if isinstance(data, (bytes, bytearray)):
-            data = bytes(b for b in data[:-2] if b >= 32 or b in (9, 10, 13))
-            data = json.loads(data.decode('latin1'), strict=False)
+            data = dvrip_json.loads_lenient(data)
 
         if data["Ret"] in self.OK_CODES and command in data:
             return data[command]
@@ -724,12 +1083,14 @@ class DVRIPCam(object):
         if m is None:
             return None, buf
         buf = buf[m.span(1)[1] :]
-        return json.loads(m.group(1)), buf
+        return dvrip_json.loads(m.group(1)), buf
 
     def get_upgrade_info(self):
         return self.get_command("OPSystemUpgrade")
 
     def upgrade(self, filename="", packetsize=0x8000, vprint=None):
+        """Upload and install a firmware. `filename` is a path, bytes or a
+        FirmwareImage, one image can serve any number of uploads."""
         if not vprint:
             vprint = lambda *args, **kwargs: print(*args, **kwargs)
 
@@ -739,34 +1100,38 @@ class DVRIPCam(object):
         if data["Ret"] not in self.OK_CODES:
             return data
 
-        self.logger.debug(f"Sending file: {filename}")
+        image = FirmwareImage.open(filename)
+        try:
+            return self.install(image, packetsize, vprint)
+        finally:
+            if image is not filename:
+                # mapped here, the caller's images stay open
+                image.close()
+
+    def install(self, image, packetsize, vprint):
+        """Upload the FirmwareImage `image` after the upgrade was started"""
+        self.logger.debug("Sending file: %s", image.name)
         blocknum = 0
         sentbytes = 0
-        fsize = os.stat(filename).st_size
+        fsize = len(image)
         rcvd = bytearray()
-        with open(filename, "rb") as f:
-            while True:
-                bytes = f.read(packetsize)
-                if not bytes:
-                    break
-                header = struct.pack(
-                    "BB2xII2xHI", 255, 0, self.session, blocknum, 0x5F2, len(bytes)
-                )
-                self.socket_send(header + bytes)
-                blocknum += 1
-                sentbytes += len(bytes)
-
-                reply, rcvd = self.recv_json(rcvd)
-                if reply and reply["Ret"] != 100:
-                    vprint("\nUpgrade failed")
-                    return reply
+        # blocks are slices of the image, sent without a copy
+        for block in image.blocks(packetsize):
+            self.socket_send(HEADER.pack(255, 0, self.session, blocknum, 0x5F2, len(block)), block)
+            blocknum += 1
+            sentbytes += len(block)
+
+            reply, rcvd = self.recv_json(rcvd)
+            if reply and reply["Ret"] != 100:
+                vprint("\nUpgrade failed")
+                return reply
 
-                progress = sentbytes / fsize * 100
-                vprint(f"Uploading: {progress:.1f}%", end='\r')
+            progress = sentbytes / fsize * 100
+            vprint(f"Uploading: {progress:.1f}%", end='\r')
         vprint()
         self.logger.debug("Upload complete")
 
-        pkt = struct.pack("BB2xIIxBHI", 255, 0, self.session, blocknum, 1, 0x05F2, 0)
+        pkt = END_HEADER.pack(255, 0, self.session, blocknum, 1, 0x05F2, 0)
         self.socket_send(pkt)
         self.logger.debug("Starting upgrade...")
         while True:
@@ -780,7 +1145,8 @@ class DVRIPCam(object):
                 return data
             if data["Ret"] == 515:
                 vprint("\nUpgrade successful")
-                self.socket.close()
+                # the camera reboots, the session is gone
+                self.disconnect()
                 return data
             vprint(f"Upgrading: {data['Ret']:>3}%", end='\r')
         vprint()
@@ -793,7 +1159,7 @@ class DVRIPCam(object):
 
         while True:
             header = self.receive_with_timeout(20)
-            len_data = struct.unpack("I", header[16:])[0]
+            (len_data,) = LENGTH.unpack_from(header, 16)
 
             if len_data == 0:
                 return buf
@@ -804,40 +1170,26 @@ class DVRIPCam(object):
     def get_specific_size(self, size):
         return self.receive_with_timeout(size)
 
-    def reassemble_bin_payload(self, metadata={}):
-        def internal_to_type(data_type, value):
-            if data_type == 0x1FC or data_type == 0x1FD:
-                if value == 1:
-                    return "mpeg4"
-                elif value == 2:
-                    return "h264"
-                elif value == 3:
-                    return "h265"
-            elif data_type == 0x1F9:
-                if value == 1 or value == 6:
-                    return "info"
-            elif data_type == 0x1FA:
-                if value == 0xE:
-                    return "g711a"
-            elif data_type == 0x1FE and value == 0:
-                return "jpeg"
-            return None
-
-        def internal_to_datetime(value):
-            second = value & 0x3F
-            minute = (value & 0xFC0) >> 6
-            hour = (value & 0x1F000) >> 12
-            day = (value & 0x3E0000) >> 17
-            month = (value & 0x3C00000) >> 22
-            year = ((value & 0xFC000000) >> 26) + 2000
-            return datetime(year, month, day, hour, minute, second)
-
+    def reassemble_bin_payload(self, metadata=None, stall=None):
+        """Payload of the next media frame, its metadata is stored in the
+        dict `metadata`. See read_frame()."""
+        frame = self.read_frame(stall)
+        if metadata is not None:
+            metadata.update(frame.meta())
+        return frame.data
+
+    def read_frame(self, stall=None):
+        """Next media Frame. With `stall` set, CameraTimeout is raised when
+        no frame starts within that many seconds."""
         length = 0
         buf = bytearray()
-        start_time = time.time()
+        # one deadline for the whole frame
+        deadline = time.monotonic() + self.timeout
+        first = deadline if stall is None else time.monotonic() + stall
+        gaps = self.udp.gaps if self.udp is not None else 0
 
         while True:
-            data = self.receive_with_timeout(20)
+            data = self.receive_until(20, first if length == 0 else deadline)
             (
                 head,
                 version,
@@ -847,51 +1199,39 @@ class DVRIPCam(object):
                 cur,
                 msgid,
                 len_data,
-            ) = struct.unpack("BB2xIIBBHI", data)
-            packet = self.receive_with_timeout(len_data)
+            ) = MEDIA_HEADER.unpack(data)
+            packet = self.receive_until(len_data, deadline)
+            if self.udp is not None:
+                if self.udp.gaps != gaps:
+                    # datagrams were lost, drop the frame and wait for the next
+                    gaps = self.udp.gaps
+                    length = 0
+                    buf = bytearray()
+                if length == 0 and (len(packet) < 8 or DATA_TYPE.unpack_from(packet)[0] not in START_TYPES):
+                    # the rest of a frame whose first packet was lost
+                    continue
             frame_len = 0
             if length == 0:
-                media = None
-                frame_len = 8
-                (data_type,) = struct.unpack(">I", packet[:4])
-                if data_type == 0x1FC or data_type == 0x1FE:
-                    frame_len = 16
-                    (
-                        media,
-                        metadata["fps"],
-                        w,
-                        h,
-                        dt,
-                        length,
-                    ) = struct.unpack("BBBBII", packet[4:frame_len])
-                    metadata["width"] = w * 8
-                    metadata["height"] = h * 8
-                    metadata["datetime"] = internal_to_datetime(dt)
-                    if data_type == 0x1FC:
-                        metadata["frame"] = "I"
-                elif data_type == 0x1FD:
-                    (length,) = struct.unpack("I", packet[4:frame_len])
-                    metadata["frame"] = "P"
-                elif data_type == 0x1FA:
-                    (media, samp_rate, length) = struct.unpack(
-                        "BBH", packet[4:frame_len]
-                    )
-                elif data_type == 0x1F9:
-                    (media, n, length) = struct.unpack("BBH", packet[4:frame_len])
-                # special case of JPEG shapshots
-                elif data_type == 0xFFD8FFE0 or data_type == 0xFFD8FFDB:
-                    return packet
-                else:
-                    raise ValueError(data_type)
-                if media is not None:
-                    metadata["type"] = internal_to_type(data_type, media)
-            buf.extend(packet[frame_len:])
+                if packet[:1] == b"{":
+                    # keepalive replies share the socket with the stream
+                    continue
+                started = time.perf_counter()
+                frame, frame_len, length = frame_start(packet, self.video_codec)
+                if length is None:
+                    # special case of JPEG shapshots
+                    frame.data = packet
+                    return frame
+                if frame.kind == "I":
+                    self.video_codec = frame.codec
+            if frame_len:
+                buf.extend(memoryview(packet)[frame_len:])
+            else:
+                buf.extend(packet)
             length -= len(packet) - frame_len
             if length == 0:
-                return buf
-            elapsed_time = time.time() - start_time
-            if elapsed_time > self.timeout:
-                return None
+                self.metrics.frame(len(buf), time.perf_counter() - started)
+                frame.data = buf
+                return frame
 
     def snapshot(self, channel=0):
         command = "OPSNAP"
@@ -907,13 +1247,7 @@ class DVRIPCam(object):
         packet = self.reassemble_bin_payload()
         return packet
 
-    def start_monitor(self, frame_callback, user={}, stream="Main"):
-        params = {
-            "Channel": 0,
-            "CombinMode": "NONE",
-            "StreamType": stream,
-            "TransMode": "TCP",
-        }
+    def claim_monitor(self, params):
         data = self.set_command("OPMonitor", {"Action": "Claim", "Parameter": params})
         if data["Ret"] not in self.OK_CODES:
             return data
@@ -927,11 +1261,73 @@ class DVRIPCam(object):
             },
             wait_response=False,
         )
-        self.monitoring = True
-        while self.monitoring:
-            meta = {}
-            frame = self.reassemble_bin_payload(meta)
-            frame_callback(frame, meta, user)
+        return data
+
+    def reclaim_monitor(self):
+        """Ask for the stream again on the same session. The replies are
+        not awaited, reassemble_bin_payload() skips them."""
+        for action, msgid in (("Stop", 1413), ("Claim", 1413), ("Start", 1410)):
+            self.send(
+                msgid,
+                {
+                    "Name": "OPMonitor",
+                    "SessionID": "0x%08X" % self.session,
+                    "OPMonitor": {"Action": action, "Parameter": self.monitor_params},
+                },
+                wait_response=False,
+            )
+
+    def start_monitor(self, frame_callback, user=None, stream="Main", health=None, frames=False, pts=None):
+        """Call frame_callback(frame, meta, user) for every frame until
+        stop_monitor(). With `frames` set it is called as
+        frame_callback(frame) with a Frame, no meta dict is built.
+        `health` is a StreamHealth, a stream it finds stalled is claimed
+        again before the session is reconnected. `pts` is a
+        dvrip_pts.PTSClock that stamps every frame."""
+        if user is None:
+            user = {}
+        params = {
+            "Channel": 0,
+            "CombinMode": "NONE",
+            "StreamType": stream,
+            "TransMode": "UDP" if self.udp is not None else "TCP",
+        }
+        with self.reading:
+            data = self.claim_monitor(params)
+            if data["Ret"] not in self.OK_CODES:
+                return data
+
+            self.monitor_params = params
+            self.monitoring = True
+            if health is not None and health.metrics is None:
+                health.metrics = self.metrics
+            while self.monitoring:
+                generation = self.generation
+                try:
+                    frame = self.read_frame(health and health.timeout())
+                except (CameraTimeout, ConnectionClosed, ValueError, struct.error) as error:
+                    if isinstance(error, CameraTimeout) and health is not None and self.monitoring:
+                        if health.stall():
+                            # the session may be fine, only the stream stopped
+                            self.reclaim_monitor()
+                            if pts is not None:
+                                pts.discontinuity()
+                            continue
+                    if not self.reconnect_enabled or not self.monitoring:
+                        raise
+                    if not self.reconnect(generation):
+                        raise SomethingIsWrongWithCamera("Cannot reconnect to camera")
+                    if pts is not None:
+                        pts.discontinuity()
+                    continue
+                if health is not None:
+                    health.frame(frame)
+                if pts is not None:
+                    pts.stamp(frame)
+                if frames:
+                    frame_callback(frame)
+                else:
+                    frame_callback(frame.data, frame.meta(), user)
 
     def stop_monitor(self):
         self.monitoring = False
@@ -962,7 +1358,10 @@ class DVRIPCam(object):
         # When no file can be found
         if data["Ret"] != 100:
             self.logger.debug(
-                f"No files found for channel {channel} for this time range. Start: {startTime}, End: {endTime}"
+                "No files found for channel %s for this time range. Start: %s, End: %s",
+                channel,
+                startTime,
+                endTime,
             )
             return []
 
@@ -1006,7 +1405,7 @@ class DVRIPCam(object):
                 max_event["status"] = "limit"
                 max_event["last_num_results"] = len(result)
 
-        self.logger.debug(f"Found {len(result)} files.")
+        self.logger.debug("Found %d files.", len(result))
         return result
 
     def ptz_step(self, cmd, step=5):
@@ -1045,7 +1444,7 @@ class DVRIPCam(object):
     ):
         Path(targetFilePath).parent.mkdir(parents=True, exist_ok=True)
 
-        self.logger.debug(f"Downloading: {targetFilePath}")
+        self.logger.debug("Downloading: %s", targetFilePath)
 
         self.send(
             1424,
@@ -1101,10 +1500,10 @@ class DVRIPCam(object):
                 bin_data.write(data)
         except TypeError:
             Path(targetFilePath).unlink(missing_ok=True)
-            self.logger.debug(f"An error occured while downloading {targetFilePath}")
+            self.logger.debug("An error occured while downloading %s", targetFilePath)
             raise
 
-        self.logger.debug(f"File successfully downloaded: {targetFilePath}")
+        self.logger.debug("File successfully downloaded: %s", targetFilePath)
 
         actionStop = "Stop"
         if download:
@@ -0,0 +1,271 @@
+"""Activity and scene change detection from compressed frame sizes.
+
+Nothing is decoded. With a still picture the encoder sends P-frames of
+nearly constant size, motion makes them larger, and a different scene
+(camera moved or covered, lights switched) changes the size of I-frames.
+Frame sizes come straight from reassemble_bin_payload().
+
+Needs NumPy: pip install python-dvr[activity]
+"""
+
+import threading
+from datetime import datetime
+from time import monotonic, time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# per stream arrays, one row each
+ARRAYS = ("psizes", "isizes", "ppos", "ipos", "ichecked", "bytes", "bitrate", "score", "active", "fed", "heat")
+
+
+class ActivityDetector(object):
+    """Rolling frame size statistics of many streams.
+
+    Every stream is a row of NumPy ring buffers: sizes of the last `window`
+    P-frames and the last `iframes` I-frames. feed() only stores a size,
+    all streams are evaluated together every `interval` seconds:
+
+    - score: mean of the last `recent` P-frames above the window median, in
+      units of the median absolute deviation (at least `floor` times the
+      median). Activity starts above `threshold` and stops below half of it.
+    - scene change: an I-frame `scene` times larger or smaller than the
+      median of the I-frames before it.
+    - bitrate: bytes per second of all frames, smoothed.
+
+    A stream without frames for `stale` seconds scores 0, so its activity
+    stops; call poll() regularly when all streams may stop at once.
+
+    The callback gets AlarmFilter style messages: {"Camera", "Channel",
+    "Event": "Activity" or "SceneChange", "Status", "StartTime", ...}.
+    The fraction of evaluations with activity is kept per `bucket` seconds
+    for the last `buckets` buckets, see timeline() and heatmap(). `clock`
+    times the evaluations, `wall` gives bucket starts and event times."""
+
+    def __init__(
+        self,
+        callback=None,
+        window=500,
+        recent=10,
+        iframes=8,
+        threshold=4.0,
+        floor=0.05,
+        scene=1.5,
+        interval=0.5,
+        bucket=60,
+        buckets=60,
+        stale=2.0,
+        clock=monotonic,
+        wall=time,
+    ):
+        if np is None:
+            raise ImportError("ActivityDetector needs numpy")
+        self.callback = callback
+        self.window = window
+        self.recent = recent
+        self.iframes = iframes
+        self.threshold = threshold
+        self.floor = floor
+        self.scene = scene
+        self.interval = interval
+        self.bucket = bucket
+        self.buckets = buckets
+        self.stale = stale
+        self.clock = clock
+        self.wall = wall
+        self.lock = threading.Lock()
+        self.rows = {}  # camera -> row
+        self.cameras = []
+        self.starts = []  # StartTime of the current activity
+        self.last_poll = clock()
+        n = 16
+        self.psizes = np.zeros((n, window), np.float32)
+        self.isizes = np.zeros((n, iframes), np.float32)
+        self.ppos = np.zeros(n, np.int64)  # P-frames seen
+        self.ipos = np.zeros(n, np.int64)
+        self.ichecked = np.zeros(n, np.int64)  # I-frames evaluated
+        self.bytes = np.zeros(n, np.float64)  # since the last evaluation
+        self.bitrate = np.zeros(n, np.float64)
+        self.score = np.zeros(n, np.float32)
+        self.active = np.zeros(n, bool)
+        self.fed = np.zeros(n, np.float64)  # clock() of the last frame
+        self.heat = np.zeros((n, buckets), np.float32)
+        self.polls = np.zeros(buckets, np.float32)
+        self.bucket_starts = []
+
+    def row(self, camera):
+        row = self.rows.get(camera)
+        if row is None:
+            row = len(self.cameras)
+            if row == len(self.psizes):
+                for name in ARRAYS:
+                    array = getattr(self, name)
+                    setattr(self, name, np.concatenate([array, np.zeros_like(array)]))
+            self.rows[camera] = row
+            self.starts.append(None)
+            self.cameras.append(camera)
+        return row
+
+    def feed(self, camera, frame, size):
+        """One frame of `camera`, `frame` is "I", "P" or None (audio, info)"""
+        out = None
+        with self.lock:
+            now = self.clock()
+            row = self.row(camera)
+            self.fed[row] = now
+            self.bytes[row] += size
+            if frame == "P":
+                pos = self.ppos[row]
+                self.psizes[row, pos % self.window] = size
+                self.ppos[row] = pos + 1
+            elif frame == "I":
+                pos = self.ipos[row]
+                self.isizes[row, pos % self.iframes] = size
+                self.ipos[row] = pos + 1
+            if now - self.last_poll >= self.interval:
+                out = self.evaluate(now)
+        if out:
+            self.emit(out)
+
+    def poll(self):
+        """Evaluate all streams now, feed() does it every `interval` seconds"""
+        with self.lock:
+            out = self.evaluate(self.clock())
+        self.emit(out)
+
+    def emit(self, out):
+        if self.callback is not None:
+            for msg in out:
+                self.callback(msg)
+
+    def evaluate(self, now):
+        out = []
+        n = len(self.cameras)
+        elapsed = now - self.last_poll
+        self.last_poll = now
+        if not n:
+            return out
+        if elapsed > 0:
+            rate = self.bytes[:n] / elapsed
+            seen = self.bitrate[:n] > 0
+            self.bitrate[:n] = np.where(seen, 0.7 * self.bitrate[:n] + 0.3 * rate, rate)
+            self.bytes[:n] = 0
+
+        # P-frame scores, streams with too few frames score 0
+        sizes = self.psizes[:n]
+        ready = self.ppos[:n] >= self.window
+        median = np.median(sizes, axis=1)
+        mad = np.median(np.abs(sizes - median[:, None]), axis=1)
+        spread = np.maximum(1.4826 * mad, self.floor * median) + 1
+        last = (self.ppos[:n, None] - 1 - np.arange(self.recent)) % self.window
+        recent = np.take_along_axis(sizes, last, axis=1).mean(axis=1)
+        live = now - self.fed[:n] <= self.stale
+        score = np.where(ready & live, (recent - median) / spread, 0)
+        self.score[:n] = score
+
+        active = self.active[:n]
+        started = ~active & (score > self.threshold)
+        stopped = active & (score < self.threshold / 2)
+        for row in np.flatnonzero(started):
+            self.starts[row] = self.timestamp()
+            out.append(self.message(row, "Activity", "Start"))
+        for row in np.flatnonzero(stopped):
+            msg = self.message(row, "Activity", "Stop")
+            msg["StopTime"] = self.timestamp()
+            out.append(msg)
+        active[started] = True
+        active[stopped] = False
+
+        # the newest I-frame against the ones before it
+        fresh = (self.ipos[:n] > self.ichecked[:n]) & (self.ipos[:n] > self.iframes)
+        if fresh.any():
+            rows = np.flatnonzero(fresh)
+            newest = (self.ipos[rows] - 1) % self.iframes
+            isizes = self.isizes[rows]
+            latest = isizes[np.arange(len(rows)), newest]
+            isizes[np.arange(len(rows)), newest] = np.nan
+            before = np.nanmedian(isizes, axis=1) + 1
+            ratio = (latest + 1) / before
+            changed = (ratio > self.scene) | (ratio < 1 / self.scene)
+            for row, r in zip(rows[changed], ratio[changed]):
+                msg = self.message(row, "SceneChange", "")
+                msg["StartTime"] = self.timestamp()
+                msg["Ratio"] = float(r)
+                out.append(msg)
+            self.ichecked[rows] = self.ipos[rows]
+            # the new scene is the reference from now on, P-frame sizes are
+            # learned again
+            self.isizes[rows[changed]] = latest[changed][:, None]
+            self.ppos[rows[changed]] = 0
+
+        self.count(active)
+        return out
+
+    def timestamp(self):
+        return datetime.fromtimestamp(self.wall()).strftime(DATE_FORMAT)
+
+    def message(self, row, event, status):
+        return {
+            "Camera": self.cameras[row],
+            "Channel": 0,
+            "Event": event,
+            "Status": status,
+            "StartTime": self.starts[row],
+            "Score": float(self.score[row]),
+        }
+
+    def count(self, active):
+        start = int(self.wall() // self.bucket * self.bucket)
+        if not self.bucket_starts or self.bucket_starts[-1] != start:
+            self.bucket_starts.append(start)
+            # the oldest column is reused
+            self.heat = np.roll(self.heat, -1, axis=1)
+            self.polls = np.roll(self.polls, -1)
+            self.heat[:, -1] = 0
+            self.polls[-1] = 0
+            del self.bucket_starts[: -self.buckets]
+        self.heat[: len(active), -1] += active
+        self.polls[-1] += 1
+
+    def stats(self, camera):
+        """{"active", "score", "baseline", "bitrate"} of one stream"""
+        with self.lock:
+            row = self.rows[camera]
+            count = min(int(self.ppos[row]), self.window)
+            return {
+                "active": bool(self.active[row]),
+                "score": float(self.score[row]),
+                "baseline": float(np.median(self.psizes[row, :count])) if count else None,
+                "bitrate": float(self.bitrate[row] * 8),
+            }
+
+    def heatmap(self):
+        """(cameras, bucket start times, array of the active fraction per
+        camera and bucket)"""
+        with self.lock:
+            k = len(self.bucket_starts)
+            polls = np.maximum(self.polls[self.buckets - k :], 1)
+            heat = self.heat[: len(self.cameras), self.buckets - k :] / polls
+            return list(self.cameras), list(self.bucket_starts), heat
+
+    def timeline(self, camera):
+        """{bucket start time: active fraction} of one camera"""
+        cameras, starts, heat = self.heatmap()
+        row = cameras.index(camera)
+        return {start: float(value) for start, value in zip(starts, heat[row])}
+
+    def dvrip_callback(self, camera="", frame_callback=None):
+        """Function for DVRIPCam.start_monitor, frames are passed on to
+        `frame_callback`"""
+
+        def callback(frame, meta, user):
+            if frame is not None:
+                self.feed(camera, meta.get("frame"), len(frame))
+            if frame_callback is not None:
+                frame_callback(frame, meta, user)
+
+        return callback
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""SQLite index of recording trees.
+
+Indexes the .video/.audio files of monitor.py (camera/YYYY/MM/DD/HH.MM.SS)
+and recordings downloaded from devices (frames with their DVRIP headers,
+as download_file() stores them) with their time range, codec, size and
+keyframe offsets, so "what is there for camera X between T1 and T2" is
+one query instead of a walk over the tree.
+
+    python3 dvrip_archive.py archive.db /srv/recordings
+    python3 dvrip_archive.py archive.db --query hall "2024-05-01 14:00:00" "2024-05-01 15:00:00"
+
+Files are read through mmap by a pool of processes. A file is scanned
+again only when its size or mtime changed, rows of deleted files are
+dropped.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import sqlite3
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from dvrip_header import DATA_TYPE, FRAME_TYPES, iter_frames
+from dvrip_nal import CodecConfig, access_units, guess_codec, parameter_sets
+from dvrip_pts import PTSClock
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+EXTENSIONS = (".video", ".audio", ".h264", ".h265")
+# G.711 of monitor.py .audio files
+AUDIO_RATE = 8000
+
+# recording names, matched against the end of the path. The camera is the
+# named group or the parent directory and the channel.
+NAMES = (
+    # monitor.py: camera/2024/05/01/14.00.00.video
+    re.compile(r"(?P<camera>[^/]+)/(?P<Y>\d{4})/(?P<m>\d\d)/(?P<d>\d\d)/(?P<H>\d\d)\.(?P<M>\d\d)\.(?P<S>\d\d)\.\w+$"),
+    # NVR.py: 002_2023-11-19_05.38.58-05.39.34.h264
+    re.compile(
+        r"(?P<channel>\d+)_(?P<Y>\d{4})-(?P<m>\d\d)-(?P<d>\d\d)_(?P<H>\d\d)\.(?P<M>\d\d)\.(?P<S>\d\d)"
+        r"-(?P<eH>\d\d)\.(?P<eM>\d\d)\.(?P<eS>\d\d)\.\w+$"
+    ),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    camera TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    codec TEXT,
+    width INTEGER,
+    height INTEGER,
+    fps REAL,
+    frames INTEGER NOT NULL DEFAULT 0,
+    keyframes INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS segments_camera_time ON segments (camera, start, end);
+CREATE INDEX IF NOT EXISTS segments_start ON segments (start);
+CREATE TABLE IF NOT EXISTS usage (
+    camera TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+-- bytes per camera follow the segment rows, no SUM() over the archive
+CREATE TRIGGER IF NOT EXISTS usage_insert AFTER INSERT ON segments BEGIN
+    INSERT INTO usage (camera, bytes, files) VALUES (NEW.camera, NEW.size, 1)
+    ON CONFLICT (camera) DO UPDATE SET bytes = bytes + NEW.size, files = files + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS usage_delete AFTER DELETE ON segments BEGIN
+    UPDATE usage SET bytes = bytes - OLD.size, files = files - 1 WHERE camera = OLD.camera;
+END;
+CREATE TABLE IF NOT EXISTS keyframes (
+    segment INTEGER NOT NULL REFERENCES segments (id) ON DELETE CASCADE,
+    offset INTEGER NOT NULL,
+    time REAL NOT NULL,
+    PRIMARY KEY (segment, offset)
+) WITHOUT ROWID;
+"""
+SEGMENT_FIELDS = (
+    "path",
+    "camera",
+    "start",
+    "end",
+    "size",
+    "mtime_ns",
+    "format",
+    "codec",
+    "width",
+    "height",
+    "fps",
+    "frames",
+    "keyframes",
+)
+
+
+def timestamp(value):
+    """POSIX time of a datetime, a "YYYY-MM-DD HH:MM:SS" string or a number"""
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            value = datetime.strptime(value, DATE_FORMAT)
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+def parse_name(path):
+    """(camera, start, end) of a recording path, times are None when the
+    name does not tell them"""
+    name = path.replace(os.sep, "/")
+    for pattern in NAMES:
+        m = pattern.search(name)
+        if m is None:
+            continue
+        g = m.groupdict()
+        day = (int(g["Y"]), int(g["m"]), int(g["d"]))
+        try:
+            start = datetime(*day, int(g["H"]), int(g["M"]), int(g["S"])).timestamp()
+            end = None
+            if "eH" in g:
+                end = datetime(*day, int(g["eH"]), int(g["eM"]), int(g["eS"])).timestamp()
+                if end < start:
+                    end += 86400
+        except ValueError:
+            continue
+        if "camera" in g:
+            return g["camera"], start, end
+        return "%s/%s" % (os.path.basename(os.path.dirname(path)), g["channel"]), start, end
+    return os.path.basename(os.path.dirname(path)), None, None
+
+
+def scan_file(path):
+    """Segment row and [(offset, time)] of keyframes of one file, None
+    when it is gone"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    camera, start, end = parse_name(path)
+    row = {
+        "path": path,
+        "camera": camera,
+        "start": start,
+        "end": end,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "format": "unknown",
+        "codec": None,
+        "width": None,
+        "height": None,
+        "fps": None,
+        "frames": 0,
+        "keyframes": 0,
+    }
+    keyframes = []
+    mtime = st.st_mtime_ns / 1e9
+    if path.endswith(".audio"):
+        scan_audio(row, mtime)
+    elif st.st_size >= DATA_TYPE.size:
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            if DATA_TYPE.unpack_from(data)[0] in FRAME_TYPES:
+                scan_frames(data, row, keyframes, mtime)
+            else:
+                scan_annexb(data, row, keyframes, mtime)
+        except (ValueError, struct.error):
+            # damaged beyond what the scanners skip, indexed by its name
+            del keyframes[:]
+        finally:
+            try:
+                data.close()
+            except BufferError:
+                pass
+    if row["start"] is None:
+        row["start"] = row["end"] if row["end"] is not None else mtime
+    if row["end"] is None or row["end"] < row["start"]:
+        row["end"] = max(row["start"], mtime)
+    return row, keyframes
+
+
+def scan_audio(row, mtime):
+    row["format"] = "g711"
+    row["codec"] = "g711a"
+    duration = row["size"] / AUDIO_RATE
+    if row["start"] is None:
+        row["start"] = mtime - duration
+    row["end"] = row["start"] + duration
+
+
+def scan_frames(data, row, keyframes, mtime):
+    """Recording with DVRIP frame headers, timed by the camera clock"""
+    row["format"] = "dvrip"
+    clock = PTSClock(clock=None)
+    first = last = None
+    pictures = []
+    for offset, frame in iter_frames(data):
+        clock.stamp(frame)
+        if frame.kind is None:
+            continue
+        if first is None:
+            first = frame.pts
+        last = frame.pts
+        row["frames"] += 1
+        if frame.kind == "I":
+            pictures.append((offset, frame.pts))
+            if row["codec"] is None:
+                row["codec"] = frame.codec
+                row["fps"] = frame.fps
+                row["width"], row["height"] = frame.width, frame.height
+                config = frame.codec in ("h264", "h265") and CodecConfig.from_frame(frame.data, frame.codec)
+                if config:
+                    row["width"], row["height"] = config.width, config.height
+        frame.data = None
+    if first is None:
+        return
+    duration = (last - first) / clock.timebase + 1.0 / (row["fps"] or clock.fps)
+    if clock.wall(first) is not None:
+        # the camera time mapping is only final after the last I-frame
+        row["start"] = clock.wall(first)
+    elif row["start"] is None:
+        # the camera clock was not set
+        row["start"] = mtime - duration
+    row["end"] = row["start"] + duration
+    keyframes.extend((offset, row["start"] + (pts - first) / clock.timebase) for offset, pts in pictures)
+    row["keyframes"] = len(keyframes)
+
+
+def scan_annexb(data, row, keyframes, mtime):
+    """Raw H.264/H.265 of monitor.py, timed by the file name and mtime"""
+    codec = guess_codec(data)
+    if codec is None:
+        return
+    row["format"] = "annexb"
+    row["codec"] = codec
+    pictures = []
+    for offset, key in access_units(data, codec):
+        if key:
+            pictures.append((offset, row["frames"]))
+        row["frames"] += 1
+    if pictures:
+        vps, sps, pps, key = parameter_sets(data, codec, pictures[0][0])
+        if sps is not None and pps is not None:
+            try:
+                config = CodecConfig(codec, sps, pps, vps)
+            except ValueError:
+                config = None
+            if config is not None:
+                row["width"], row["height"], row["fps"] = config.width, config.height, config.fps
+    # no timestamps in the stream: the file was written from its start
+    # time until its mtime, unless the SPS tells the frame rate
+    start = row["start"]
+    counted = row["frames"] / (row["fps"] or 25)
+    if start is None:
+        start = mtime - counted
+    duration = max(mtime - start, 0)
+    if row["fps"] or not counted / 2 <= duration <= counted * 2:
+        # copied files have a new mtime
+        duration = counted
+    elif duration:
+        row["fps"] = row["frames"] / duration
+    step = duration / row["frames"] if row["frames"] else 0
+    keyframes.extend((offset, start + n * step) for offset, n in pictures)
+    row["start"] = start
+    row["end"] = start + duration
+    row["keyframes"] = len(keyframes)
+
+
+def walk(root):
+    """(path, size, mtime_ns) of the recordings below `root`"""
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(EXTENSIONS):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    yield entry.path, st.st_size, st.st_mtime_ns
+
+
+class ArchiveIndex(object):
+    """Index database at `path`, ":memory:" works for one-off queries"""
+
+    def __init__(self, path="archive.db"):
+        self.path = path
+        # clips are served from other threads, SQLite serializes the calls
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode = WAL")
+        counted = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'usage'").fetchone()
+        self.db.executescript(SCHEMA)
+        if counted is None:
+            # index of an older version
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO usage (camera, bytes, files) "
+                    "SELECT camera, SUM(size), COUNT(*) FROM segments GROUP BY camera"
+                )
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def scan(self, root, processes=None, chunksize=8):
+        """Index new and changed files below `root`, forget deleted ones.
+        {"scanned", "unchanged", "removed"} counts."""
+        root = os.path.abspath(root)
+        known = {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.db.execute(
+                "SELECT path, size, mtime_ns FROM segments WHERE path >= ? AND path < ?",
+                (root + os.sep, root + chr(ord(os.sep) + 1)),
+            )
+        }
+        changed = []
+        unchanged = 0
+        for path, size, mtime_ns in walk(root):
+            if known.pop(path, None) == (size, mtime_ns):
+                unchanged += 1
+            else:
+                changed.append(path)
+        with self.db:
+            self.db.executemany("DELETE FROM segments WHERE path = ?", [(path,) for path in known])
+        if processes == 1 or len(changed) < 2 * chunksize:
+            results = map(scan_file, changed)
+            self.store(results)
+        else:
+            with ProcessPoolExecutor(processes) as pool:
+                self.store(pool.map(scan_file, changed, chunksize=chunksize))
+        return {"scanned": len(changed), "unchanged": unchanged, "removed": len(known)}
+
+    def add(self, paths):
+        """Index the given files, e.g. the segments monitor.py has just
+        closed, without walking the tree"""
+        self.store(scan_file(os.path.abspath(path)) for path in paths)
+
+    def store(self, results, batch=256):
+        pending = []
+        for result in results:
+            if result is None:
+                continue
+            pending.append(result)
+            if len(pending) >= batch:
+                self.insert(pending)
+                pending = []
+        self.insert(pending)
+
+    def insert(self, results):
+        columns = ", ".join(SEGMENT_FIELDS)
+        marks = ", ".join("?" * len(SEGMENT_FIELDS))
+        with self.db:
+            for row, keyframes in results:
+                self.db.execute("DELETE FROM segments WHERE path = ?", (row["path"],))
+                cursor = self.db.execute(
+                    "INSERT INTO segments (%s) VALUES (%s)" % (columns, marks),
+                    [row[name] for name in SEGMENT_FIELDS],
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO keyframes (segment, offset, time) VALUES (?, ?, ?)",
+                    [(cursor.lastrowid, offset, time) for offset, time in keyframes],
+                )
+
+    def cameras(self):
+        return [row[0] for row in self.db.execute("SELECT DISTINCT camera FROM segments ORDER BY camera")]
+
+    def segments(self, camera, start, end, format=None):
+        """Segment rows of `camera` overlapping start..end, oldest first.
+        Times are datetimes, "YYYY-MM-DD HH:MM:SS" strings or POSIX times."""
+        query = "SELECT * FROM segments WHERE camera = ? AND start < ? AND end > ?"
+        args = [camera, timestamp(end), timestamp(start)]
+        if format is not None:
+            query += " AND format = ?"
+            args.append(format)
+        return [dict(row) for row in self.db.execute(query + " ORDER BY start", args)]
+
+    def coverage(self, camera, start, end, gap=2.0):
+        """[(start, end)] of recorded video between start and end, segments
+        less than `gap` seconds apart are joined"""
+        spans = []
+        for row in self.segments(camera, start, end):
+            if row["format"] == "g711":
+                continue
+            if spans and row["start"] - spans[-1][1] <= gap:
+                spans[-1][1] = max(spans[-1][1], row["end"])
+            else:
+                spans.append([row["start"], row["end"]])
+        lo, hi = timestamp(start), timestamp(end)
+        return [(max(a, lo), min(b, hi)) for a, b in spans]
+
+    def keyframe_before(self, segment, time):
+        """(offset, time) of the last keyframe of a segment id at or before
+        `time`, the first one when there is none before"""
+        time = timestamp(time)
+        row = self.db.execute(
+            "SELECT offset, time FROM keyframes WHERE segment = ? AND time <= ? ORDER BY time DESC LIMIT 1",
+            (segment, time),
+        ).fetchone()
+        if row is None:
+            row = self.db.execute(
+                "SELECT offset, time FROM keyframes WHERE segment = ? ORDER BY time LIMIT 1", (segment,)
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def keyframes(self, segment):
+        return [tuple(row) for row in self.db.execute(
+            "SELECT offset, time FROM keyframes WHERE segment = ? ORDER BY offset", (segment,)
+        )]
+
+    def usage(self):
+        """{camera: (bytes, oldest start, newest end)}"""
+        return {
+            camera: (size, oldest, newest)
+            for camera, size, oldest, newest in self.db.execute(
+                "SELECT camera, bytes,"
+                " (SELECT MIN(start) FROM segments WHERE camera = usage.camera),"
+                " (SELECT MAX(end) FROM segments WHERE camera = usage.camera)"
+                " FROM usage WHERE files > 0 ORDER BY camera"
+            )
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index recording trees in SQLite")
+    parser.add_argument("database")
+    parser.add_argument("roots", nargs="*", help="directories to scan")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--query", nargs=3, metavar=("CAMERA", "START", "END"))
+    args = parser.parse_args()
+
+    with ArchiveIndex(args.database) as index:
+        for root in args.roots:
+            print(root, index.scan(root, args.processes))
+        if args.query:
+            camera, start, end = args.query
+            for row in index.segments(camera, start, end):
+                print(
+                    "%s  %s - %s  %s %s %d keyframes"
+                    % (
+                        row["path"],
+                        datetime.fromtimestamp(row["start"]).strftime(DATE_FORMAT),
+                        datetime.fromtimestamp(row["end"]).strftime(DATE_FORMAT),
+                        row["codec"],
+                        row["size"],
+                        row["keyframes"],
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
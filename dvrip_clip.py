@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Clips of indexed recordings.
+
+A clip starts at the keyframe at or before its start time, so it decodes
+without anything before it, and ends before the first picture at its end
+time. Rotated monitor.py segments are joined where one continues the
+other. Nothing is decoded: the byte ranges of the clip are copied, with
+sendfile() when the output is a file, and recordings with DVRIP frame
+headers are reduced to their video payload. The result is an H.264 or
+H.265 elementary stream.
+
+    python3 dvrip_clip.py archive.db hall "2024-05-01 14:03:10" "2024-05-01 14:05:40" clip.h264
+    python3 dvrip_clip.py archive.db --serve 8080
+    curl -o clip.h264 "http://localhost:8080/clip?camera=hall&start=2024-05-01+14:03:10&end=2024-05-01+14:05:40"
+
+The index comes from dvrip_archive.py.
+"""
+
+import argparse
+import mmap
+import os
+from urllib.parse import parse_qs
+
+from dvrip_archive import ArchiveIndex, timestamp
+from dvrip_header import iter_frames
+from dvrip_nal import access_units
+
+# RFC 6184 and RFC 7798 media types
+CONTENT_TYPES = {"h264": "video/H264", "h265": "video/H265"}
+
+
+class Piece(object):
+    """Bytes `begin` to `stop` of one segment file"""
+
+    __slots__ = ("path", "format", "codec", "begin", "stop")
+
+    def __init__(self, path, format, codec, begin, stop):
+        self.path = path
+        self.format = format
+        self.codec = codec
+        self.begin = begin
+        self.stop = stop
+
+    def __repr__(self):
+        return "Piece(%r, %s, %d-%d)" % (self.path, self.format, self.begin, self.stop)
+
+
+def open_map(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close_map(data):
+    try:
+        data.close()
+    except BufferError:
+        # views are still in use, the garbage collector unmaps it
+        pass
+
+
+class ClipExtractor(object):
+    """Clips of the recordings in an ArchiveIndex. Segments less than `gap`
+    seconds apart are joined without looking for a keyframe, the later one
+    continues the stream of the earlier."""
+
+    def __init__(self, index, gap=2.0, chunk=0x100000):
+        self.index = index
+        self.gap = gap
+        self.chunk = chunk
+
+    def plan(self, camera, start, end):
+        """Pieces of the clip of `camera` from `start` to `end`, empty when
+        nothing was recorded. Times as for ArchiveIndex.segments()."""
+        start, end = timestamp(start), timestamp(end)
+        pieces = []
+        previous = None
+        for segment in self.index.segments(camera, start, end):
+            if segment["format"] not in ("annexb", "dvrip"):
+                continue
+            continued = (
+                previous is not None
+                and segment["start"] - previous["end"] <= self.gap
+                and segment["codec"] == previous["codec"]
+            )
+            if continued:
+                begin = 0
+            else:
+                keyframe = self.index.keyframe_before(segment["id"], max(start, segment["start"]))
+                if keyframe is None or keyframe[1] >= end:
+                    continue
+                begin = keyframe[0]
+            stop = self.cut(segment, end)
+            if stop > begin:
+                pieces.append(Piece(segment["path"], segment["format"], segment["codec"], begin, stop))
+                previous = segment
+        return pieces
+
+    def cut(self, segment, end):
+        """Offset of the first picture of a segment at or after `end`"""
+        if end >= segment["end"]:
+            return segment["size"]
+        keyframe = self.index.keyframe_before(segment["id"], end)
+        if keyframe is None:
+            return segment["size"]
+        offset, time = keyframe
+        if time >= end:
+            return offset
+        data = open_map(segment["path"])
+        try:
+            if segment["format"] == "dvrip":
+                step = 1.0 / (segment["fps"] or 25)
+                pictures = ((at, frame.kind) for at, frame in iter_frames(data, offset) if frame.kind)
+            else:
+                # pictures are evenly spread over the segment
+                step = (segment["end"] - segment["start"]) / max(segment["frames"], 1)
+                pictures = access_units(data, segment["codec"], offset)
+            for n, (at, key) in enumerate(pictures):
+                if time + n * step >= end:
+                    return at
+            return segment["size"]
+        finally:
+            pictures = None
+            close_map(data)
+
+    def chunks(self, pieces):
+        """Memoryviews of the clip data, valid until the next one is taken"""
+        for piece in pieces:
+            data = open_map(piece.path)
+            try:
+                if piece.format == "dvrip":
+                    for offset, frame in iter_frames(data, piece.begin, piece.stop):
+                        if frame.kind:
+                            yield frame.data
+                        frame.data = None
+                else:
+                    view = memoryview(data)
+                    for offset in range(piece.begin, piece.stop, self.chunk):
+                        yield view[offset : min(offset + self.chunk, piece.stop)]
+                    view.release()
+            finally:
+                close_map(data)
+
+    def write(self, pieces, out):
+        """Write the clip to a path or a binary file, number of bytes"""
+        if isinstance(out, (str, os.PathLike)):
+            with open(out, "wb") as f:
+                return self.write(pieces, f)
+        try:
+            fd = out.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        written = 0
+        for piece in pieces:
+            if piece.format == "annexb" and fd is not None and hasattr(os, "sendfile"):
+                out.flush()
+                with open(piece.path, "rb") as f:
+                    written += sendfile(fd, f.fileno(), piece.begin, piece.stop - piece.begin)
+                continue
+            for chunk in self.chunks([piece]):
+                out.write(chunk)
+                written += len(chunk)
+        return written
+
+    def extract(self, camera, start, end, out):
+        """Write the clip of `camera` from `start` to `end` to `out`, the
+        number of bytes, 0 when nothing was recorded"""
+        return self.write(self.plan(camera, start, end), out)
+
+    def size(self, pieces):
+        """Length of the clip, None when DVRIP headers are left out"""
+        if any(piece.format != "annexb" for piece in pieces):
+            return None
+        return sum(piece.stop - piece.begin for piece in pieces)
+
+    def wsgi(self, environ, start_response):
+        """WSGI application: GET ?camera=...&start=...&end=... streams the
+        clip, times as "YYYY-MM-DD HH:MM:SS" or POSIX times"""
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        try:
+            camera, start, end = (query[name][0] for name in ("camera", "start", "end"))
+            pieces = self.plan(camera, start, end)
+        except (KeyError, ValueError):
+            start_response("400 Bad Request", [("Content-Type", "text/plain")])
+            return [b"camera, start and end are needed\n"]
+        if not pieces:
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"nothing recorded\n"]
+        codec = pieces[0].codec
+        headers = [
+            ("Content-Type", CONTENT_TYPES.get(codec, "application/octet-stream")),
+            ("Content-Disposition", 'attachment; filename="%s.%s"' % (camera.replace("/", "_"), codec)),
+        ]
+        size = self.size(pieces)
+        if size is not None:
+            headers.append(("Content-Length", str(size)))
+        start_response("200 OK", headers)
+        return (bytes(chunk) for chunk in self.chunks(pieces))
+
+
+def sendfile(out, fd, offset, count):
+    written = 0
+    while written < count:
+        n = os.sendfile(out, fd, offset + written, count - written)
+        if n == 0:
+            # the file got shorter
+            break
+        written += n
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cut clips out of indexed recordings")
+    parser.add_argument("database")
+    parser.add_argument("clip", nargs="*", metavar="CAMERA START END OUTPUT")
+    parser.add_argument("--serve", type=int, metavar="PORT", help="serve clips over HTTP")
+    args = parser.parse_args()
+
+    index = ArchiveIndex(args.database)
+    extractor = ClipExtractor(index)
+    if args.serve:
+        from wsgiref.simple_server import make_server
+
+        make_server("", args.serve, extractor.wsgi).serve_forever()
+    elif len(args.clip) == 4:
+        camera, start, end, output = args.clip
+        print(output, extractor.extract(camera, start, end, output), "bytes")
+    else:
+        parser.error("CAMERA START END OUTPUT or --serve PORT")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Firmware images for DVRIPCam.upgrade().
+
+An image is read or mapped once and handed out in blocks as memoryviews,
+so any number of uploads, concurrent ones too, slice the same memory
+instead of reading the file again for every device.
+"""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+
+class FirmwareImage(object):
+    """Upgrade file contents. `source` is a path, which is memory-mapped,
+    or a bytes-like object such as bytes, a bytearray or an mmap."""
+
+    def __init__(self, source):
+        self.mmap = None
+        if isinstance(source, (str, os.PathLike)):
+            self.name = os.fspath(source)
+            with open(self.name, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    # the mapping stays valid after the file is closed
+                    self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.mmap if self.mmap is not None else b"")
+        else:
+            self.name = "<memory>"
+            self.data = memoryview(source).cast("B")
+
+    @classmethod
+    def open(cls, source):
+        """`source` itself if it is an image already"""
+        if isinstance(source, cls):
+            return source
+        return cls(source)
+
+    def __len__(self):
+        return len(self.data)
+
+    def blocks(self, size):
+        """The image in blocks of `size` bytes"""
+        data = self.data
+        for offset in range(0, len(data), size):
+            yield data[offset : offset + size]
+
+    def close(self):
+        """Unmap the file, the mapping is left to the garbage collector
+        while blocks of it are still in use"""
+        if self.mmap is not None:
+            try:
+                self.data.release()
+                self.data = memoryview(b"")
+                self.mmap.close()
+            except BufferError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "FirmwareImage(%r, %d bytes)" % (self.name, len(self))
+
+
+# the most recently used images stay mapped
+SHARED_IMAGES = 4
+images = OrderedDict()
+images_lock = threading.Lock()
+
+
+def shared(path):
+    """Image of the file at `path` shared by all callers, it is mapped
+    again when the file changes"""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    old = []
+    with images_lock:
+        if path in images and images[path][0] != key:
+            old.append(images.pop(path)[1])
+        if path not in images:
+            images[path] = (key, FirmwareImage(path))
+        images.move_to_end(path)
+        while len(images) > SHARED_IMAGES:
+            old.append(images.popitem(last=False)[1][1])
+        image = images[path][1]
+    # uploads still sending blocks keep their mapping until they are done
+    for stale in old:
+        stale.close()
+    return image
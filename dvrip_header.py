@@ -0,0 +1,216 @@
+"""DVRIP packet headers.
+
+Every packet starts with a 20 byte header in host (little endian) order:
+
+    0   B  head, always 0xFF
+    1   B  version
+    4   I  session id
+    8   I  sequence number
+    12  B  media packets: fragment count
+    13  B  media packets: fragment number, upgrade end packet: flag
+    14  H  message id
+    16  I  payload length
+
+All modules pack and unpack through the structs compiled here.
+"""
+
+import struct
+from datetime import datetime
+
+HEADER_SIZE = 20
+HEADER = struct.Struct("BB2xII2xHI")  # head, version, session, sequence, msgid, length
+MEDIA_HEADER = struct.Struct("BB2xIIBBHI")  # ... sequence, total, cur, msgid, length
+END_HEADER = struct.Struct("BB2xIIxBHI")  # ... sequence, flag, msgid, length
+LENGTH = struct.Struct("I")  # payload length alone, at offset 16
+SEQUENCE = struct.Struct("I")  # sequence number alone, at offset 8
+# UDP discovery and network setup on port 34569
+SEARCH_HEADER = struct.Struct("BBHIIHHI")  # head, version, type, session, sequence, info, msgid, length
+
+# media frame headers, after the big endian data type
+DATA_TYPE = struct.Struct(">I")
+IFRAME = struct.Struct("BBBBII")  # media, fps, width / 8, height / 8, datetime, length
+PFRAME = struct.Struct("I")  # length
+AUDIO = struct.Struct("BBH")  # media, sample rate, length
+INFO = AUDIO  # media, n, length
+BITMAP = struct.Struct("HH12x")  # width, height
+
+# codec of (data type << 8 | media), the names are shared by all frames
+CODECS = {
+    0x1FC01: "mpeg4",
+    0x1FC02: "h264",
+    0x1FC03: "h265",
+    0x1F901: "info",
+    0x1F906: "info",
+    0x1FA0E: "g711a",
+    0x1FE00: "jpeg",
+}
+# data types whose header names the media
+MEDIA_TYPES = (0x1FC, 0x1FE, 0x1FA, 0x1F9)
+# data types that start a frame
+FRAME_TYPES = (0x1FC, 0x1FD, 0x1FA, 0x1F9, 0x1FE)
+JPEG_TYPES = (0xFFD8FFE0, 0xFFD8FFDB)
+# sample rate codes of the 0x1FA audio header
+AUDIO_RATES = {1: 4000, 2: 8000, 3: 11025, 4: 16000, 5: 20000, 6: 22050, 7: 32000, 8: 44100, 9: 48000}
+# start of an I-frame in a recording, where reading resumes after damage
+IFRAME_MARK = DATA_TYPE.pack(0x1FC)
+
+
+def decode_datetime(value):
+    """datetime of the packed camera time of I-frame headers"""
+    return datetime(
+        ((value & 0xFC000000) >> 26) + 2000,
+        (value & 0x3C00000) >> 22,
+        (value & 0x3E0000) >> 17,
+        (value & 0x1F000) >> 12,
+        (value & 0xFC0) >> 6,
+        value & 0x3F,
+    )
+
+
+class Header(object):
+    """Decoded packet header. Fragment fields are 0 outside of media packets,
+    `cur` holds the flag of the upgrade end packet."""
+
+    __slots__ = ("version", "session", "sequence", "total", "cur", "msgid", "length")
+
+    def __init__(self, version=0, session=0, sequence=0, msgid=0, length=0, total=0, cur=0):
+        self.version = version
+        self.session = session
+        self.sequence = sequence
+        self.total = total
+        self.cur = cur
+        self.msgid = msgid
+        self.length = length
+
+    @classmethod
+    def unpack(cls, data, offset=0):
+        (
+            head,
+            version,
+            session,
+            sequence,
+            total,
+            cur,
+            msgid,
+            length,
+        ) = MEDIA_HEADER.unpack_from(data, offset)
+        return cls(version, session, sequence, msgid, length, total, cur)
+
+    def __repr__(self):
+        return "Header(%s)" % ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__
+        )
+
+
+class Frame(object):
+    """One reassembled media frame, `data` is the payload without the
+    frame header.
+
+    `kind` is "I" or "P" for video frames and None otherwise, `codec` a
+    name of CODECS (P-frames get the one of the last I-frame). I-frame and
+    JPEG headers add fps, width, height and the packed camera time
+    `timestamp`, which the `datetime` property decodes on access. Audio
+    frames keep the sample rate code of their header in `rate`, see
+    AUDIO_RATES. `pts` is set by a dvrip_pts.PTSClock."""
+
+    __slots__ = ("data_type", "kind", "codec", "fps", "width", "height", "timestamp", "rate", "data", "pts")
+
+    def __init__(self, data_type, kind=None, codec=None, fps=0, width=0, height=0, timestamp=None, rate=0, data=None):
+        self.data_type = data_type
+        self.kind = kind
+        self.codec = codec
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.timestamp = timestamp
+        self.rate = rate
+        self.data = data
+        self.pts = None
+
+    @property
+    def datetime(self):
+        if self.timestamp is None:
+            return None
+        try:
+            return decode_datetime(self.timestamp)
+        except ValueError:
+            # the camera clock is not set
+            return None
+
+    def meta(self):
+        """The metadata dict of the (frame, meta, user) callbacks"""
+        meta = {}
+        if self.timestamp is not None:
+            meta["fps"] = self.fps
+            meta["width"] = self.width
+            meta["height"] = self.height
+            meta["datetime"] = self.datetime
+        if self.kind is not None:
+            meta["frame"] = self.kind
+        if self.data_type in MEDIA_TYPES:
+            meta["type"] = self.codec
+        if self.pts is not None:
+            meta["pts"] = self.pts
+        return meta
+
+    def __repr__(self):
+        return "Frame(%#x, %s, %s, %d bytes)" % (self.data_type, self.kind, self.codec, len(self.data or b""))
+
+
+def frame_start(packet, codec=None, offset=0):
+    """(Frame, header size, payload length) of the first packet of a
+    frame. The payload length is None for a JPEG snapshot, the packet is
+    the whole picture then. `codec` is the codec of P-frames."""
+    (data_type,) = DATA_TYPE.unpack_from(packet, offset)
+    offset += 4
+    if data_type == 0x1FC or data_type == 0x1FE:
+        media, fps, w, h, dt, length = IFRAME.unpack_from(packet, offset)
+        frame = Frame(data_type, "I" if data_type == 0x1FC else None, CODECS.get(data_type << 8 | media), fps, w * 8, h * 8, dt)
+        return frame, 16, length
+    if data_type == 0x1FD:
+        (length,) = PFRAME.unpack_from(packet, offset)
+        return Frame(data_type, "P", codec), 8, length
+    if data_type == 0x1FA:
+        media, rate, length = AUDIO.unpack_from(packet, offset)
+        return Frame(data_type, None, CODECS.get(data_type << 8 | media), rate=rate), 8, length
+    if data_type == 0x1F9:
+        media, n, length = INFO.unpack_from(packet, offset)
+        return Frame(data_type, None, CODECS.get(data_type << 8 | media)), 8, length
+    if data_type in JPEG_TYPES:
+        return Frame(data_type, None, "jpeg"), 0, None
+    raise ValueError(data_type)
+
+
+def iter_frames(data, start=0, end=None):
+    """(offset, Frame) of every frame of a recording as stored on the
+    device, e.g. a download_file() result or an mmap of one, from offset
+    `start` to `end`. Frame data are memoryviews of `data`, nothing is
+    copied. Damaged parts are skipped up to the next I-frame, a truncated
+    last frame ends the iteration."""
+    view = memoryview(data).cast("B")
+    if end is None:
+        end = len(view)
+    offset = start
+    codec = None
+    while offset + 8 <= end:
+        try:
+            frame, size, length = frame_start(view, codec, offset)
+        except (ValueError, struct.error):
+            length = None
+        if length is None:
+            if hasattr(data, "find"):
+                offset = data.find(IFRAME_MARK, offset + 1, end)
+            else:
+                found = bytes(view[offset + 1 : end]).find(IFRAME_MARK)
+                offset = offset + 1 + found if found >= 0 else -1
+            if offset < 0:
+                return
+            continue
+        start = offset + size
+        if start + length > end:
+            return
+        if frame.kind == "I":
+            codec = frame.codec
+        frame.data = view[start : start + length]
+        yield offset, frame
+        offset = start + length
@@ -0,0 +1,165 @@
+from datetime import datetime
+from time import monotonic
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class StreamHealth(object):
+    """Health of one stream of DVRIPCam.start_monitor(health=...).
+
+    The stream is stalled when no frame starts within `stall_timeout`
+    seconds, or three frame intervals of the announced fps if longer. The
+    monitor then claims the stream again on the same session, up to
+    `reclaims` times in a row, before it reconnects.
+
+    Every second of frames is checked for:
+    - FPSDrop: fewer video frames than `fps_ratio` times the camera fps
+    - Bitrate: bytes `bitrate_ratio` times above or below the average
+    - TimeJump: the I-frame datetime moving more than `jump` seconds
+      against the arrival time
+
+    Events go to `callback` in the AlarmFilter message layout ("Camera",
+    "Channel", "Event", "Status", "StartTime"); Stall, FPSDrop and Bitrate
+    have a Start and a Stop, TimeJump is a single message."""
+
+    def __init__(
+        self,
+        callback=None,
+        camera="",
+        stall_timeout=1.0,
+        reclaims=2,
+        fps_ratio=0.5,
+        bitrate_ratio=4.0,
+        jump=5,
+        clock=monotonic,
+    ):
+        self.callback = callback
+        self.camera = camera
+        self.stall_timeout = stall_timeout
+        self.reclaims = reclaims
+        self.fps_ratio = fps_ratio
+        self.bitrate_ratio = bitrate_ratio
+        self.jump = jump
+        self.clock = clock
+        self.metrics = None  # SessionMetrics, set by start_monitor
+        self.fps = 0  # announced by the camera
+        self.measured_fps = 0.0
+        self.bitrate = 0.0  # bytes per second of the last second
+        self.average = None  # smoothed bitrate
+        self.window_start = None
+        self.video = 0
+        self.bytes = 0
+        self.windows = 0
+        self.offset = None  # camera time - arrival time
+        self.last_frame = None
+        self.attempts = 0
+        self.active = {}  # event -> StartTime
+        self.counts = {"Stall": 0, "Reclaim": 0, "FPSDrop": 0, "Bitrate": 0, "TimeJump": 0}
+
+    def timeout(self):
+        """Seconds to wait for the next frame"""
+        if self.fps:
+            return max(self.stall_timeout, 3.0 / self.fps)
+        return self.stall_timeout
+
+    def stall(self):
+        """No frame in time. True when the stream should be claimed again,
+        False when the session should be reconnected."""
+        if "Stall" not in self.active:
+            self.start("Stall")
+            if self.metrics is not None:
+                self.metrics.stall()
+        # a new window starts with the next frame
+        self.window_start = None
+        self.video = self.bytes = 0
+        if self.attempts < self.reclaims:
+            self.attempts += 1
+            self.counts["Reclaim"] += 1
+            if self.metrics is not None:
+                self.metrics.reclaim()
+            return True
+        self.attempts = 0
+        return False
+
+    def frame(self, frame):
+        """Check one reassembled Frame"""
+        now = self.clock()
+        self.last_frame = now
+        if "Stall" in self.active:
+            self.attempts = 0
+            self.stop("Stall")
+        if self.window_start is None:
+            self.window_start = now
+        elif now - self.window_start >= 1:
+            self.evaluate(now - self.window_start)
+            self.window_start = now
+            self.video = self.bytes = 0
+        if frame.kind is not None:
+            self.video += 1
+        self.bytes += len(frame.data)
+        if frame.kind == "I":
+            self.fps = frame.fps
+        camera_time = frame.datetime if frame.kind == "I" else None
+        if camera_time is not None:
+            offset = camera_time.timestamp() - now
+            if self.offset is not None and abs(offset - self.offset) > self.jump:
+                self.emit("TimeJump", "", {"Jump": round(offset - self.offset)})
+            self.offset = offset
+
+    def evaluate(self, elapsed):
+        self.windows += 1
+        self.measured_fps = self.video / elapsed
+        self.bitrate = self.bytes / elapsed
+        if self.fps and self.windows > 1:
+            self.condition("FPSDrop", self.measured_fps < self.fps * self.fps_ratio)
+        if self.average is None:
+            self.average = self.bitrate
+            return
+        ratio = self.bitrate / self.average if self.average else 1
+        anomaly = self.windows > 3 and not 1 / self.bitrate_ratio <= ratio <= self.bitrate_ratio
+        self.condition("Bitrate", anomaly)
+        if not anomaly:
+            self.average += 0.2 * (self.bitrate - self.average)
+
+    def condition(self, event, present):
+        if present and event not in self.active:
+            self.start(event)
+        elif not present and event in self.active:
+            self.stop(event)
+
+    def start(self, event):
+        self.active[event] = datetime.now().strftime(DATE_FORMAT)
+        self.emit(event, "Start")
+
+    def stop(self, event):
+        self.emit(event, "Stop", {"StopTime": datetime.now().strftime(DATE_FORMAT)})
+        del self.active[event]
+
+    def emit(self, event, status, extra=None):
+        if status != "Stop":
+            self.counts[event] += 1
+            if self.metrics is not None and event != "Stall":
+                self.metrics.anomaly(event)
+        if self.callback is None:
+            return
+        msg = {
+            "Camera": self.camera,
+            "Channel": 0,
+            "Event": event,
+            "Status": status,
+            "StartTime": self.active.get(event, datetime.now().strftime(DATE_FORMAT)),
+        }
+        if extra:
+            msg.update(extra)
+        self.callback(msg)
+
+    def as_dict(self):
+        return {
+            "fps": self.fps,
+            "measured_fps": self.measured_fps,
+            "bitrate": self.bitrate * 8,
+            "average_bitrate": (self.average or 0) * 8,
+            "stalled": "Stall" in self.active,
+            "active": sorted(self.active),
+            "counts": dict(self.counts),
+        }
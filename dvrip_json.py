@@ -0,0 +1,82 @@
+"""JSON codec of the DVRIP command channel.
+
+orjson or ujson are used when installed, the json module otherwise. Switch
+with use("json"), call dumps() and loads() through this module so the
+switch applies everywhere.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# control characters some firmwares leave in strings, tab, LF and CR stay
+CONTROL_CHARS = bytes(c for c in range(32) if c not in (9, 10, 13))
+
+
+def std_dumps(obj, compact=False):
+    separators = (",", ":") if compact else None
+    return json.dumps(obj, ensure_ascii=False, separators=separators).encode("utf-8")
+
+
+def std_loads(data):
+    if isinstance(data, memoryview):
+        # decodes straight from the buffer, json.loads() takes no memoryview
+        data = str(data, "utf-8")
+    return json.loads(data)
+
+
+def orjson_dumps(obj, compact=False):
+    # always compact
+    return orjson.dumps(obj)
+
+
+def orjson_loads(data):
+    return orjson.loads(data)
+
+
+def ujson_dumps(obj, compact=False):
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+
+
+def ujson_loads(data):
+    if isinstance(data, memoryview):
+        data = str(data, "utf-8")
+    return ujson.loads(data)
+
+
+backends = {"json": (std_dumps, std_loads)}
+if ujson is not None:
+    backends["ujson"] = (ujson_dumps, ujson_loads)
+if orjson is not None:
+    backends["orjson"] = (orjson_dumps, orjson_loads)
+
+
+def use(name):
+    """Select the backend by name, see `backends`"""
+    global backend, dumps, loads
+    dumps, loads = backends[name]
+    backend = name
+
+
+use("orjson" if orjson is not None else "ujson" if ujson is not None else "json")
+
+
+def sanitize(data):
+    """`data` without control characters, in one pass over the buffer"""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return data.translate(None, CONTROL_CHARS)
+
+
+def loads_lenient(data):
+    """Parse a reply the strict parsers reject: control characters are
+    dropped and invalid UTF-8 is read as latin1."""
+    return json.loads(sanitize(data).decode("latin1"), strict=False)
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import weakref
+from time import monotonic
+
+
+class KeepaliveScheduler(object):
+    """Keepalives of all DVRIPCam sessions from one scheduler thread.
+
+    Sessions wait in a heap ordered by due time. The keepalive is skipped
+    while a request got its reply within the last alive interval, that
+    traffic has refreshed the session already. Due keepalives are sent by
+    `workers` daemon threads, so a camera that does not answer holds up
+    one worker instead of every other session.
+
+    A session is scheduled by storing the returned entry in `cam.alive`,
+    setting `cam.alive` to anything else drops it."""
+
+    def __init__(self, workers=4):
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.due = queue.Queue()
+        self.thread = None
+
+    def add(self, cam, delay=None):
+        if delay is None:
+            delay = cam.alive_time
+        entry = [monotonic() + delay, next(self.counter), cam]
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(name="DVRKeepalive", target=self.run, daemon=True)
+                self.thread.start()
+                for i in range(self.workers):
+                    threading.Thread(name="DVRKeepalive%d" % i, target=self.work, daemon=True).start()
+            self.push(entry)
+        return entry
+
+    def push(self, entry):
+        with self.lock:
+            heapq.heappush(self.heap, entry)
+            if self.heap[0] is entry:
+                self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.heap or self.heap[0][0] > monotonic():
+                    self.lock.wait(self.heap[0][0] - monotonic() if self.heap else None)
+                entry = heapq.heappop(self.heap)
+            cam = entry[2]
+            if cam.alive is not entry:
+                # closed or scheduled again by a new login
+                continue
+            if monotonic() - cam.last_reply < cam.alive_time:
+                entry[0] = cam.last_reply + cam.alive_time
+                self.push(entry)
+                continue
+            self.due.put(entry)
+
+    def work(self):
+        while True:
+            entry = self.due.get()
+            cam = entry[2]
+            try:
+                alive = cam.keep_alive()
+            except Exception:
+                self.logger.exception("Keepalive of %s failed", cam.ip)
+                alive = False
+            if alive and cam.alive is entry:
+                entry[0] = monotonic() + cam.alive_time
+                self.push(entry)
+
+
+class AsyncKeepaliveScheduler(object):
+    """The same for asyncio_dvrip sessions, one task per event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def add(self, cam, delay=None):
+        if delay is None:
+            delay = cam.alive_time
+        entry = [monotonic() + delay, next(self.counter), cam]
+        self.push(entry)
+        if self.task is None:
+            self.task = self.loop.create_task(self.run())
+        return entry
+
+    def push(self, entry):
+        heapq.heappush(self.heap, entry)
+        if self.heap[0] is entry:
+            self.wakeup.set()
+
+    async def run(self):
+        while self.heap:
+            delay = self.heap[0][0] - monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            entry = heapq.heappop(self.heap)
+            cam = entry[2]
+            if cam.alive is not entry:
+                continue
+            if monotonic() - cam.last_reply < cam.alive_time:
+                entry[0] = cam.last_reply + cam.alive_time
+                self.push(entry)
+                continue
+            self.loop.create_task(self.keepalive(entry))
+        self.task = None
+
+    async def keepalive(self, entry):
+        cam = entry[2]
+        if await cam.keep_alive_once() and cam.alive is entry:
+            entry[0] = monotonic() + cam.alive_time
+            self.push(entry)
+            if self.task is None:
+                self.task = self.loop.create_task(self.run())
+
+
+scheduler = KeepaliveScheduler()
+async_schedulers = weakref.WeakKeyDictionary()
+
+
+def async_scheduler(loop):
+    """Scheduler of the event loop `loop`"""
+    if loop not in async_schedulers:
+        async_schedulers[loop] = AsyncKeepaliveScheduler(loop)
+    return async_schedulers[loop]
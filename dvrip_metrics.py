@@ -0,0 +1,260 @@
+import threading
+import weakref
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REASSEMBLY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# every live SessionMetrics, for the exporter
+sessions = weakref.WeakSet()
+
+
+class Histogram(object):
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class SessionMetrics(object):
+    """Counters and histograms of one camera session.
+
+    Updates are a few integer operations without locks, so they can stay on
+    in production; a concurrent update may rarely be lost. Hooks are called
+    as hook(event, metrics, value) for "request", "frame", "timeout",
+    "keepalive_miss", "reconnect", "error", "stall", "reclaim" and
+    "anomaly" events."""
+
+    def __init__(self, ip="", port=0, window=10):
+        self.labels = {"ip": str(ip), "port": str(port)}
+        self.window = window
+        self.requests = {}  # msgid -> Histogram of round trip time
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.reassembly = Histogram(REASSEMBLY_BUCKETS)
+        self.keepalive_misses = 0
+        self.reconnects = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.datagrams_lost = 0
+        self.retransmits = 0
+        self.stalls = 0
+        self.reclaims = 0
+        self.anomalies = 0
+        self.frame_buckets = deque([[0, 0]], maxlen=window + 1)
+        self.hooks = []
+        sessions.add(self)
+
+    def add_hook(self, func):
+        self.hooks.append(func)
+
+    def remove_hook(self, func):
+        self.hooks.remove(func)
+
+    def fire(self, event, value=None):
+        for hook in self.hooks:
+            hook(event, self, value)
+
+    def request(self, msgid, latency):
+        histogram = self.requests.get(msgid)
+        if histogram is None:
+            histogram = self.requests[msgid] = Histogram()
+        histogram.observe(latency)
+        if self.hooks:
+            self.fire("request", (msgid, latency))
+
+    def frame(self, size, elapsed):
+        self.frames += 1
+        self.frame_bytes += size
+        self.reassembly.observe(elapsed)
+        second = int(monotonic())
+        bucket = self.frame_buckets[-1]
+        if bucket[0] == second:
+            bucket[1] += 1
+        else:
+            self.frame_buckets.append([second, 1])
+        if self.hooks:
+            self.fire("frame", (size, elapsed))
+
+    def timeout(self):
+        self.timeouts += 1
+        if self.hooks:
+            self.fire("timeout")
+
+    def keepalive_miss(self):
+        self.keepalive_misses += 1
+        if self.hooks:
+            self.fire("keepalive_miss")
+
+    def reconnect(self):
+        self.reconnects += 1
+        if self.hooks:
+            self.fire("reconnect")
+
+    def error(self, error):
+        self.errors += 1
+        if self.hooks:
+            self.fire("error", error)
+
+    def stall(self):
+        self.stalls += 1
+        if self.hooks:
+            self.fire("stall")
+
+    def reclaim(self):
+        self.reclaims += 1
+        if self.hooks:
+            self.fire("reclaim")
+
+    def anomaly(self, event):
+        self.anomalies += 1
+        if self.hooks:
+            self.fire("anomaly", event)
+
+    def frames_per_sec(self):
+        now = int(monotonic())
+        count = sum(n for second, n in self.frame_buckets if 0 < now - second <= self.window)
+        return count / self.window
+
+    def as_dict(self):
+        return {
+            "labels": dict(self.labels),
+            "requests": {msgid: h.as_dict() for msgid, h in self.requests.items()},
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "frames": self.frames,
+            "frame_bytes": self.frame_bytes,
+            "frames_per_sec": self.frames_per_sec(),
+            "reassembly": self.reassembly.as_dict(),
+            "keepalive_misses": self.keepalive_misses,
+            "reconnects": self.reconnects,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "datagrams_lost": self.datagrams_lost,
+            "retransmits": self.retransmits,
+            "stalls": self.stalls,
+            "reclaims": self.reclaims,
+            "anomalies": self.anomalies,
+        }
+
+
+def format_labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in items
+    )
+
+
+def format_histogram(lines, name, labels, histogram, **extra):
+    cumulative = 0
+    for bound, n in zip(histogram.bounds + (float("inf"),), histogram.counts):
+        cumulative += n
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append("%s_bucket%s %d" % (name, format_labels(labels, le=le, **extra), cumulative))
+    lines.append("%s_sum%s %r" % (name, format_labels(labels, **extra), histogram.sum))
+    lines.append("%s_count%s %d" % (name, format_labels(labels, **extra), histogram.count))
+
+
+COUNTERS = (
+    ("dvrip_received_bytes", "bytes_in", "Bytes received from the camera"),
+    ("dvrip_sent_bytes", "bytes_out", "Bytes sent to the camera"),
+    ("dvrip_frames", "frames", "Media frames reassembled"),
+    ("dvrip_frame_bytes", "frame_bytes", "Media payload bytes reassembled"),
+    ("dvrip_keepalive_misses", "keepalive_misses", "Keepalives without reply"),
+    ("dvrip_reconnects", "reconnects", "Reconnects after a lost session"),
+    ("dvrip_timeouts", "timeouts", "Receive timeouts"),
+    ("dvrip_errors", "errors", "Socket errors"),
+    ("dvrip_datagrams_lost", "datagrams_lost", "UDP datagrams never received"),
+    ("dvrip_retransmits", "retransmits", "UDP requests sent again"),
+    ("dvrip_stream_stalls", "stalls", "Monitored streams that stopped sending frames"),
+    ("dvrip_stream_reclaims", "reclaims", "Streams claimed again after a stall"),
+    ("dvrip_stream_anomalies", "anomalies", "Frame rate drops, camera clock jumps and bitrate anomalies"),
+)
+
+
+def exposition(metrics=None, openmetrics=False):
+    """Prometheus text format (or OpenMetrics) of `metrics`, all sessions by default"""
+    if metrics is None:
+        metrics = list(sessions)
+    lines = []
+    for name, attr, help in COUNTERS:
+        # OpenMetrics names the counter family without the _total suffix
+        family = name if openmetrics else name + "_total"
+        lines.append("# HELP %s %s" % (family, help))
+        lines.append("# TYPE %s counter" % family)
+        for m in metrics:
+            lines.append("%s_total%s %d" % (name, format_labels(m.labels), getattr(m, attr)))
+    lines.append("# HELP dvrip_frames_per_second Frame rate over the last seconds")
+    lines.append("# TYPE dvrip_frames_per_second gauge")
+    for m in metrics:
+        lines.append("dvrip_frames_per_second%s %r" % (format_labels(m.labels), m.frames_per_sec()))
+    lines.append("# HELP dvrip_request_seconds Request round trip time")
+    lines.append("# TYPE dvrip_request_seconds histogram")
+    for m in metrics:
+        for msgid, histogram in sorted(m.requests.items()):
+            format_histogram(lines, "dvrip_request_seconds", m.labels, histogram, msgid=msgid)
+    lines.append("# HELP dvrip_reassembly_seconds Time from first to last packet of a frame")
+    lines.append("# TYPE dvrip_reassembly_seconds histogram")
+    for m in metrics:
+        format_histogram(lines, "dvrip_reassembly_seconds", m.labels, m.reassembly)
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+        body = exposition(openmetrics=openmetrics).encode()
+        self.send_response(200)
+        if openmetrics:
+            self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+        else:
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=9108, host=""):
+    """Export all sessions over HTTP from a daemon thread, returns the server"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,458 @@
+"""H.264 and H.265 Annex B bitstreams.
+
+Camera frames and the .video files of monitor.py are Annex B: NAL units
+behind 00 00 01 or 00 00 00 01 start codes. Start codes are found with one
+regular expression over the buffer, which may be bytes, a bytearray, an
+mmap or a memoryview of them; only parameter sets are copied. Slices are
+never parsed, keyframes and picture starts are told by the first bytes of
+their NAL units.
+"""
+
+import re
+import struct
+
+START_CODE = re.compile(b"\x00\x00\x01")
+
+# NAL unit types
+H264_IDR = 5
+H264_SEI = 6
+H264_SPS = 7
+H264_PPS = 8
+H264_AUD = 9
+H265_VPS = 32
+H265_SPS = 33
+H265_PPS = 34
+H265_AUD = 35
+H265_SEI = 39
+# types that open a new access unit before its first slice
+AU_START = {
+    "h264": (H264_SEI, H264_SPS, H264_PPS, H264_AUD),
+    "h265": (H265_VPS, H265_SPS, H265_PPS, H265_AUD, H265_SEI),
+}
+# profiles whose avcC ends with chroma format and bit depths
+H264_HIGH_PROFILES = (100, 110, 122, 144)
+
+
+def nal_type(data, pos, codec):
+    if codec == "h265":
+        return (data[pos] >> 1) & 0x3F
+    return data[pos] & 0x1F
+
+
+def is_vcl(kind, codec):
+    if codec == "h265":
+        return kind < 32
+    return 1 <= kind <= 5
+
+
+def is_keyframe(kind, codec):
+    """IDR picture, for H.265 any random access point (BLA, IDR, CRA)"""
+    if codec == "h265":
+        return 16 <= kind <= 23
+    return kind == H264_IDR
+
+
+def first_slice(data, pos, codec):
+    """The slice at `pos` starts a picture: first_mb_in_slice is 0 or
+    first_slice_segment_in_pic_flag is set, both the first bit after the
+    NAL header"""
+    if codec == "h265":
+        return bool(data[pos + 2] & 0x80)
+    return bool(data[pos + 1] & 0x80)
+
+
+def nal_units(data, codec="h264", start=0, end=None):
+    """(offset, start, end, type) of every NAL unit of `data` between
+    `start` and `end`: offset of its start code, then the NAL unit itself
+    without trailing zeros"""
+    if end is None:
+        end = len(data)
+    pos = None
+    for m in START_CODE.finditer(data, start, end):
+        code = m.start()
+        if code > start and data[code - 1] == 0:
+            code -= 1
+        if pos is not None:
+            yield offset, pos, trim(data, pos, code), nal_type(data, pos, codec)
+        offset = code
+        pos = m.end()
+    if pos is not None and pos < end:
+        yield offset, pos, trim(data, pos, end), nal_type(data, pos, codec)
+
+
+def trim(data, pos, stop):
+    while stop > pos and data[stop - 1] == 0:
+        stop -= 1
+    return stop
+
+
+def access_units(data, codec="h264", start=0, end=None):
+    """(offset, keyframe) of every picture. The offset is the start code of
+    the first NAL unit of its access unit, delimiter, SEI or parameter
+    sets, so a keyframe can be cut there and decoded on its own."""
+    opening = AU_START[codec]
+    first = None
+    for offset, pos, stop, kind in nal_units(data, codec, start, end):
+        if is_vcl(kind, codec):
+            if stop - pos > 2 and first_slice(data, pos, codec):
+                yield (offset if first is None else first), is_keyframe(kind, codec)
+            first = None
+        elif first is None and kind in opening:
+            first = offset
+
+
+def guess_codec(data, start=0, end=None):
+    """"h264" or "h265" by the header of the first NAL unit, None when
+    `data` does not look like Annex B"""
+    if end is None:
+        end = len(data)
+    m = START_CODE.search(data, start, end)
+    if m is None or m.end() + 1 >= end:
+        return None
+    pos = m.end()
+    if data[pos + 1] == 1 and H265_VPS <= nal_type(data, pos, "h265") <= H265_AUD:
+        return "h265"
+    if not data[pos] & 0x80 and 1 <= nal_type(data, pos, "h264") <= H264_AUD:
+        return "h264"
+    return None
+
+
+def parameter_sets(data, codec="h264", start=0, end=None):
+    """(vps, sps, pps, keyframe) of a frame, the first NAL unit of each
+    kind as bytes or None. Scanning stops at the first slice, so P-frames
+    cost one start code search."""
+    if end is None:
+        end = len(data)
+    found = {}
+    pos = None
+    for m in START_CODE.finditer(data, start, end):
+        if pos is not None and kind not in found:
+            found[kind] = bytes(data[pos : trim(data, pos, m.start())])
+        pos = m.end()
+        if pos >= end:
+            kind = None
+            break
+        kind = nal_type(data, pos, codec)
+        if is_vcl(kind, codec):
+            break
+    else:
+        if pos is not None and pos < end and kind not in found:
+            found[kind] = bytes(data[pos : trim(data, pos, end)])
+        kind = None
+    if codec == "h265":
+        vps, sps, pps = found.get(H265_VPS), found.get(H265_SPS), found.get(H265_PPS)
+    else:
+        vps, sps, pps = None, found.get(H264_SPS), found.get(H264_PPS)
+    return vps, sps, pps, kind is not None and is_keyframe(kind, codec)
+
+
+class BitReader(object):
+    """Reads the RBSP of a NAL unit, emulation prevention bytes removed"""
+
+    def __init__(self, nal, skip=0):
+        data = bytes(nal[skip:]).replace(b"\x00\x00\x03", b"\x00\x00")
+        self.value = int.from_bytes(data, "big")
+        self.left = len(data) * 8
+
+    def u(self, n):
+        self.left -= n
+        if self.left < 0:
+            raise ValueError("NAL unit too short")
+        return (self.value >> self.left) & ((1 << n) - 1)
+
+    def ue(self):
+        zeros = 0
+        while not self.u(1):
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Exp-Golomb code too long")
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        k = self.ue()
+        return (k + 1) // 2 if k & 1 else -(k // 2)
+
+
+def skip_scaling_list(r, size):
+    last = scale = 8
+    for j in range(size):
+        if scale:
+            scale = (last + r.se()) % 256
+        last = scale or last
+
+
+def parse_h264_sps(nal):
+    """Fields of an H.264 SPS NAL unit, with the cropped picture size"""
+    r = BitReader(nal, 1)
+    info = {"profile": r.u(8), "constraints": r.u(8), "level": r.u(8), "sps_id": r.ue()}
+    chroma = 1
+    depth = depth_chroma = 8
+    if info["profile"] in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma = r.ue()
+        if chroma == 3:
+            r.u(1)  # separate_colour_plane_flag
+        depth = r.ue() + 8
+        depth_chroma = r.ue() + 8
+        r.u(1)  # qpprime_y_zero_transform_bypass_flag
+        if r.u(1):
+            for i in range(8 if chroma != 3 else 12):
+                if r.u(1):
+                    skip_scaling_list(r, 16 if i < 6 else 64)
+    r.ue()  # log2_max_frame_num_minus4
+    poc_type = r.ue()
+    if poc_type == 0:
+        r.ue()
+    elif poc_type == 1:
+        r.u(1)
+        r.se()
+        r.se()
+        for i in range(r.ue()):
+            r.se()
+    info["ref_frames"] = r.ue()
+    r.u(1)  # gaps_in_frame_num_value_allowed_flag
+    mbs_w = r.ue() + 1
+    map_units_h = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.u(1)  # mb_adaptive_frame_field_flag
+    r.u(1)  # direct_8x8_inference_flag
+    crop = (0, 0, 0, 0)
+    if r.u(1):
+        crop = (r.ue(), r.ue(), r.ue(), r.ue())
+    # crop units of 4:2:0, 4:2:2 and 4:4:4 / monochrome
+    unit_x = 2 if chroma in (1, 2) else 1
+    unit_y = (2 if chroma == 1 else 1) * (2 - frame_mbs_only)
+    info["width"] = mbs_w * 16 - unit_x * (crop[0] + crop[1])
+    info["height"] = (2 - frame_mbs_only) * map_units_h * 16 - unit_y * (crop[2] + crop[3])
+    info["interlaced"] = not frame_mbs_only
+    info["chroma_format"] = chroma
+    info["bit_depth"] = depth
+    info["bit_depth_chroma"] = depth_chroma
+    info["fps"] = None
+    if r.u(1):
+        parse_h264_vui(r, info)
+    return info
+
+
+def parse_h264_vui(r, info):
+    if r.u(1):  # aspect_ratio_info_present_flag
+        if r.u(8) == 255:
+            info["sar"] = (r.u(16), r.u(16))
+    if r.u(1):  # overscan_info_present_flag
+        r.u(1)
+    if r.u(1):  # video_signal_type_present_flag
+        r.u(3)
+        info["full_range"] = bool(r.u(1))
+        if r.u(1):
+            r.u(24)  # colour primaries, transfer, matrix
+    if r.u(1):  # chroma_loc_info_present_flag
+        r.ue()
+        r.ue()
+    if r.u(1):  # timing_info_present_flag
+        units, scale = r.u(32), r.u(32)
+        if units:
+            info["fps"] = scale / (2.0 * units)
+
+
+def parse_h265_ptl(r, sub_layers, info):
+    info["profile_space"] = r.u(2)
+    info["tier"] = r.u(1)
+    info["profile"] = r.u(5)
+    info["compatibility"] = r.u(32)
+    info["constraints"] = r.u(48)
+    info["level"] = r.u(8)
+    present = [(r.u(1), r.u(1)) for i in range(sub_layers)]
+    if sub_layers:
+        r.u(2 * (8 - sub_layers))
+    for profile, level in present:
+        if profile:
+            r.u(88)
+        if level:
+            r.u(8)
+
+
+def parse_h265_sps(nal):
+    """Fields of an H.265 SPS NAL unit, with the cropped picture size"""
+    r = BitReader(nal, 2)
+    r.u(4)  # sps_video_parameter_set_id
+    sub_layers = r.u(3)
+    info = {"sub_layers": sub_layers + 1, "temporal_id_nesting": r.u(1)}
+    parse_h265_ptl(r, sub_layers, info)
+    info["sps_id"] = r.ue()
+    chroma = r.ue()
+    if chroma == 3:
+        r.u(1)  # separate_colour_plane_flag
+    width = r.ue()
+    height = r.ue()
+    if r.u(1):
+        left, right, top, bottom = r.ue(), r.ue(), r.ue(), r.ue()
+        width -= (2 if chroma in (1, 2) else 1) * (left + right)
+        height -= (2 if chroma == 1 else 1) * (top + bottom)
+    info["width"] = width
+    info["height"] = height
+    info["interlaced"] = False
+    info["chroma_format"] = chroma
+    info["bit_depth"] = r.ue() + 8
+    info["bit_depth_chroma"] = r.ue() + 8
+    # the frame rate is in the VUI, behind the reference picture sets
+    info["fps"] = None
+    return info
+
+
+def parse_pps(nal, codec="h264"):
+    """{"pps_id", "sps_id"} of a PPS NAL unit"""
+    r = BitReader(nal, 2 if codec == "h265" else 1)
+    return {"pps_id": r.ue(), "sps_id": r.ue()}
+
+
+class CodecConfig(object):
+    """Parameter sets of an H.264 or H.265 stream and what they say.
+    `vps`, `sps` and `pps` are NAL units without start codes, the other
+    fields of the SPS are in `info`."""
+
+    __slots__ = ("codec", "vps", "sps", "pps", "width", "height", "profile", "level", "fps", "info")
+
+    def __init__(self, codec, sps, pps, vps=None):
+        self.codec = codec
+        self.vps = vps
+        self.sps = sps
+        self.pps = pps
+        self.info = parse_h265_sps(sps) if codec == "h265" else parse_h264_sps(sps)
+        self.info.update(parse_pps(pps, codec))
+        self.width = self.info["width"]
+        self.height = self.info["height"]
+        self.profile = self.info["profile"]
+        self.level = self.info["level"]
+        self.fps = self.info["fps"]
+
+    @classmethod
+    def from_frame(cls, data, codec="h264"):
+        """Config of a keyframe, None when its parameter sets are missing"""
+        vps, sps, pps, keyframe = parameter_sets(data, codec)
+        if sps is None or pps is None or (codec == "h265" and vps is None):
+            return None
+        return cls(codec, sps, pps, vps)
+
+    def same(self, vps, sps, pps):
+        return sps == self.sps and pps == self.pps and vps == self.vps
+
+    def record(self):
+        """avcC or hvcC decoder configuration record, the sample entry
+        box payload of MP4 and Matroska CodecPrivate"""
+        if self.codec == "h265":
+            return self.hvcc()
+        return self.avcc()
+
+    def avcc(self):
+        sps, pps = self.sps, self.pps
+        out = bytearray(b"\x01" + sps[1:4] + b"\xff\xe1")
+        out += struct.pack(">H", len(sps)) + sps
+        out += b"\x01" + struct.pack(">H", len(pps)) + pps
+        if self.profile in H264_HIGH_PROFILES:
+            info = self.info
+            out += bytes(
+                (
+                    0xFC | info["chroma_format"],
+                    0xF8 | (info["bit_depth"] - 8),
+                    0xF8 | (info["bit_depth_chroma"] - 8),
+                    0,  # numOfSequenceParameterSetExt
+                )
+            )
+        return bytes(out)
+
+    def hvcc(self):
+        info = self.info
+        constraints = info["constraints"]
+        out = bytearray(
+            struct.pack(
+                ">BBIHIBHBBBBHB",
+                1,
+                info["profile_space"] << 6 | info["tier"] << 5 | info["profile"],
+                info["compatibility"],
+                constraints >> 32,
+                constraints & 0xFFFFFFFF,
+                self.level,
+                0xF000,  # min_spatial_segmentation_idc
+                0xFC,  # parallelismType
+                0xFC | info["chroma_format"],
+                0xF8 | (info["bit_depth"] - 8),
+                0xF8 | (info["bit_depth_chroma"] - 8),
+                0,  # avgFrameRate
+                info["sub_layers"] << 3 | info["temporal_id_nesting"] << 2 | 3,
+            )
+        )
+        out.append(3)
+        for kind, nal in ((H265_VPS, self.vps), (H265_SPS, self.sps), (H265_PPS, self.pps)):
+            out += struct.pack(">BHH", 0x80 | kind, 1, len(nal)) + nal
+        return bytes(out)
+
+    def codec_string(self):
+        """RFC 6381 codecs parameter, e.g. avc1.4D0028 or hvc1.1.6.L93.90"""
+        if self.codec != "h265":
+            return "avc1.%02X%02X%02X" % tuple(self.sps[1:4])
+        info = self.info
+        compatibility = int("{:032b}".format(info["compatibility"])[::-1], 2)
+        constraints = info["constraints"].to_bytes(6, "big").rstrip(b"\x00")
+        return "hvc1.%s%d.%X.%s%d%s" % (
+            ("", "A", "B", "C")[info["profile_space"]],
+            self.profile,
+            compatibility,
+            "H" if info["tier"] else "L",
+            self.level,
+            "".join(".%X" % b for b in constraints),
+        )
+
+    def as_dict(self):
+        return {
+            "codec": self.codec,
+            "codec_string": self.codec_string(),
+            "width": self.width,
+            "height": self.height,
+            "profile": self.profile,
+            "level": self.level,
+            "fps": self.fps,
+            "bit_depth": self.info["bit_depth"],
+            "chroma_format": self.info["chroma_format"],
+        }
+
+    def __repr__(self):
+        return "CodecConfig(%s %dx%d, profile %d, level %d)" % (
+            self.codec,
+            self.width,
+            self.height,
+            self.profile,
+            self.level,
+        )
+
+
+class StreamInspector(object):
+    """Keyframes and codec config of a live stream, inline in the frame
+    callback of start_monitor(frames=True):
+
+        inspector = StreamInspector(print)
+        cam.start_monitor(lambda frame: inspector.feed(frame), frames=True)
+
+    Parameter sets are parsed again only when their bytes change, then
+    `callback` gets the new CodecConfig."""
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.config = None
+        self.keyframes = 0
+        self.changes = 0
+
+    def feed(self, frame):
+        """True for a keyframe"""
+        if frame.codec not in AU_START:
+            return False
+        vps, sps, pps, keyframe = parameter_sets(frame.data, frame.codec)
+        if keyframe:
+            self.keyframes += 1
+        if sps is not None and pps is not None:
+            config = self.config
+            if config is None or config.codec != frame.codec or not config.same(vps, sps, pps):
+                self.config = CodecConfig(frame.codec, sps, pps, vps)
+                self.changes += 1
+                if self.callback is not None:
+                    self.callback(self.config)
+        return keyframe
@@ -0,0 +1,191 @@
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+
+
+class SessionPool(object):
+    """Logged in DVRIPCam sessions shared by the whole process.
+
+    Sessions are keyed by (ip, port, user). A checked in session stays
+    open (its keepalive keeps running) for `idle_timeout` seconds and is
+    handed to the next caller with the same key; one idle for longer than
+    `check_interval` seconds is verified with a keepalive round trip first.
+    At most `max_per_host` sessions per camera IP exist at once; at the
+    limit the least recently used idle session of another key is closed,
+    when all are checked out further callers wait for a free one. Checked
+    out sessions have `reused` set when they did not need a new login."""
+
+    def __init__(self, max_per_host=2, idle_timeout=60, check_interval=10, factory=DVRIPCam):
+        self.logger = logging.getLogger(__name__)
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.factory = factory
+        self.lock = threading.Condition()
+        self.idle = {}  # key -> [(cam, checked in at)], most recent last
+        self.hosts = {}  # ip -> open sessions, idle or checked out
+        self.created = 0
+        self.reused = 0
+        self.reaper = None
+
+    def evict(self, now=None):
+        """Close sessions idle for longer than idle_timeout"""
+        if now is None:
+            now = monotonic()
+        expired = []
+        with self.lock:
+            for key, idle in list(self.idle.items()):
+                while idle and now - idle[0][1] > self.idle_timeout:
+                    expired.append(idle.pop(0)[0])
+                    self.hosts[key[0]] -= 1
+                if not idle:
+                    del self.idle[key]
+            if expired:
+                self.lock.notify_all()
+        for cam in expired:
+            cam.close()
+
+    def healthy(self, cam, since):
+        if cam.socket is None or cam.monitoring or cam.alarm_active:
+            return False
+        if monotonic() - since < self.check_interval:
+            return True
+        reply = cam.send(
+            cam.QCODES["KeepAlive"],
+            {"Name": "KeepAlive", "SessionID": "0x%08X" % cam.session},
+        )
+        return hasattr(reply, "get") and reply.get("Ret") in cam.OK_CODES
+
+    def acquire(self, ip, port=34567, user="admin", password="", timeout=30, **kwargs):
+        """Logged in session for ip:port, waits up to `timeout` seconds for
+        a free slot. Raises SomethingIsWrongWithCamera if login fails."""
+        key = (ip, port, user)
+        hash_pass = kwargs.pop("hash_pass", None) or DVRIPCam.sofia_hash(password)
+        deadline = monotonic() + timeout
+        while True:
+            self.evict()
+            with self.lock:
+                idle = self.idle.get(key)
+                if idle:
+                    cam, since = idle.pop()
+                else:
+                    cam = None
+                    if self.hosts.get(ip, 0) < self.max_per_host:
+                        self.hosts[ip] = self.hosts.get(ip, 0) + 1
+                        break
+                    # the slot of an idle session of another user or port
+                    cam = self.take_oldest(ip)
+                    if cam is not None:
+                        break
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise SomethingIsWrongWithCamera("No free session for %s" % ip)
+                    self.lock.wait(remaining)
+                    continue
+            if cam.hash_pass == hash_pass and self.healthy(cam, since):
+                cam.reused = True
+                self.reused += 1
+                return cam
+            self.discard(cam)
+        if cam is not None:
+            cam.close()
+        # slot reserved, login outside of the lock
+        try:
+            cam = self.factory(ip, port=port, user=user, hash_pass=hash_pass, **kwargs)
+            if not cam.login():
+                cam.close()
+                raise SomethingIsWrongWithCamera("Cannot login to %s" % ip)
+        except Exception:
+            with self.lock:
+                self.hosts[ip] -= 1
+                self.lock.notify_all()
+            raise
+        cam.reused = False
+        self.created += 1
+        return cam
+
+    def take_oldest(self, ip):
+        """Least recently used idle session of a host, its slot stays
+        counted. Called with the lock held."""
+        oldest = None
+        for key, idle in self.idle.items():
+            if key[0] == ip and idle and (oldest is None or idle[0][1] < self.idle[oldest][0][1]):
+                oldest = key
+        if oldest is None:
+            return None
+        cam = self.idle[oldest].pop(0)[0]
+        if not self.idle[oldest]:
+            del self.idle[oldest]
+        return cam
+
+    def reap(self):
+        # idle sessions keep sending keepalives until they are closed
+        while True:
+            sleep(self.idle_timeout / 2)
+            self.evict()
+            with self.lock:
+                if not self.idle:
+                    self.reaper = None
+                    return
+
+    def release(self, cam, discard=False):
+        """Check the session back in, broken or streaming ones are closed"""
+        if discard or cam.socket is None or cam.monitoring or cam.alarm_active:
+            self.discard(cam)
+            return
+        with self.lock:
+            self.idle.setdefault((cam.ip, cam.port, cam.user), []).append((cam, monotonic()))
+            self.lock.notify_all()
+            if self.reaper is None:
+                self.reaper = threading.Thread(target=self.reap, daemon=True)
+                self.reaper.start()
+
+    def discard(self, cam):
+        cam.close()
+        with self.lock:
+            self.hosts[cam.ip] -= 1
+            self.lock.notify_all()
+
+    @contextmanager
+    def session(self, ip, **kwargs):
+        """with pool.session(ip, password=...) as cam: ..."""
+        cam = self.acquire(ip, **kwargs)
+        try:
+            yield cam
+        except BaseException:
+            # the connection may be left in the middle of a reply
+            self.release(cam, discard=True)
+            raise
+        self.release(cam)
+
+    def close_all(self):
+        with self.lock:
+            sessions = [cam for idle in self.idle.values() for cam, since in idle]
+            self.idle.clear()
+            for cam in sessions:
+                self.hosts[cam.ip] -= 1
+            self.lock.notify_all()
+        for cam in sessions:
+            cam.close()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "idle": sum(len(idle) for idle in self.idle.values()),
+                "open": sum(self.hosts.values()),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+
+pool = SessionPool()
+atexit.register(pool.close_all)
+
+
+def session(ip, **kwargs):
+    """Session from the process-wide pool, for use in a with statement"""
+    return pool.session(ip, **kwargs)
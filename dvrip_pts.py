@@ -0,0 +1,211 @@
+"""Presentation timestamps of media frames.
+
+Only I-frames carry a time, the camera clock in whole seconds. P-frames
+and audio have none, so a PTS is counted: 1 / fps per video frame and
+samples / sample rate per audio frame. The count drifts (cameras lower
+their frame rate in the dark without saying so) and breaks when frames
+are lost, so it is corrected against a reference:
+
+- live streams: the arrival time of the frames
+- recordings (clock=None): the camera time of I-frames for video, the
+  position between the video frames for audio
+
+Small errors are slewed out by changing frame durations by at most
+`slew`, errors above `resync` seconds make the PTS jump forward. PTS
+never go back.
+"""
+
+from time import monotonic
+
+from dvrip_header import AUDIO_RATES
+
+
+class Track(object):
+    """PTS state of the video or the audio frames"""
+
+    __slots__ = ("next", "last", "tick", "lag", "base", "since", "checked", "rate", "skew", "restart")
+
+    def __init__(self):
+        self.next = None  # PTS of the next frame, seconds
+        self.last = None
+        self.tick = -1  # last PTS handed out, timebase units
+        self.lag = None  # lowest reference - PTS seen lately
+        self.base = None  # lowest lag of the first seconds after a (re)start
+        self.since = None  # PTS of the (re)start
+        self.checked = None  # PTS of the last reference
+        self.rate = 1.0  # real / announced frame duration
+        self.skew = 0.0  # change of the frame durations to slew out an error
+        self.restart = False
+
+
+class PTSClock(object):
+    """Monotonic PTS of one stream in units of 1 / `timebase` seconds.
+
+    stamp() sets Frame.pts of every frame in stream order, start_monitor()
+    does it when passed pts=PTSClock(). For a downloaded recording:
+
+        clock = PTSClock(clock=None)
+        for offset, frame in iter_frames(data):
+            clock.stamp(frame)
+
+    `fps` is used until the first I-frame tells the real one. wall() maps
+    a PTS to the camera time, precise to a fraction of a second once a few
+    I-frames were seen."""
+
+    def __init__(self, timebase=90000, fps=25, slew=0.02, horizon=10.0, resync=1.0, clock=monotonic):
+        self.timebase = timebase
+        self.fps = fps
+        self.slew = slew
+        self.horizon = horizon  # seconds to slew out an error
+        self.resync = resync
+        self.clock = clock
+        self.start = None
+        self.video = Track()
+        self.audio = Track()
+        # camera time - PTS lies between lo and hi, I-frame times are
+        # truncated to the second
+        self.lo = None
+        self.hi = None
+        self.jumps = 0
+
+    def discontinuity(self):
+        """Frames were lost, e.g. the stream was claimed again or the
+        session reconnected"""
+        self.video.restart = self.audio.restart = True
+        self.lo = self.hi = None
+
+    def stamp(self, frame):
+        """Set and return the PTS of the next frame"""
+        ref = None
+        if self.clock is not None:
+            now = self.clock()
+            if self.start is None:
+                self.start = now
+            ref = now - self.start
+        if frame.kind is not None:
+            if frame.fps:
+                self.fps = frame.fps
+            track = self.video
+            pts = self.advance(track, self.audio, 1.0 / self.fps, ref, frame)
+        elif frame.data_type == 0x1FA:
+            steer = ref is not None
+            if ref is None:
+                # recordings keep the capture order of audio and video, too
+                # coarse to steer by but enough to find gaps
+                ref = self.video.last
+            track = self.audio
+            # G.711, one byte per sample
+            duration = len(frame.data) / AUDIO_RATES.get(frame.rate, 8000)
+            pts = self.advance(track, self.video, duration, ref, steer=steer)
+        else:
+            frame.pts = max(self.video.tick, 0)
+            return frame.pts
+        tick = int(round(pts * self.timebase))
+        if tick <= track.tick:
+            tick = track.tick + 1
+        track.tick = frame.pts = tick
+        return tick
+
+    def advance(self, track, other, duration, ref, frame=None, steer=True):
+        pts = track.next
+        if pts is None:
+            # a new track starts on the timeline of the other one
+            if ref is not None and other.base is not None:
+                pts = ref - other.base
+            elif ref is not None:
+                pts = ref
+            else:
+                pts = other.last or 0.0
+        error = None
+        if frame is not None and frame.timestamp is not None:
+            error = self.camera_time(frame, pts)
+        if ref is not None:
+            if track.restart and track.base is not None:
+                pts = max(pts, ref - track.base)
+                track.lag = None
+            offset = ref - pts
+            if track.lag is None:
+                track.lag = track.base = offset
+                track.since = pts
+            elif offset < track.lag:
+                # late frames only raise the lag, it follows the earliest
+                track.lag = offset
+            else:
+                track.lag += 0.02 * (offset - track.lag)
+            if pts - track.since < self.resync:
+                # the first frames often come in a burst
+                track.base = min(track.base, track.lag)
+            error = track.lag - track.base
+        track.restart = False
+        if error is not None:
+            if error > self.resync:
+                pts += error
+                self.jumps += 1
+                if track.lag is not None:
+                    track.lag = track.base = ref - pts
+                    track.since = pts
+                error = 0.0
+            elif error < -self.resync:
+                # a PTS cannot go back, the new offset is taken as it is
+                if track.base is not None:
+                    track.base = track.lag
+                error = 0.0
+            if not steer:
+                error = 0.0
+            if track.checked is not None:
+                # the error that stays is a wrong frame rate or sample rate
+                rate = track.rate + error * (pts - track.checked) / self.horizon ** 2
+                track.rate = min(max(rate, 0.5), 2.0)
+            track.checked = pts
+            track.skew = min(max(error / self.horizon, -self.slew), self.slew)
+        track.last = pts
+        track.next = pts + duration * (track.rate + track.skew)
+        return pts
+
+    def camera_time(self, frame, pts):
+        """Error of `pts` against the camera time of an I-frame, used as
+        the reference of recordings"""
+        camera = frame.datetime
+        if camera is None:
+            return None
+        lo = camera.timestamp() - pts
+        hi = lo + 1
+        if self.lo is None:
+            self.lo, self.hi = lo, hi
+            return 0.0
+        if lo > self.hi:
+            error = lo - self.hi
+        elif hi < self.lo:
+            error = hi - self.lo
+        else:
+            self.lo = max(self.lo, lo)
+            self.hi = min(self.hi, hi)
+            return 0.0
+        if self.clock is None:
+            if error < -self.resync:
+                # the camera clock was set back
+                self.lo, self.hi = lo, hi
+            return error
+        # live PTS follow the arrival time, only the mapping moves
+        if abs(error) > self.resync:
+            self.lo, self.hi = lo, hi
+        else:
+            self.lo = max(self.lo + error, lo)
+            self.hi = min(self.hi + error, hi)
+        return None
+
+    def wall(self, pts):
+        """Camera time of a PTS as a POSIX timestamp, None before the first
+        I-frame with a valid time"""
+        if self.lo is None:
+            return None
+        return pts / self.timebase + (self.lo + self.hi) / 2
+
+    def as_dict(self):
+        return {
+            "fps": self.fps,
+            "video_rate": self.video.rate + self.video.skew,
+            "audio_rate": self.audio.rate + self.audio.skew,
+            "jumps": self.jumps,
+            "wall_error": None if self.lo is None else (self.hi - self.lo) / 2,
+        }
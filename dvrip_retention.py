@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Retention of indexed recordings.
+
+Deletes the oldest recordings when a camera or the whole archive is over
+its byte quota, when they are older than the maximum age, or when the
+file system has less than `min_free` bytes left. Segments overlapping a
+pinned time range, e.g. around an alarm, are kept.
+
+    python3 dvrip_retention.py archive.db --quota 2T --max-age 30d --camera hall=200G/7d --every 60
+    python3 dvrip_retention.py archive.db --pin hall "2024-05-01 14:03:00" "2024-05-01 14:06:00" burglary
+
+Usage is counted by the index as files are added and removed, nothing
+walks the tree: monitor.py adds its segments as it closes them when it
+is given the database, files of other tools come in with dvrip_archive.py.
+The file being written is not indexed yet, `min_free` covers it. Files
+are deleted in batches, at most `rate` per second, so the recording
+writes keep the disk.
+"""
+
+import argparse
+import logging
+import os
+import re
+from time import monotonic, sleep, time
+
+from dvrip_archive import ArchiveIndex, timestamp
+
+PINS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pins (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL,
+    note TEXT
+);
+CREATE INDEX IF NOT EXISTS pins_camera_time ON pins (camera, start);
+"""
+UNPINNED = (
+    "NOT EXISTS (SELECT 1 FROM pins WHERE pins.camera = segments.camera"
+    " AND pins.start < segments.end AND pins.end > segments.start)"
+)
+SIZES = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+AGES = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_size(value):
+    """Bytes of "500G", "1.5T" or "1048576" """
+    m = re.fullmatch(r"([\d.]+)([KMGT]?)B?", value.strip().upper())
+    if m is None:
+        raise ValueError("bad size %r" % value)
+    return int(float(m.group(1)) * SIZES[m.group(2)])
+
+
+def parse_age(value):
+    """Seconds of "30d", "12h" or "3600" """
+    m = re.fullmatch(r"([\d.]+)([smhdw]?)", value.strip().lower())
+    if m is None:
+        raise ValueError("bad age %r" % value)
+    return float(m.group(1)) * AGES[m.group(2) or "s"]
+
+
+class Limits(object):
+    """Byte quota and maximum age in seconds of one camera, None is no limit"""
+
+    __slots__ = ("max_bytes", "max_age")
+
+    def __init__(self, max_bytes=None, max_age=None):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def __repr__(self):
+        return "Limits(max_bytes=%r, max_age=%r)" % (self.max_bytes, self.max_age)
+
+
+class RetentionManager(object):
+    """Keeps the recordings of an ArchiveIndex within `quota` bytes in
+    total, `max_age` seconds and the Limits of `cameras` ({camera: Limits},
+    they replace the default age of that camera). `min_free` needs the
+    `root` of the recordings."""
+
+    def __init__(
+        self,
+        index,
+        quota=None,
+        max_age=None,
+        cameras=None,
+        min_free=None,
+        root=None,
+        batch=32,
+        rate=50.0,
+        clock=time,
+    ):
+        self.index = index
+        self.db = index.db
+        self.quota = quota
+        self.max_age = max_age
+        self.cameras = cameras or {}
+        self.min_free = min_free
+        self.root = root
+        self.batch = batch
+        self.rate = rate
+        self.clock = clock
+        self.logger = logging.getLogger(__name__)
+        self.deleted = 0
+        self.freed = 0
+        self.db.executescript(PINS_SCHEMA)
+
+    def pin(self, camera, start, end, note=None):
+        """Keep the recordings of `camera` from `start` to `end`, the pin id"""
+        with self.db:
+            return self.db.execute(
+                "INSERT INTO pins (camera, start, end, note) VALUES (?, ?, ?, ?)",
+                (camera, timestamp(start), timestamp(end), note),
+            ).lastrowid
+
+    def unpin(self, pin):
+        with self.db:
+            self.db.execute("DELETE FROM pins WHERE id = ?", (pin,))
+
+    def pins(self, camera=None):
+        query = "SELECT * FROM pins"
+        args = ()
+        if camera is not None:
+            query += " WHERE camera = ?"
+            args = (camera,)
+        return [dict(row) for row in self.db.execute(query + " ORDER BY start", args)]
+
+    def usage(self):
+        """{camera: bytes} of the indexed recordings"""
+        return dict(self.db.execute("SELECT camera, bytes FROM usage WHERE files > 0"))
+
+    def limits(self, camera):
+        return self.cameras.get(camera) or Limits(max_age=self.max_age)
+
+    def free(self):
+        st = os.statvfs(self.root)
+        return st.f_bavail * st.f_frsize
+
+    def enforce(self):
+        """One pass over all limits, {"files", "bytes"} deleted"""
+        deleted, freed = self.deleted, self.freed
+        now = self.clock()
+        usage = self.usage()
+        for camera in sorted(set(usage) | set(self.cameras)):
+            limits = self.limits(camera)
+            if limits.max_age is not None:
+                usage[camera] = usage.get(camera, 0) - self.expire(camera, now - limits.max_age)
+            if limits.max_bytes is not None and usage.get(camera, 0) > limits.max_bytes:
+                usage[camera] -= self.trim(camera, usage[camera] - limits.max_bytes)
+        if self.quota is not None:
+            total = sum(usage.values())
+            if total > self.quota:
+                self.trim(None, total - self.quota)
+        if self.min_free is not None and self.root is not None:
+            free = self.free()
+            if free < self.min_free:
+                self.trim(None, self.min_free - free)
+        return {"files": self.deleted - deleted, "bytes": self.freed - freed}
+
+    def expire(self, camera, before):
+        """Delete the segments of `camera` that ended before `before`, bytes freed"""
+        freed = 0
+        while True:
+            # nothing that starts later can have ended before
+            rows = self.oldest("camera = ? AND start < ? AND end < ?", (camera, before, before))
+            files, done = self.delete(rows) if rows else (0, 0)
+            freed += done
+            if not files:
+                return freed
+
+    def trim(self, camera, excess):
+        """Delete the oldest segments of `camera`, all cameras when None,
+        until `excess` bytes are freed, bytes freed"""
+        freed = 0
+        while freed < excess:
+            if camera is None:
+                rows = self.oldest("1", ())
+            else:
+                rows = self.oldest("camera = ?", (camera,))
+            # no more of the batch than needed
+            needed = []
+            size = freed
+            for row in rows:
+                needed.append(row)
+                size += row["size"]
+                if size >= excess:
+                    # not the .video without its .audio
+                    needed.extend(self.siblings(row, needed))
+                    break
+            files, done = self.delete(needed) if needed else (0, 0)
+            freed += done
+            if not files:
+                self.logger.warning(
+                    "%s is %d bytes over its limit with pinned or undeletable recordings",
+                    camera or "The archive",
+                    excess - freed,
+                )
+                return freed
+        return freed
+
+    def oldest(self, where, args):
+        return self.db.execute(
+            "SELECT id, path, camera, start, size FROM segments WHERE %s AND %s ORDER BY start, path LIMIT ?"
+            % (where, UNPINNED),
+            args + (self.batch,),
+        ).fetchall()
+
+    def siblings(self, row, rows):
+        """The other files of the segment of `row` that are not in `rows`"""
+        stem = os.path.splitext(row["path"])[0]
+        ids = set(other["id"] for other in rows)
+        return [
+            other
+            for other in self.db.execute(
+                "SELECT id, path, camera, start, size FROM segments WHERE camera = ? AND start = ? AND %s" % UNPINNED,
+                (row["camera"], row["start"]),
+            )
+            if other["id"] not in ids and os.path.splitext(other["path"])[0] == stem
+        ]
+
+    def delete(self, rows):
+        """Delete the files and rows of a batch of segments at no more than
+        `rate` files per second, (files, bytes) deleted"""
+        started = monotonic()
+        gone = []
+        freed = 0
+        folders = set()
+        for row in rows:
+            try:
+                os.remove(row["path"])
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                self.logger.warning("Cannot delete %s: %s", row["path"], err)
+                continue
+            gone.append((row["id"],))
+            freed += row["size"]
+            folders.add(os.path.dirname(row["path"]))
+        with self.db:
+            self.db.executemany("DELETE FROM segments WHERE id = ?", gone)
+        for folder in sorted(folders, reverse=True):
+            prune(folder)
+        self.deleted += len(gone)
+        self.freed += freed
+        if gone and self.rate:
+            wait = len(gone) / self.rate - (monotonic() - started)
+            if wait > 0:
+                sleep(wait)
+        return len(gone), freed
+
+    def run(self, every=60.0):
+        while True:
+            result = self.enforce()
+            if result["files"]:
+                self.logger.info("Deleted %d files, %d bytes", result["files"], result["bytes"])
+            sleep(every)
+
+
+def prune(folder):
+    """Remove the empty date folders (2024/05/01) of monitor.py"""
+    while os.path.basename(folder).isdigit():
+        try:
+            os.rmdir(folder)
+        except OSError:
+            return
+        folder = os.path.dirname(folder)
+
+
+def parse_camera(value):
+    """CAMERA=SIZE[/AGE], CAMERA=/AGE"""
+    camera, _, limits = value.partition("=")
+    size, _, age = limits.partition("/")
+    return camera, Limits(parse_size(size) if size else None, parse_age(age) if age else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete the oldest recordings beyond quotas and ages")
+    parser.add_argument("database")
+    parser.add_argument("--quota", type=parse_size, help="bytes of all cameras, e.g. 2T")
+    parser.add_argument("--max-age", type=parse_age, help="e.g. 30d")
+    parser.add_argument("--camera", type=parse_camera, action="append", default=[], metavar="CAMERA=SIZE/AGE")
+    parser.add_argument("--min-free", type=parse_size, help="bytes to keep free on the file system of --root")
+    parser.add_argument("--root", help="recordings, scanned once at start when given")
+    parser.add_argument("--rate", type=float, default=50.0, help="files deleted per second")
+    parser.add_argument("--every", type=float, default=0, help="seconds between passes, 0 runs once")
+    parser.add_argument("--pin", nargs="+", metavar="CAMERA START END [NOTE]", help="keep a time range")
+    parser.add_argument("--unpin", type=int, metavar="ID")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s")
+
+    with ArchiveIndex(args.database) as index:
+        retention = RetentionManager(
+            index,
+            quota=args.quota,
+            max_age=args.max_age,
+            cameras=dict(args.camera),
+            min_free=args.min_free,
+            root=args.root,
+            rate=args.rate,
+        )
+        if args.pin:
+            if len(args.pin) not in (3, 4):
+                parser.error("--pin CAMERA START END [NOTE]")
+            print("pin", retention.pin(*args.pin))
+            return
+        if args.unpin is not None:
+            retention.unpin(args.unpin)
+            return
+        if args.root:
+            print(args.root, index.scan(args.root))
+        if args.every:
+            retention.run(args.every)
+        else:
+            print(retention.enforce())
+
+
+if __name__ == "__main__":
+    main()
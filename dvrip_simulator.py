@@ -0,0 +1,845 @@
+#!/usr/bin/env python3
+"""Fake DVRIP devices for load and regression testing on loopback.
+
+    python3 dvrip_simulator.py --count 1000 --port 40000 --latency 0.005
+
+starts 1000 cameras on 127.0.0.1:40000..40999 which accept any login
+unless --password is given.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import struct
+import zlib
+from datetime import datetime, timedelta
+from time import monotonic
+
+from dvrip_header import HEADER, MEDIA_HEADER, SEARCH_HEADER
+
+
+VIDEO_CODECS = {"mpeg4": 1, "h264": 2, "h265": 3}
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def sofia_hash(password=""):
+    md5 = hashlib.md5(bytes(password, "utf-8")).digest()
+    chars = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    return "".join([chars[sum(x) % 62] for x in zip(md5[::2], md5[1::2])])
+
+
+def datetime_to_internal(dt):
+    return (
+        dt.second
+        | dt.minute << 6
+        | dt.hour << 12
+        | dt.day << 17
+        | dt.month << 22
+        | (dt.year - 2000) << 26
+    )
+
+
+class BitWriter(object):
+    def __init__(self):
+        self.bits = []
+
+    def u(self, n, value):
+        for i in range(n - 1, -1, -1):
+            self.bits.append((value >> i) & 1)
+
+    def ue(self, value):
+        value += 1
+        n = value.bit_length()
+        self.u(n - 1, 0)
+        self.u(n, value)
+
+    def rbsp(self):
+        self.bits.append(1)
+        while len(self.bits) % 8:
+            self.bits.append(0)
+        data = bytearray()
+        for i in range(0, len(self.bits), 8):
+            byte = 0
+            for b in self.bits[i : i + 8]:
+                byte = byte << 1 | b
+            data.append(byte)
+        # emulation prevention
+        out = bytearray()
+        zeros = 0
+        for b in data:
+            if zeros >= 2 and b <= 3:
+                out.append(3)
+                zeros = 0
+            out.append(b)
+            zeros = zeros + 1 if b == 0 else 0
+        return bytes(out)
+
+
+def h264_sps(width, height, profile=77, level=40):
+    w = BitWriter()
+    w.u(8, profile)
+    w.u(8, 0)  # constraint flags
+    w.u(8, level)
+    w.ue(0)  # seq_parameter_set_id
+    w.ue(0)  # log2_max_frame_num_minus4
+    w.ue(2)  # pic_order_cnt_type
+    w.ue(1)  # max_num_ref_frames
+    w.u(1, 0)  # gaps_in_frame_num_value_allowed_flag
+    mbs_w = (width + 15) // 16
+    mbs_h = (height + 15) // 16
+    w.ue(mbs_w - 1)
+    w.ue(mbs_h - 1)
+    w.u(1, 1)  # frame_mbs_only_flag
+    w.u(1, 1)  # direct_8x8_inference_flag
+    crop_r = (mbs_w * 16 - width) // 2
+    crop_b = (mbs_h * 16 - height) // 2
+    if crop_r or crop_b:
+        w.u(1, 1)
+        w.ue(0)
+        w.ue(crop_r)
+        w.ue(0)
+        w.ue(crop_b)
+    else:
+        w.u(1, 0)
+    w.u(1, 0)  # vui_parameters_present_flag
+    return b"\x00\x00\x00\x01\x67" + w.rbsp()
+
+
+def h265_profile_tier_level(w, level):
+    w.u(2, 0)  # general_profile_space
+    w.u(1, 0)  # general_tier_flag
+    w.u(5, 1)  # general_profile_idc, Main
+    w.u(32, 0x60000000)  # compatibility flags 1 and 2
+    w.u(4, 0b1001)  # progressive, interlaced, non packed, frame only
+    w.u(44, 0)
+    w.u(8, level)
+
+
+def h265_vps(level=93):
+    w = BitWriter()
+    w.u(4, 0)  # vps_video_parameter_set_id
+    w.u(1, 1)  # vps_base_layer_internal_flag
+    w.u(1, 1)  # vps_base_layer_available_flag
+    w.u(6, 0)  # vps_max_layers_minus1
+    w.u(3, 0)  # vps_max_sub_layers_minus1
+    w.u(1, 1)  # vps_temporal_id_nesting_flag
+    w.u(16, 0xFFFF)
+    h265_profile_tier_level(w, level)
+    w.u(1, 1)  # vps_sub_layer_ordering_info_present_flag
+    w.ue(1)
+    w.ue(0)
+    w.ue(0)
+    w.u(6, 0)  # vps_max_layer_id
+    w.ue(0)  # vps_num_layer_sets_minus1
+    w.u(1, 0)  # vps_timing_info_present_flag
+    w.u(1, 0)  # vps_extension_flag
+    return b"\x00\x00\x00\x01\x40\x01" + w.rbsp()
+
+
+def h265_sps(width, height, level=93):
+    w = BitWriter()
+    w.u(4, 0)  # sps_video_parameter_set_id
+    w.u(3, 0)  # sps_max_sub_layers_minus1
+    w.u(1, 1)  # sps_temporal_id_nesting_flag
+    h265_profile_tier_level(w, level)
+    w.ue(0)  # sps_seq_parameter_set_id
+    w.ue(1)  # chroma_format_idc
+    w.ue((width + 7) // 8 * 8)
+    w.ue((height + 7) // 8 * 8)
+    if width % 8 or height % 8:
+        w.u(1, 1)
+        w.ue(0)
+        w.ue(((width + 7) // 8 * 8 - width) // 2)
+        w.ue(0)
+        w.ue(((height + 7) // 8 * 8 - height) // 2)
+    else:
+        w.u(1, 0)  # conformance_window_flag
+    w.ue(0)  # bit_depth_luma_minus8
+    w.ue(0)  # bit_depth_chroma_minus8
+    w.ue(4)  # log2_max_pic_order_cnt_lsb_minus4
+    w.u(1, 1)  # sps_sub_layer_ordering_info_present_flag
+    w.ue(1)
+    w.ue(0)
+    w.ue(0)
+    w.ue(0)  # log2_min_luma_coding_block_size_minus3
+    w.ue(3)  # log2_diff_max_min_luma_coding_block_size
+    w.ue(0)  # log2_min_luma_transform_block_size_minus2
+    w.ue(3)  # log2_diff_max_min_luma_transform_block_size
+    w.ue(0)  # max_transform_hierarchy_depth_inter
+    w.ue(0)  # max_transform_hierarchy_depth_intra
+    w.u(1, 0)  # scaling_list_enabled_flag
+    w.u(1, 0)  # amp_enabled_flag
+    w.u(1, 0)  # sample_adaptive_offset_enabled_flag
+    w.u(1, 0)  # pcm_enabled_flag
+    w.ue(0)  # num_short_term_ref_pic_sets
+    w.u(1, 0)  # long_term_ref_pics_present_flag
+    w.u(1, 0)  # sps_temporal_mvp_enabled_flag
+    w.u(1, 0)  # strong_intra_smoothing_enabled_flag
+    w.u(1, 0)  # vui_parameters_present_flag
+    w.u(1, 0)  # sps_extension_present_flag
+    return b"\x00\x00\x00\x01\x42\x01" + w.rbsp()
+
+
+class MediaGenerator(object):
+    """Synthetic DVRIP media frames: (time offset, frame header + payload).
+
+    Video is Annex B with real SPS/PPS (and VPS for H.265) on every I-frame
+    and filler slices sized from the bitrate. `motion` = (period, duration)
+    makes P-frames three times bigger for `duration` seconds of every period.
+    Audio is G.711A, 320 bytes every 40 ms."""
+
+    def __init__(self, codec="h264", width=1920, height=1080, fps=25, gop=2, bitrate=2048,
+                 audio=True, motion=None, start=None, seed=0):
+        self.codec = codec
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.gop = gop
+        self.bitrate = bitrate
+        self.audio = audio
+        self.motion = motion
+        self.start = start or datetime.now()
+        self.random = random.Random(seed)
+        if codec == "h265":
+            self.params = (
+                h265_vps()
+                + h265_sps(width, height)
+                + b"\x00\x00\x00\x01\x44\x01\xc1\x72\xb4\x62\x40"
+            )
+            # slice headers start with first_slice_segment_in_pic_flag
+            self.idr = b"\x00\x00\x00\x01\x26\x01\xaf"
+            self.slice = b"\x00\x00\x00\x01\x02\x01\xd0"
+        else:
+            self.params = h264_sps(width, height) + b"\x00\x00\x00\x01\x68\xce\x3c\x80"
+            # and first_mb_in_slice 0
+            self.idr = b"\x00\x00\x00\x01\x65\x88"
+            self.slice = b"\x00\x00\x00\x01\x41\x9a"
+        self.filler = bytes(range(0x10, 0x100)) * 2048
+
+    def payload(self, head, size):
+        size = max(size, 16)
+        while len(self.filler) < size * 2:
+            self.filler += self.filler
+        offset = self.random.randrange(0, len(self.filler) - size - 1)
+        return head + self.filler[offset : offset + size]
+
+    def in_motion(self, t):
+        if self.motion is None:
+            return False
+        period, duration = self.motion
+        return t % period < duration
+
+    def frames(self):
+        """Endless iterator of (seconds since start, frame)"""
+        n = 0
+        audio_t = 0.0
+        bytes_per_gop = self.bitrate * 1024 // 8 * self.gop
+        gop_frames = max(1, self.gop * self.fps)
+        i_size = bytes_per_gop // 4
+        p_size = (bytes_per_gop - i_size) // gop_frames
+        while True:
+            t = n / self.fps
+            while self.audio and audio_t <= t:
+                yield audio_t, struct.pack(">I", 0x1FA) + struct.pack("<BBH", 0xE, 2, 320) + b"\xd5" * 320
+                audio_t += 0.04
+            jitter = self.random.uniform(0.8, 1.2)
+            if n % gop_frames == 0:
+                dt = datetime_to_internal(self.start + timedelta(seconds=int(t)))
+                body = self.payload(self.params + self.idr, int(i_size * jitter))
+                header = struct.pack(">I", 0x1FC) + struct.pack(
+                    "<BBBBII",
+                    VIDEO_CODECS[self.codec],
+                    self.fps,
+                    self.width // 8,
+                    self.height // 8,
+                    dt,
+                    len(body),
+                )
+            else:
+                size = p_size * (3 if self.in_motion(t) else 1)
+                body = self.payload(self.slice, int(size * jitter))
+                header = struct.pack(">I", 0x1FD) + struct.pack("<I", len(body))
+            yield t, header + body
+            n += 1
+
+    def file(self, size):
+        """Recording as stored on the device: frames with their headers"""
+        data = bytearray()
+        for t, frame in self.frames():
+            if len(data) + len(frame) > size and len(data) > 0:
+                break
+            data.extend(frame)
+        return bytes(data)
+
+
+def jpeg(size=20000):
+    return b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00" + b"\x80" * size + b"\xff\xd9"
+
+
+class DVRIPSimulator(object):
+    """One fake device listening on host:port, any number of connections.
+
+    Options: user/password (None accepts any), latency (seconds before each
+    reply), bandwidth (bytes/s per connection, 0 unlimited), chunk (max
+    bytes per socket write, to fragment packets on the wire), packet_size
+    (max media payload per DVRIP packet), speed (media clock, 1.0 real time,
+    0 as fast as possible), alarm_interval/alarm_burst (AlarmInfo pushes
+    after AlarmSet), stall_after/disconnect_after (seconds of streaming
+    before the stream freezes or the connection drops), alive_interval
+    (AliveInterval of the login reply), udp (serve UDP on the same port
+    too) with loss/reorder (probability of dropping a datagram or sending
+    it one later) and MediaGenerator keywords (codec, width, height, fps,
+    gop, bitrate, audio, motion)."""
+
+    def __init__(self, host="127.0.0.1", port=34567, **kwargs):
+        self.logger = logging.getLogger(__name__)
+        self.host = host
+        self.port = port
+        self.user = kwargs.pop("user", "admin")
+        password = kwargs.pop("password", None)
+        self.hash_pass = None if password is None else sofia_hash(password)
+        self.latency = kwargs.pop("latency", 0)
+        self.bandwidth = kwargs.pop("bandwidth", 0)
+        self.chunk = kwargs.pop("chunk", 0)
+        self.packet_size = kwargs.pop("packet_size", 8192)
+        self.speed = kwargs.pop("speed", 1.0)
+        self.alarm_interval = kwargs.pop("alarm_interval", 0)
+        self.alarm_burst = kwargs.pop("alarm_burst", 1)
+        self.stall_after = kwargs.pop("stall_after", None)
+        self.disconnect_after = kwargs.pop("disconnect_after", None)
+        self.alive_interval = kwargs.pop("alive_interval", 20)
+        self.udp = kwargs.pop("udp", False)
+        self.loss = kwargs.pop("loss", 0)
+        self.reorder = kwargs.pop("reorder", 0)
+        self.file_count = kwargs.pop("file_count", 200)
+        self.file_size = kwargs.pop("file_size", 1024)  # KB
+        self.media = kwargs
+        self.serial = "%016x" % (port * 7919)
+        self.time_offset = timedelta(0)
+        self.configs = {
+            "SystemInfo": {
+                "AlarmInChannel": 1,
+                "AlarmOutChannel": 1,
+                "BuildTime": "2020-01-08 11:05:18",
+                "DeviceModel": "SIMULATOR",
+                "DeviceRunTime": "0x00000001",
+                "HardWare": "SIMULATOR",
+                "SerialNo": self.serial,
+                "SoftWareVersion": "V5.00.R02.00000000.10010.040600.0020000",
+                "VideoInChannel": 1,
+            },
+            "General.General": {"MachineName": "sim%d" % port, "AutoLogout": 0},
+            "General": {"General": {"MachineName": "sim%d" % port}},
+            "NetWork.NetCommon": {
+                "HostIP": "0x0100007F",
+                "HostName": "sim%d" % port,
+                "TCPPort": port,
+                "HttpPort": 80,
+                "MAC": "00:12:31:%02x:%02x:%02x" % ((port >> 16) & 0xFF, (port >> 8) & 0xFF, port & 0xFF),
+            },
+            "Simplify.Encode": [
+                {
+                    "MainFormat": {
+                        "AudioEnable": kwargs.get("audio", True),
+                        "Video": {
+                            "BitRate": kwargs.get("bitrate", 2048),
+                            "Compression": "H.265" if kwargs.get("codec") == "h265" else "H.264",
+                            "FPS": kwargs.get("fps", 25),
+                            "GOP": kwargs.get("gop", 2),
+                        },
+                        "VideoEnable": True,
+                    }
+                }
+            ],
+            "Camera": {"Param": [{"DayNightColor": "0x00000000"}]},
+            "Detect": {"MotionDetect": [{"Enable": True, "Level": 3}]},
+            "ChannelTitle": ["CAM%d" % port],
+            "NetWork.ChnStatus": [{"ChnName": "CAM%d" % port, "Status": "Connected"}],
+            "OPSystemUpgrade": {"Hardware": "SIMULATOR", "LogoArea": {}, "Vendor": "General"},
+            "StorageInfo": [
+                {
+                    "PartNumber": 1,
+                    "Partition": [
+                        {"RemainSpace": "0x00010000", "TotalSpace": "0x00020000", "Status": 0}
+                    ],
+                    "PlysicalNo": 0,
+                }
+            ],
+            "SystemFunction": {"AlarmFunction": {"MotionDetect": True}},
+            "EncodeCapability": {"MaxEncodePower": 2000},
+        }
+        self.server = None
+        self.datagrams = None
+        self.sessions = 0
+        self.connections = 0
+        self.requests = 0
+        self.upgrades = []
+        self.alarms_sent = 0
+        self.datagrams_dropped = 0
+        self.files = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, backlog=1024)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        if self.udp:
+            self.datagrams, protocol = await asyncio.get_event_loop().create_datagram_endpoint(
+                lambda: DatagramServer(self), local_addr=(self.host, self.port)
+            )
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        if self.datagrams is not None:
+            self.datagrams.close()
+            self.datagrams = None
+
+    def file_list(self):
+        if self.files is None:
+            begin = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=self.file_count // 6)
+            self.files = []
+            for i in range(self.file_count):
+                start = begin + timedelta(minutes=10 * i)
+                end = start + timedelta(minutes=10)
+                self.files.append(
+                    {
+                        "BeginTime": start.strftime(DATE_FORMAT),
+                        "EndTime": end.strftime(DATE_FORMAT),
+                        "DiskNo": 0,
+                        "SerialNo": 0,
+                        "FileLength": "0x%08X" % self.file_size,
+                        "FileName": "/idea0/%s/001/%s-%s[M][@%x][0].h264"
+                        % (start.strftime("%Y-%m-%d"), start.strftime("%H.%M.%S"), end.strftime("%H.%M.%S"), i),
+                    }
+                )
+        return self.files
+
+    def search_reply(self):
+        """Answer to the 1530 broadcast search, as DeviceManager expects it"""
+        data = json.dumps({"NetWork.NetCommon": self.configs["NetWork.NetCommon"], "Ret": 100}).encode() + b"\x00"
+        return SEARCH_HEADER.pack(255, 0, 0, 0, 0, 0, 1531, len(data)) + data
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        conn = Connection(self, reader, writer)
+        try:
+            await conn.run()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            conn.cancel()
+            writer.close()
+            self.connections -= 1
+
+
+class Connection(object):
+    def __init__(self, device, reader, writer):
+        self.device = device
+        self.reader = reader
+        self.writer = writer
+        self.session = 0
+        self.sequence = 0
+        self.tasks = []
+        self.upgrade = None
+        self.sent = 0
+        self.started = monotonic()
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+
+    async def write(self, data):
+        device = self.device
+        chunk = device.chunk or len(data)
+        for i in range(0, len(data), chunk):
+            self.writer.write(data[i : i + chunk])
+            await self.writer.drain()
+        self.sent += len(data)
+        if device.bandwidth:
+            delay = self.started + self.sent / device.bandwidth - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def reply(self, msgid, data):
+        if self.device.latency:
+            await asyncio.sleep(self.device.latency)
+        if isinstance(data, dict):
+            data.setdefault("SessionID", "0x%08X" % self.session)
+            data = json.dumps(data).encode() + b"\x0a\x00"
+        self.sequence += 1
+        await self.write(HEADER.pack(255, 0, self.session, self.sequence, msgid, len(data)) + data)
+
+    async def media(self, msgid, frame):
+        size = self.device.packet_size
+        for i in range(0, len(frame), size):
+            part = frame[i : i + size]
+            self.sequence += 1
+            await self.write(MEDIA_HEADER.pack(255, 0, self.session, self.sequence, 0, 0, msgid, len(part)) + part)
+
+    async def run(self):
+        while True:
+            header = await self.reader.readexactly(MEDIA_HEADER.size)
+            head, version, session, sequence, total, cur, msgid, length = MEDIA_HEADER.unpack(header)
+            data = await self.reader.readexactly(length) if length else b""
+            await self.request(msgid, cur, data)
+
+    async def request(self, msgid, cur, data):
+        self.device.requests += 1
+        if msgid == 0x5F2:
+            await self.upgrade_block(cur, data)
+            return
+        try:
+            request = json.loads(data.rstrip(b"\x00\x0a").decode("utf-8", errors="replace") or "{}")
+        except ValueError:
+            request = {}
+        await self.dispatch(msgid, request, data)
+
+    async def dispatch(self, msgid, request, data):
+        device = self.device
+        name = request.get("Name", "")
+        if msgid == 1000:
+            if (device.hash_pass is not None and request.get("PassWord") != device.hash_pass) or request.get(
+                "UserName"
+            ) != device.user:
+                await self.reply(1001, {"Ret": 203, "SessionID": "0x00000000"})
+                return
+            device.sessions += 1
+            self.session = device.sessions
+            await self.reply(
+                1001,
+                {
+                    "AliveInterval": device.alive_interval,
+                    "ChannelNum": 1,
+                    "DeviceType ": "IPC",
+                    "ExtraChannel": 0,
+                    "Ret": 100,
+                    "SessionID": "0x%08X" % self.session,
+                },
+            )
+        elif msgid == 1006:
+            await self.reply(1007, {"Name": "KeepAlive", "Ret": 100})
+        elif msgid == 1410:
+            params = request.get("OPMonitor", {}).get("Parameter", {})
+            self.tasks.append(asyncio.ensure_future(self.stream(params)))
+        elif msgid == 1413:
+            if request.get("OPMonitor", {}).get("Action") == "Stop":
+                self.cancel()
+            await self.reply(1414, {"Name": "", "Ret": 100})
+        elif msgid == 1560:
+            frame = jpeg()
+            self.sequence += 1
+            await self.write(MEDIA_HEADER.pack(255, 0, self.session, self.sequence, 0, 0, 1562, len(frame)) + frame)
+        elif msgid == 1440:
+            await self.file_query(request.get("OPFileQuery", {}))
+        elif msgid == 1424:
+            await self.reply(1425, {"Name": "", "Ret": 100})
+        elif msgid == 1420:
+            await self.playback(request.get("OPPlayBack", {}))
+        elif msgid == 1500:
+            await self.reply(1501, {"Name": "", "Ret": 100})
+            if device.alarm_interval:
+                self.tasks.append(asyncio.ensure_future(self.alarms()))
+        elif msgid == 1452:
+            now = datetime.now() + device.time_offset
+            await self.reply(1453, {"Name": name, "Ret": 100, name: now.strftime(DATE_FORMAT)})
+        elif msgid == 1450 and name == "OPTimeSetting":
+            device.time_offset = datetime.strptime(request[name], DATE_FORMAT) - datetime.now()
+            await self.reply(1451, {"Name": "", "Ret": 100})
+        elif msgid == 1450 and name == "OPMachine":
+            await self.reply(1451, {"Name": "", "Ret": 100})
+            raise ConnectionResetError()
+        elif msgid == 0x5F0:
+            self.upgrade = bytearray()
+            await self.reply(0x5F1, {"Name": "", "Ret": 100})
+        elif msgid == 0x41A:
+            await self.reply(0x41B, {"Name": "", "Ret": 100})
+        elif name in request and name:
+            if msgid == 1040 or msgid == 1042:
+                device.configs[name] = request[name]
+            await self.reply(msgid + 1, {"Name": "", "Ret": 100})
+        elif name in device.configs:
+            await self.reply(msgid + 1, {"Name": name, "Ret": 100, name: device.configs[name]})
+        else:
+            await self.reply(msgid + 1, {"Name": name, "Ret": 607 if name else 100})
+
+    async def upgrade_block(self, end, data):
+        if self.upgrade is None:
+            self.upgrade = bytearray()
+        if end == 1 and len(data) == 0:
+            self.device.upgrades.append(bytes(self.upgrade))
+            self.upgrade = None
+            for progress in (0, 25, 50, 75, 99):
+                await self.reply(0x5F4, {"Name": "", "Ret": progress})
+                await asyncio.sleep(0.01)
+            await self.reply(0x5F4, {"Name": "", "Ret": 515})
+            return
+        self.upgrade.extend(data)
+        await self.reply(0x5F3, {"Name": "", "Ret": 100})
+
+    async def file_query(self, query):
+        begin = query.get("BeginTime", "")
+        end = query.get("EndTime", "")
+        files = [f for f in self.device.file_list() if f["BeginTime"] >= begin and f["BeginTime"] <= end]
+        if not files:
+            await self.reply(1441, {"Name": "OPFileQuery", "Ret": 119})
+            return
+        await self.reply(1441, {"Name": "OPFileQuery", "Ret": 100, "OPFileQuery": files[:64]})
+
+    async def playback(self, playback):
+        action = playback.get("Action", "")
+        if action not in ("DownloadStart", "Start"):
+            await self.reply(1421, {"Name": "", "Ret": 100})
+            return
+        name = playback.get("Parameter", {}).get("FileName", "")
+        size = self.device.file_size * 1024
+        for f in self.device.file_list():
+            if f["FileName"] == name:
+                size = int(f["FileLength"], 0) * 1024
+        # str hashes differ between processes, the content of a file must not
+        generator = MediaGenerator(seed=zlib.crc32(name.encode()), **self.device.media)
+        data = generator.file(size)
+        step = 0x8000
+        msgid = 1421
+        for i in range(0, len(data), step):
+            part = data[i : i + step]
+            self.sequence += 1
+            await self.write(HEADER.pack(255, 0, self.session, self.sequence, msgid, len(part)) + part)
+            msgid = 1426
+        self.sequence += 1
+        await self.write(HEADER.pack(255, 0, self.session, self.sequence, 1426, 0))
+
+    async def stream(self, params):
+        device = self.device
+        generator = MediaGenerator(**device.media)
+        started = monotonic()
+        try:
+            await self.frames(generator, started)
+        except ConnectionError:
+            pass
+        except Exception:
+            device.logger.exception("Stream failed")
+            self.writer.close()
+
+    async def frames(self, generator, started):
+        device = self.device
+        for t, frame in generator.frames():
+            if device.disconnect_after is not None and t >= device.disconnect_after:
+                self.writer.close()
+                return
+            if device.stall_after is not None and t >= device.stall_after:
+                await asyncio.sleep(3600)
+            if device.speed:
+                delay = started + t / device.speed - monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self.media(1412, frame)
+
+    async def alarms(self):
+        device = self.device
+        while True:
+            await asyncio.sleep(device.alarm_interval)
+            for i in range(device.alarm_burst):
+                for status in ("Start", "Stop"):
+                    await self.reply(
+                        1504,
+                        {
+                            "AlarmInfo": {
+                                "Channel": 0,
+                                "Event": "MotionDetect",
+                                "StartTime": (datetime.now() + device.time_offset).strftime(DATE_FORMAT),
+                                "Status": status,
+                            },
+                            "Name": "AlarmInfo",
+                        },
+                    )
+                    device.alarms_sent += 1
+
+
+class DatagramWriter(object):
+    """Sends the packets of one UDP peer, in place of a StreamWriter"""
+
+    def __init__(self, server, address):
+        self.server = server
+        self.address = address
+        self.closed = False
+
+    def write(self, data):
+        self.server.transport.sendto(data, self.address)
+
+    async def drain(self):
+        if self.closed:
+            raise ConnectionResetError()
+
+    def close(self):
+        self.closed = True
+        self.server.drop(self.address)
+
+
+class DatagramConnection(Connection):
+    """One UDP peer, every packet is a datagram of its own"""
+
+    def __init__(self, device, writer):
+        Connection.__init__(self, device, None, writer)
+        self.queue = asyncio.Queue()
+        self.held = None
+
+    async def write(self, data):
+        device = self.device
+        await self.writer.drain()
+        if device.loss and random.random() < device.loss:
+            device.datagrams_dropped += 1
+        elif device.reorder and self.held is None and random.random() < device.reorder:
+            # goes out after the next one
+            self.held = data
+        else:
+            self.writer.write(data)
+            if self.held is not None:
+                self.writer.write(self.held)
+                self.held = None
+        self.sent += len(data)
+        if device.bandwidth:
+            delay = self.started + self.sent / device.bandwidth - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def run(self):
+        while True:
+            data = await self.queue.get()
+            if len(data) < MEDIA_HEADER.size:
+                continue
+            head, version, session, sequence, total, cur, msgid, length = MEDIA_HEADER.unpack_from(data)
+            await self.request(msgid, cur, data[MEDIA_HEADER.size : MEDIA_HEADER.size + length])
+
+
+class DatagramServer(asyncio.DatagramProtocol):
+    """UDP side of a DVRIPSimulator, a connection per peer address"""
+
+    def __init__(self, device):
+        self.device = device
+        self.transport = None
+        self.peers = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        conn = self.peers.get(address)
+        if conn is None:
+            conn = self.peers[address] = DatagramConnection(self.device, DatagramWriter(self, address))
+            conn.task = asyncio.ensure_future(self.serve(conn))
+        conn.queue.put_nowait(data)
+
+    async def serve(self, conn):
+        self.device.connections += 1
+        try:
+            await conn.run()
+        except ConnectionError:
+            pass
+        finally:
+            conn.cancel()
+            conn.writer.close()
+            self.device.connections -= 1
+
+    def drop(self, address):
+        conn = self.peers.pop(address, None)
+        if conn is not None:
+            conn.task.cancel()
+
+
+async def push_alarm(host, port, session=1, status="Start", event="MotionDetect"):
+    """Send one AlarmInfo the way cameras report to an alarm server"""
+    reader, writer = await asyncio.open_connection(host, port)
+    data = json.dumps(
+        {
+            "Address": "0x0100007F",
+            "Channel": 0,
+            "Descrip": "",
+            "Event": event,
+            "SerialID": "%016x" % session,
+            "StartTime": datetime.now().strftime(DATE_FORMAT),
+            "Status": status,
+            "Type": "Alarm",
+        }
+    ).encode() + b"\x0a\x00"
+    writer.write(HEADER.pack(255, 1, session, 0, 1508, len(data)) + data)
+    await writer.drain()
+    writer.close()
+
+
+class DVRIPFleet(object):
+    """`count` simulators on consecutive ports starting from `port`"""
+
+    def __init__(self, count=10, host="127.0.0.1", port=40000, **kwargs):
+        self.devices = [DVRIPSimulator(host, port + i, **kwargs) for i in range(count)]
+
+    async def start(self):
+        await asyncio.gather(*[d.start() for d in self.devices])
+        return self
+
+    async def stop(self):
+        await asyncio.gather(*[d.stop() for d in self.devices])
+
+    def addresses(self):
+        return [(d.host, d.port) for d in self.devices]
+
+
+async def main(args):
+    fleet = DVRIPFleet(
+        args.count,
+        args.host,
+        args.port,
+        password=args.password,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        chunk=args.chunk,
+        packet_size=args.packet_size,
+        speed=args.speed,
+        alarm_interval=args.alarm_interval,
+        alarm_burst=args.alarm_burst,
+        codec=args.codec,
+        width=args.width,
+        height=args.height,
+        fps=args.fps,
+        bitrate=args.bitrate,
+        udp=args.udp,
+        loss=args.loss,
+        reorder=args.reorder,
+    )
+    await fleet.start()
+    print(f"{args.count} devices on {args.host}:{args.port}..{args.port + args.count - 1}")
+    while True:
+        await asyncio.sleep(3600)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=34567)
+    parser.add_argument("--password", default=None, help="Accept any password if not set")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds before every reply")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Bytes per second per connection")
+    parser.add_argument("--chunk", type=int, default=0, help="Fragment socket writes to this size")
+    parser.add_argument("--packet-size", type=int, default=8192, help="Media payload per DVRIP packet")
+    parser.add_argument("--speed", type=float, default=1.0, help="Media clock, 0 is unlimited")
+    parser.add_argument("--udp", action="store_true", help="Serve UDP on the same ports")
+    parser.add_argument("--loss", type=float, default=0, help="UDP datagram loss probability")
+    parser.add_argument("--reorder", type=float, default=0, help="UDP datagram reorder probability")
+    parser.add_argument("--alarm-interval", type=float, default=0)
+    parser.add_argument("--alarm-burst", type=int, default=1)
+    parser.add_argument("--codec", choices=["h264", "h265"], default="h264")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--bitrate", type=int, default=2048, help="kbit/s")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
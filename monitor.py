@@ -1,25 +1,51 @@
 #! /usr/bin/python3
 from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip_health import StreamHealth
+from dvrip_archive import ArchiveIndex
 from signal import signal, SIGINT, SIGTERM
 from sys import argv, stdout, exit
 from datetime import datetime
 from pathlib import Path
 from time import sleep, time
+from queue import Queue
 import logging
+import sqlite3
+import threading
 
 baseDir = argv[3]
 retryIn = 5
-rebootWait = 10
 camIp = argv[1]
 camName = argv[2]
 cam = None
 isShuttingDown = False
 chunkSize = 600 # new file every 10 minutes
 logFile = baseDir + '/' + camName + '/log.log'
+# closed clips go into the index of dvrip_retention.py when given
+archivePath = argv[4] if len(argv) > 4 else None
+closedFiles = Queue()
+video = None
+audio = None
 
 def log(str):
     logging.info(str)
 
+def indexer():
+    # scanning a clip and waiting for the database must not hold up the
+    # stream, a locked or full database only costs the index entry
+    archive = None
+    while True:
+        paths = closedFiles.get()
+        for attempt in range(3):
+            try:
+                if archive is None:
+                    archive = ArchiveIndex(archivePath)
+                archive.add(paths)
+                break
+            except sqlite3.Error as err:
+                log('Cannot index ' + ', '.join(paths) + ': ' + str(err))
+                sleep(retryIn)
+        closedFiles.task_done()
+
 def mkpath():
     path = baseDir + '/' + camName + "/" + datetime.today().strftime('%Y/%m/%d/%H.%M.%S')
     Path(path).parent.mkdir(parents=True, exist_ok=True)
@@ -34,6 +60,10 @@ def shutDown():
         close()
     except (RuntimeError, TypeError, NameError, Exception):
         pass
+    closeFiles()
+    if archivePath is not None:
+        # the indexer is a daemon thread, let it add the last segment
+        closedFiles.join()
     log('done')
     exit(0)
 
@@ -47,22 +77,35 @@ signal(SIGTERM, handler)
 def close():
     cam.close()
 
+def closeFiles():
+    # segments left open would never be indexed, so never counted nor
+    # deleted by dvrip_retention.py
+    global video, audio
+    files = [f for f in (video, audio) if f is not None]
+    video = audio = None
+    for f in files:
+        f.close()
+    if files and archivePath is not None:
+        closedFiles.put([f.name for f in files])
+
 def theActualJob():
 
     prevtime = 0
-    video = None
-    audio = None
+    # a frozen stream is claimed again within seconds instead of waiting
+    # for the socket timeout
+    health = StreamHealth(lambda msg: log('Stream ' + msg['Event'] + ' ' + msg['Status']), camName)
 
     def receiver(frame, meta, user):
-        nonlocal prevtime, video, audio
+        global video, audio
+        nonlocal prevtime
         if frame is None:
             log('Empty frame')
         else:
             tn = time()
             if tn - prevtime >= chunkSize:
                 if video != None:
-                    video.close()
-                    audio.close()
+                    closeFiles()
+                    log('Stream health: ' + str(health.as_dict()))
                 prevtime = tn
                 path = mkpath()
                 log('Starting files: ' + path)
@@ -72,7 +115,12 @@ def theActualJob():
             elif 'frame' in meta: video.write(frame)
 
     log('Starting to grab streams...')
-    cam.start_monitor(receiver)
+    try:
+        cam.start_monitor(receiver, health=health)
+    finally:
+        closeFiles()
+    if not isShuttingDown:
+        raise SomethingIsWrongWithCamera('Cannot start stream')
 
 def syncTime():
     log('Synching time...')
@@ -82,7 +130,11 @@ def syncTime():
 def jobWrapper():
     global cam
     log('Logging in to camera ' + camIp + '...')
-    cam = DVRIPCam(camIp)
+    # lost sessions are restored by DVRIPCam itself, streaming resumes
+    # right after the camera answers again
+    cam = DVRIPCam(camIp, reconnect=True)
+    cam.metrics.add_hook(lambda event, metrics, value: event == 'reconnect' and log('Reconnected'))
+    cam.metrics.add_hook(lambda event, metrics, value: event == 'reclaim' and log('Stream claimed again'))
     if cam.login():
         log('done')
     else:
@@ -94,21 +146,18 @@ def theJob():
     while True:
         try:
             jobWrapper()
-        except (TypeError, ValueError) as err:
+        except (TypeError, ValueError, OSError) as err:
             if isShuttingDown:
                 exit(0)
-            else:
-                try:
-                    log('Error. Attempting to reboot camera...')
-                    cam.reboot()
-                    log('Waiting for ' + str(rebootWait) + 's for reboot...')
-                    sleep(rebootWait)
-                except (UnicodeDecodeError, ValueError, TypeError):
-                    raise SomethingIsWrongWithCamera('Failed to reboot')
+            log('Error: ' + str(err) + '. Logging in again in ' + str(retryIn) + 's...')
+            close()
+            sleep(retryIn)
 
 def main():
     Path(logFile).parent.mkdir(parents=True, exist_ok=True)
     logging.basicConfig(filename=logFile, level=logging.INFO, format='[%(asctime)s] %(message)s')
+    if archivePath is not None:
+        threading.Thread(target=indexer, daemon=True).start()
     while True:
         try:
             theJob()
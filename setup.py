@@ -36,7 +36,13 @@ setup(
         'Programming Language :: Python :: 3 :: Only',
     ],
 
-    py_modules=["dvrip", "DeviceManager", "asyncio_dvrip"],
+    py_modules=["dvrip", "DeviceManager", "asyncio_dvrip", "alarm_filter", "dvrip_simulator", "dvrip_metrics", "dvrip_pool", "dvrip_header", "dvrip_json", "dvrip_keepalive", "dvrip_firmware", "dvrip_activity", "dvrip_health", "dvrip_pts", "dvrip_nal", "dvrip_archive", "dvrip_clip", "dvrip_retention"],
+
+    extras_require={
+        'fast': ['orjson'],
+        'activity': ['numpy'],
+        'test': ['pytest'],
+    },
 
     python_requires='>=3.6',
 
@@ -1,5 +1,6 @@
 from time import sleep
-from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip import SomethingIsWrongWithCamera
+from dvrip_pool import pool
 from pathlib import Path
 import subprocess
 import json
@@ -12,17 +13,19 @@ class SolarCam:
 
     def __init__(self, host_ip, user, password, logger):
         self.logger = logger
-        self.cam = DVRIPCam(
-            host_ip,
-            user=user,
-            password=password,
-        )
+        self.host_ip = host_ip
+        self.user = user
+        self.password = password
+        self.cam = None
 
     def login(self, num_retries=10):
         for i in range(num_retries):
             try:
                 self.logger.debug("Try login...")
-                self.cam.login()
+                self.cam = pool.acquire(self.host_ip, user=self.user, password=self.password)
+                if self.cam.reused:
+                    self.logger.debug("Success! Reusing the open session.")
+                    return
                 self.logger.debug(
                     f"Success! Connected to Camera. Waiting few seconds to let Camera fully boot..."
                 )
@@ -31,7 +34,6 @@ class SolarCam:
                 return
             except SomethingIsWrongWithCamera:
                 self.logger.debug("Could not connect...Camera could be offline")
-                self.cam.close()
 
             if i == 9:
                 raise ConnectionRefusedError(
@@ -40,7 +42,9 @@ class SolarCam:
             sleep(2)
 
     def logout(self):
-        self.cam.close()
+        if self.cam is not None:
+            pool.release(self.cam)
+            self.cam = None
 
     def get_time(self):
         return self.cam.get_time()
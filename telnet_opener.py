@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 
-from dvrip import DVRIPCam
+from dvrip import DVRIPCam, SomethingIsWrongWithCamera
+from dvrip_pool import session
 import argparse
 import datetime
+import io
 import json
-import os
 import re
 import socket
 import time
@@ -96,10 +97,12 @@ def get_envtool(swver):
     return board["envtool"]
 
 
-def make_zip(filename, data):
-    zipf = zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED)
-    zipf.writestr("InstallDesc", data)
-    zipf.close()
+def make_zip(data):
+    """Upgrade package with the InstallDesc `data`, built in memory"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zipf:
+        zipf.writestr("InstallDesc", data)
+    return buf.getvalue()
 
 
 def check_port(host_ip, port):
@@ -151,31 +154,29 @@ def enable_telnet_via_dvrip(host_ip, user="admin", password="",
     """Upload SkipCheck InstallDesc that sets telnetctrl=1, then reboot
     and probe `ports` until telnet opens. Returns the open port, or None.
     """
-    cam = DVRIPCam(host_ip, user=user, password=password)
-    if not cam.login():
+    try:
+        with session(host_ip, user=user, password=password) as cam:
+            sysinfo = cam.get_system_info()
+            upinfo = cam.get_upgrade_info()
+            if isinstance(upinfo, dict) and "Hardware" in upinfo:
+                print(f"Camera {upinfo['Hardware']}, firmware "
+                      f"{sysinfo.get('SoftWareVersion', '?')}")
+
+            package = make_zip(json.dumps(ENABLETELNET_DESC, indent=2))
+            print("Uploading SkipCheck enabletelnet InstallDesc...")
+            cam.upgrade(package)
+    except SomethingIsWrongWithCamera:
         print(f"DVRIP login failed for {host_ip}")
         return None
-    sysinfo = cam.get_system_info()
-    upinfo = cam.get_upgrade_info()
-    if isinstance(upinfo, dict) and "Hardware" in upinfo:
-        print(f"Camera {upinfo['Hardware']}, firmware "
-              f"{sysinfo.get('SoftWareVersion', '?')}")
-
-    zipfname = "enabletelnet.bin"
-    make_zip(zipfname, json.dumps(ENABLETELNET_DESC, indent=2))
-    print("Uploading SkipCheck enabletelnet InstallDesc...")
-    cam.upgrade(zipfname)
-    cam.close()
-    os.remove(zipfname)
 
     # `armbenv -s telnetctrl 1` only writes the env var; the telnet
     # daemon is launched by an init script on next boot.
     print("Rebooting camera to apply telnetctrl=1...")
-    cam = DVRIPCam(host_ip, user=user, password=password)
-    if cam.login():
-        cam.reboot()
-        cam.close()
-    else:
+    # the camera drops the session after an upgrade, so the pool logs in again
+    try:
+        with session(host_ip, user=user, password=password) as cam:
+            cam.reboot()
+    except SomethingIsWrongWithCamera:
         print("Could not log back in to reboot; camera may reboot itself.")
 
     print(f"Waiting for telnet, probing {list(ports)}...")
@@ -258,9 +259,8 @@ def downgrade_old_version(cam, buildtime, swver):
                 print("Something went wrong")
                 return False
 
-            open('upgrade.bin', 'wb').write(r.content)
             print(f"Upgrading...")
-            cam.upgrade('upgrade.bin')
+            cam.upgrade(r.content)
             print("Completed. Wait a minute and then rerun")
             return False
 
@@ -314,11 +314,8 @@ def open_telnet(host_ip, port, **kwargs):
     }
     add_flashes(desc, swver)
 
-    zipfname = "upgrade.bin"
-    make_zip(zipfname, json.dumps(desc, indent=2))
-    cam.upgrade(zipfname)
+    cam.upgrade(make_zip(json.dumps(desc, indent=2)))
     cam.close()
-    os.remove(zipfname)
 
     for i in range(10):
         time.sleep(4)
@@ -0,0 +1,69 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import SimulatorLoop
+from dvrip import DVRIPCam
+from dvrip_header import iter_frames
+from dvrip_simulator import MediaGenerator
+
+START = datetime(2024, 5, 1, 14, 0, 0)
+
+
+@pytest.fixture(scope="session")
+def sim():
+    loop = SimulatorLoop()
+    yield loop
+    loop.stop()
+
+
+@pytest.fixture
+def device(sim, request):
+    """A simulated device, keywords come from @pytest.mark.device(...)"""
+    marker = request.node.get_closest_marker("device")
+    device = sim.device(**(marker.kwargs if marker else {}))
+    yield device
+    sim.run(device.stop())
+
+
+@pytest.fixture
+def cam(device):
+    cam = DVRIPCam("127.0.0.1", port=device.port, proto="udp" if device.udp else "tcp", timeout=5)
+    cam.connect()
+    assert cam.login()
+    yield cam
+    cam.close()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "device(**kwargs): options of the simulated device")
+
+
+def write_segment(folder, start, seed, size=600000):
+    """A monitor.py segment pair of `size` bytes of recording, the end
+    time is the mtime as when monitor.py closes the files"""
+    video = bytearray()
+    audio = bytearray()
+    for offset, frame in iter_frames(MediaGenerator(start=start, seed=seed, bitrate=512).file(size)):
+        (video if frame.kind else audio).extend(frame.data)
+    path = os.path.join(folder, start.strftime("%Y/%m/%d/%H.%M.%S"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    end = start.timestamp() + len(audio) / 8000
+    for ext, data in ((".video", video), (".audio", audio)):
+        with open(path + ext, "wb") as f:
+            f.write(data)
+        os.utime(path + ext, (end, end))
+    return path
+
+
+@pytest.fixture
+def recordings(tmp_path):
+    """Four 10 minute segments of two cameras as monitor.py writes them"""
+    for camera in ("hall", "yard"):
+        for i in range(4):
+            write_segment(str(tmp_path / camera), START + timedelta(minutes=10 * i), i)
+    return tmp_path
@@ -0,0 +1,91 @@
+import io
+import os
+from datetime import timedelta
+
+from conftest import START
+from dvrip_archive import ArchiveIndex
+from dvrip_clip import ClipExtractor
+from dvrip_nal import access_units
+
+T0 = START.timestamp()
+
+
+def test_scan(recordings):
+    with ArchiveIndex(":memory:") as index:
+        assert index.scan(str(recordings)) == {"scanned": 16, "unchanged": 0, "removed": 0}
+        assert index.scan(str(recordings)) == {"scanned": 0, "unchanged": 16, "removed": 0}
+        assert index.cameras() == ["hall", "yard"]
+
+        segments = index.segments("hall", START + timedelta(minutes=5), START + timedelta(minutes=25))
+        assert sorted((s["start"] - T0, s["format"]) for s in segments) == [
+            (600, "annexb"), (600, "g711"), (1200, "annexb"), (1200, "g711"),
+        ]
+        video = [s for s in segments if s["format"] == "annexb"][0]
+        assert (video["codec"], video["width"], video["height"]) == ("h264", 1920, 1080)
+        # a keyframe every 2 seconds, the first at the start of the segment
+        keyframes = index.keyframes(video["id"])
+        assert keyframes[0] == (0, video["start"])
+        assert [round(t - video["start"], 2) for o, t in keyframes[:3]] == [0, 2, 4]
+        assert len(index.coverage("hall", START, START + timedelta(hours=1))) == 4
+
+        usage = index.usage()
+        assert usage["hall"][0] == sum(os.path.getsize(p) for p in walk(recordings / "hall"))
+        os.remove(video["path"])
+        assert index.scan(str(recordings)) == {"scanned": 0, "unchanged": 15, "removed": 1}
+        assert index.usage()["hall"][0] == usage["hall"][0] - video["size"]
+
+
+def walk(folder):
+    for root, dirs, files in os.walk(str(folder)):
+        for name in files:
+            yield os.path.join(root, name)
+
+
+def test_add(recordings, tmp_path):
+    with ArchiveIndex(str(tmp_path / "archive.db")) as index:
+        paths = sorted(walk(recordings / "yard"))[:2]
+        index.add(paths)
+        assert index.usage()["yard"][0] == sum(os.path.getsize(p) for p in paths)
+        assert index.scan(str(recordings)) == {"scanned": 14, "unchanged": 2, "removed": 0}
+
+
+def test_clip(recordings):
+    with ArchiveIndex(":memory:") as index:
+        index.scan(str(recordings))
+        extractor = ClipExtractor(index)
+        pieces = extractor.plan("hall", T0 + 603.0, T0 + 605.5)
+        assert len(pieces) == 1
+        out = io.BytesIO()
+        assert extractor.write(pieces, out) == extractor.size(pieces)
+        clip = out.getvalue()
+        with open(pieces[0].path, "rb") as f:
+            video = f.read()
+        assert video.find(clip) == pieces[0].begin
+        pictures = list(access_units(clip, "h264"))
+        # from the keyframe at 602 s to the last picture before 605.5 s
+        assert pictures[0] == (0, True)
+        assert len(pictures) == round(3.5 * 25)
+
+        path = recordings / "clip.h264"
+        assert extractor.extract("hall", T0 + 603.0, T0 + 605.5, str(path)) == len(clip)
+        assert path.read_bytes() == clip
+        assert extractor.plan("hall", T0 + 3000, T0 + 3100) == []
+
+
+def test_clip_wsgi(recordings):
+    with ArchiveIndex(":memory:") as index:
+        index.scan(str(recordings))
+        extractor = ClipExtractor(index)
+        responses = []
+
+        def get(query):
+            start_response = lambda status, headers: responses.append((status, dict(headers)))
+            body = b"".join(extractor.wsgi({"QUERY_STRING": query}, start_response))
+            return responses[-1][0], responses[-1][1], body
+
+        status, headers, body = get("camera=hall&start=%d&end=%d" % (T0 + 603, T0 + 605))
+        assert status == "200 OK"
+        assert headers["Content-Type"] == "video/H264"
+        assert int(headers["Content-Length"]) == len(body) > 0
+        assert get("camera=hall")[0] == "400 Bad Request"
+        assert get("camera=hall&start=2024-05-01+15:00:00&end=2024-05-01+15:01:00")[0] == "404 Not Found"
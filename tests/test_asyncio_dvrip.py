@@ -0,0 +1,57 @@
+import asyncio
+
+import asyncio_dvrip
+from dvrip_simulator import DVRIPSimulator
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 30))
+
+
+async def session(**kwargs):
+    device = await DVRIPSimulator("127.0.0.1", 0, **kwargs).start()
+    cam = asyncio_dvrip.DVRIPCam("127.0.0.1", port=device.port, timeout=5)
+    assert await cam.login(asyncio.get_running_loop())
+    return device, cam
+
+
+def test_login_and_command():
+    async def main():
+        device, cam = await session()
+        try:
+            info = await cam.get_command("SystemInfo")
+            assert info["SerialNo"] == device.serial
+        finally:
+            cam.close()
+            await device.stop()
+
+    run(main())
+
+
+def test_keepalive_while_monitoring():
+    async def main():
+        device, cam = await session(alive_interval=1)
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        frames = []
+
+        def callback(frame):
+            frames.append(frame)
+            if len(frames) == 250:
+                cam.stop_monitor()
+
+        try:
+            requests = device.requests
+            await cam.start_monitor(callback, frames=True)
+            # keepalives went out while streaming, their replies were skipped
+            assert device.requests - requests >= 4
+        finally:
+            cam.close()
+            await device.stop()
+        assert len(frames) == 250
+        assert cam.metrics.keepalive_misses == 0
+        assert [frame for frame in frames if frame.kind][0].kind == "I"
+        # a second reader of the stream failed with RuntimeError
+        assert not [context for context in errors if isinstance(context.get("exception"), RuntimeError)]
+
+    run(main())
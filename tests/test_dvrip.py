@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+import dvrip_firmware
+from dvrip import DVRIPCam
+
+
+def monitor(cam, count, **kwargs):
+    """The first `count` Frames of the stream"""
+    frames = []
+
+    def callback(frame):
+        frames.append(frame)
+        if len(frames) == count:
+            cam.stop_monitor()
+
+    cam.start_monitor(callback, frames=True, **kwargs)
+    return frames
+
+
+def test_login_and_command(device, cam):
+    assert cam.session != 0
+    assert cam.get_command("SystemInfo")["SerialNo"] == device.serial
+
+
+@pytest.mark.device(speed=0)
+def test_monitor(cam):
+    frames = monitor(cam, 100)
+    video = [frame for frame in frames if frame.kind]
+    assert video[0].kind == "I"
+    assert (video[0].width, video[0].height, video[0].fps) == (1920, 1080, 25)
+    assert set(frame.codec for frame in video) == {"h264"}
+    assert all(frame.data[:4] == b"\x00\x00\x00\x01" for frame in video)
+    assert any(frame.codec == "g711a" for frame in frames)
+
+
+@pytest.mark.device(alive_interval=1)
+def test_keepalive_while_monitoring(device, cam):
+    assert cam.alive_time == 1
+    requests = device.requests
+    # video and audio, about 3 seconds
+    frames = monitor(cam, 150)
+    assert len(frames) == 150
+    # claim, start and a keepalive every second, their replies are skipped
+    assert device.requests - requests >= 4
+    assert cam.metrics.keepalive_misses == 0
+    assert cam.socket is not None
+
+
+@pytest.mark.device(disconnect_after=1, speed=0)
+def test_reconnect_restores_stream(device):
+    cam = DVRIPCam("127.0.0.1", port=device.port, reconnect=True, backoff=0.01, timeout=5)
+    cam.connect()
+    assert cam.login()
+    try:
+        frames = monitor(cam, 150)
+    finally:
+        cam.close()
+    assert len(frames) == 150
+    assert cam.metrics.reconnects >= 1
+
+
+@pytest.mark.device(udp=True, loss=0.05, reorder=0.1)
+def test_udp_loss_and_reorder(device, cam):
+    random.seed(1)
+    assert all(cam.get_command("SystemInfo") is not None for i in range(20))
+    frames = monitor(cam, 100)
+    assert len(frames) == 100
+    assert device.datagrams_dropped > 0
+    # a lost datagram costs its frame, never the stream
+    assert 0 < cam.metrics.datagrams_lost <= device.datagrams_dropped
+    assert all(frame.kind != "I" or frame.data[:4] == b"\x00\x00\x00\x01" for frame in frames)
+
+
+def test_upgrade_closes_own_image(device, cam, tmp_path, monkeypatch):
+    closed = []
+    close = dvrip_firmware.FirmwareImage.close
+
+    def record(image):
+        close(image)
+        closed.append(image.mmap.closed)
+
+    monkeypatch.setattr(dvrip_firmware.FirmwareImage, "close", record)
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(bytes(range(256)) * 1000)
+    assert cam.upgrade(str(path), vprint=lambda *args, **kwargs: None)["Ret"] == 515
+    assert device.upgrades[-1] == path.read_bytes()
+    assert closed == [True]
+
+
+def test_upgrade_keeps_caller_image(device, sim, tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(b"\x5a" * 100000)
+    image = dvrip_firmware.FirmwareImage(str(path))
+    for i in range(2):
+        cam = DVRIPCam("127.0.0.1", port=device.port)
+        cam.connect()
+        assert cam.login()
+        assert cam.upgrade(image, vprint=lambda *args, **kwargs: None)["Ret"] == 515
+    assert len(device.upgrades) == 2 and not image.mmap.closed
+    image.close()
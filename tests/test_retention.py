@@ -0,0 +1,93 @@
+import os
+from datetime import timedelta
+
+import pytest
+
+from conftest import START
+from dvrip_archive import ArchiveIndex
+from dvrip_retention import Limits, RetentionManager, parse_age, parse_camera, parse_size
+
+T0 = START.timestamp()
+
+
+@pytest.fixture
+def index(recordings, tmp_path):
+    with ArchiveIndex(str(tmp_path / "archive.db")) as index:
+        index.scan(str(recordings))
+        yield index
+
+
+def files(index, camera):
+    return [row[0] for row in index.db.execute("SELECT path FROM segments WHERE camera = ? ORDER BY path", (camera,))]
+
+
+def split_pairs(index, camera):
+    stems = {}
+    for path in files(index, camera):
+        stems.setdefault(os.path.splitext(path)[0], []).append(path)
+    return [paths for paths in stems.values() if len(paths) != 2]
+
+
+def test_parse():
+    assert parse_size("2T") == 2 << 40
+    assert parse_size("1.5g") == 3 << 29
+    assert parse_age("30d") == 30 * 86400
+    assert parse_camera("hall=200G/7d")[1].max_age == 7 * 86400
+    assert parse_camera("yard=/1h")[1].max_bytes is None
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+
+def test_quota_deletes_oldest_whole_segments(index):
+    usage = index.usage()["hall"][0]
+    sizes = [os.path.getsize(path) for path in files(index, "hall")]
+    for quota in (usage - 1, usage - max(sizes) - 1000, usage // 3):
+        retention = RetentionManager(index, cameras={"hall": Limits(max_bytes=quota)}, rate=0)
+        retention.enforce()
+        assert index.usage()["hall"][0] <= quota
+        assert split_pairs(index, "hall") == []
+        assert all(os.path.exists(path) for path in files(index, "hall"))
+    remaining = files(index, "hall")
+    assert remaining and os.path.basename(remaining[0]).startswith("14.30.00")
+    # nothing of the other camera
+    assert len(files(index, "yard")) == 8
+
+
+def test_total_quota_and_empty_folders(index, recordings):
+    yard = index.usage()["yard"][0]
+    RetentionManager(index, quota=yard, rate=0).enforce()
+    assert sum(size for size, oldest, newest in index.usage().values()) <= yard
+    for camera in ("hall", "yard"):
+        folder = recordings / camera / "2024" / "05" / "01"
+        assert sorted(os.listdir(str(folder))) == sorted(os.path.basename(p) for p in files(index, camera))
+    RetentionManager(index, quota=0, rate=0).enforce()
+    assert index.usage() == {}
+    assert os.listdir(str(recordings / "hall")) == []
+
+
+def test_pins_are_kept(index):
+    retention = RetentionManager(index, quota=0, rate=0)
+    pin = retention.pin("hall", T0 + 605, T0 + 606, "burglary")
+    assert retention.pins("hall")[0]["note"] == "burglary"
+    retention.enforce()
+    assert [os.path.basename(path) for path in files(index, "hall")] == ["14.10.00.audio", "14.10.00.video"]
+    retention.unpin(pin)
+    retention.enforce()
+    assert files(index, "hall") == []
+
+
+def test_max_age(index):
+    now = START + timedelta(minutes=25)
+    retention = RetentionManager(
+        index,
+        max_age=15 * 60,
+        cameras={"yard": Limits(max_age=60)},
+        clock=now.timestamp,
+        rate=0,
+    )
+    result = retention.enforce()
+    # hall keeps what ended after 14:10, yard what ended after 14:24
+    assert [os.path.basename(path)[:8] for path in files(index, "hall")] == ["14.10.00"] * 2 + ["14.20.00"] * 2 + ["14.30.00"] * 2
+    assert [os.path.basename(path)[:8] for path in files(index, "yard")] == ["14.30.00"] * 2
+    assert result["files"] == 2 + 6
+    assert result["bytes"] == retention.freed